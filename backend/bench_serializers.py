@@ -0,0 +1,115 @@
+# bench_serializers.py
+"""
+序列化方式的基准测试：标准库 json、orjson、MessagePack 编解码典型 WebSocket 消息的耗时与体积，
+以及 REST 响应（FastAPI 默认 JSONResponse 与 FastJSONResponse）的渲染耗时
+用法: python bench_serializers.py [--seconds 0.5]
+"""
+
+import time
+import argparse
+from typing import Any, Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from serializers import JSONSerializer, ORJSONSerializer, MsgpackSerializer, FastJSONResponse, orjson, msgpack
+
+
+def sample_messages() -> Dict[str, Any]:
+    """与实际流量相近的消息：流式片段、工具结果预览、完整结果分块、一页历史记录"""
+    text = "市场数据：沪深300指数收于 3,856.21 点，上涨 0.84%。Market data for AAPL closed at 189.30. " * 4
+    record = {
+        "id": 1024,
+        "session_id": "7d17a6fe-b06a-4f73-87ff-fc2b132f7c8a",
+        "conversation_id": 12,
+        "user_input": "帮我查询最近一周的行情并分析走势",
+        "user_timestamp": "2026-10-18T09:30:00",
+        "mcp_tools_called": [{"tool_id": "call_1", "tool_name": "get_quote", "tool_args": {"symbol": "000300", "days": 7}}],
+        "mcp_results": [{"tool_id": "call_1", "tool_name": "get_quote", "result": text * 3, "success": True}],
+        "ai_response": text * 6,
+        "ai_timestamp": "2026-10-18T09:30:12",
+        "created_at": "2026-10-18 09:30:12"
+    }
+    return {
+        "ai_response_chunk": {"type": "ai_response_chunk", "content": "走势整体", "seq": 4821},
+        "tool_end": {
+            "type": "tool_end", "tool_id": "call_1", "tool_name": "get_quote",
+            "result": (text * 20)[:4000], "result_size": 18000, "truncated": True, "cached": False, "seq": 4822
+        },
+        "tool_result_chunk": {"type": "tool_result_chunk", "tool_id": "call_1", "content": (text * 300)[:64000], "index": 0, "done": False},
+        "history_page": {"success": True, "data": [dict(record, id=record["id"] + i) for i in range(50)], "has_more": True}
+    }
+
+
+def measure(func: Callable[[], Any], seconds: float) -> float:
+    """在给定时间内重复调用，返回每次调用的平均微秒数"""
+    func()
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        func()
+        count += 1
+        if count % 16 == 0 and time.perf_counter() >= deadline:
+            break
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def bench_serializers(messages: Dict[str, Any], seconds: float) -> List[Dict[str, Any]]:
+    serializers = [JSONSerializer()]
+    if orjson is not None:
+        serializers.append(ORJSONSerializer())
+    if msgpack is not None:
+        serializers.append(MsgpackSerializer())
+
+    rows = []
+    for name, message in messages.items():
+        for serializer in serializers:
+            payload = serializer.dumps(message)
+            size = len(payload.encode("utf-8")) if isinstance(payload, str) else len(payload)
+            rows.append({
+                "message": name,
+                "serializer": serializer.name,
+                "bytes": size,
+                "dumps_us": measure(lambda: serializer.dumps(message), seconds),
+                "loads_us": measure(lambda: serializer.loads(payload), seconds)
+            })
+    return rows
+
+
+def bench_responses(content: Dict[str, Any], seconds: float) -> List[Dict[str, Any]]:
+    """FastAPI 返回 dict 时先经 jsonable_encoder 再由响应类渲染；直接返回 FastJSONResponse 时跳过前者"""
+    return [
+        {"response": "JSONResponse(jsonable_encoder)", "us": measure(lambda: JSONResponse(jsonable_encoder(content)), seconds)},
+        {"response": "FastJSONResponse(jsonable_encoder)", "us": measure(lambda: FastJSONResponse(jsonable_encoder(content)), seconds)},
+        {"response": "FastJSONResponse", "us": measure(lambda: FastJSONResponse(content), seconds)}
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较 json / orjson / msgpack 的编解码性能")
+    parser.add_argument("--seconds", type=float, default=0.5, help="每项测试的持续时间（秒）")
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("⚠️ 未安装 orjson，只测试标准库 json")
+    if msgpack is None:
+        print("⚠️ 未安装 msgpack，跳过 MessagePack")
+
+    messages = sample_messages()
+    print(f"{'消息':<20}{'编码':<10}{'字节数':>10}{'编码(µs)':>12}{'解码(µs)':>12}")
+    baseline = {}
+    for row in bench_serializers(messages, args.seconds):
+        key = row["message"]
+        baseline.setdefault(key, row["dumps_us"])
+        speedup = baseline[key] / row["dumps_us"] if row["dumps_us"] else 0
+        print(f"{key:<20}{row['serializer']:<10}{row['bytes']:>10}{row['dumps_us']:>12.2f}{row['loads_us']:>12.2f}   x{speedup:.1f}")
+
+    print()
+    print(f"{'REST 响应（50条历史记录）':<40}{'耗时(µs)':>12}")
+    for row in bench_responses(messages["history_page"], args.seconds):
+        print(f"{row['response']:<40}{row['us']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# circuit_breaker.py
+"""
+MCP服务器熔断器
+连续失败达到阈值后熔断（快速失败），冷却期结束后放行一次试探调用，成功则恢复
+"""
+
+import time
+from typing import Dict, Any, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断期间拒绝调用"""
+
+    def __init__(self, server_name: str, retry_after: float):
+        self.server_name = server_name
+        self.retry_after = retry_after
+        super().__init__(f"服务器 '{server_name}' 连续失败已熔断，约 {max(0, round(retry_after))} 秒后重试")
+
+
+class CircuitBreaker:
+    """单个服务器的熔断器"""
+
+    def __init__(self, server_name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        """
+        Args:
+            server_name: 服务器名
+            failure_threshold: 连续失败多少次后熔断
+            recovery_timeout: 熔断后多少秒放行试探调用
+        """
+        self.server_name = server_name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.total_failures = 0
+        self.total_rejected = 0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        """调用前检查，熔断中抛出 CircuitOpenError；冷却期结束时放行一次试探调用"""
+        if self.state == CLOSED:
+            return
+        elapsed = time.monotonic() - (self.opened_at or 0)
+        if self.state == OPEN and elapsed >= self.recovery_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            print(f"🔌 服务器 {self.server_name} 熔断冷却结束，放行试探调用")
+            return
+        self.total_rejected += 1
+        raise CircuitOpenError(self.server_name, self.recovery_timeout - elapsed)
+
+    def record_success(self):
+        if self.state != CLOSED:
+            print(f"✅ 服务器 {self.server_name} 已恢复，熔断关闭")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self, error: str = None):
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                print(f"🚫 服务器 {self.server_name} 连续失败 {self.consecutive_failures} 次，熔断 {self.recovery_timeout} 秒")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """试探调用被取消（既非成功也非失败）时释放试探名额"""
+        self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        retry_after = None
+        if self.state == OPEN and self.opened_at is not None:
+            retry_after = max(0.0, round(self.recovery_timeout - (time.monotonic() - self.opened_at), 1))
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "recovery_timeout": self.recovery_timeout,
+            "retry_after": retry_after,
+            "total_failures": self.total_failures,
+            "total_rejected": self.total_rejected,
+            "last_error": self.last_error
+        }
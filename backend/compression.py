@@ -0,0 +1,271 @@
+# compression.py
+"""
+大文本列的透明压缩
+超过阈值的文本压缩后以 BLOB 存储，首字节为编码标记：未压缩的旧数据仍是 TEXT，读取时按类型区分，无需迁移即可兼容
+编码格式：标记(1字节) [+ 字典ID(4字节)] + 原始字节数(4字节) + 压缩数据
+"""
+
+import os
+import time
+import zlib
+import struct
+import asyncio
+from typing import Dict, List, Any, Optional, Union
+
+from env import env_int
+
+# zstandard 为可选依赖，未安装时使用 zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MARKER_ZLIB = 0x01
+MARKER_ZSTD = 0x02
+MARKER_ZSTD_DICT = 0x03
+
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+CODEC_OFF = "off"
+
+
+def stored_size(value: Union[str, bytes, None]) -> int:
+    """列值还原后的字节数（只读头部，不解压）"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    offset = 5 if value[0] == MARKER_ZSTD_DICT else 1
+    return struct.unpack_from(">I", value, offset)[0]
+
+
+class TextCodec:
+    """按阈值压缩 / 解压文本列，并统计压缩率与解压耗时"""
+
+    def __init__(self, codec: str = None, min_bytes: int = None, level: int = None):
+        """
+        Args:
+            codec: zlib / zstd / off；选择 zstd 但未安装 zstandard 时退回 zlib
+            min_bytes: 小于该字节数的文本不压缩
+            level: 压缩级别，默认 zlib 6、zstd 3
+        """
+        codec = (codec or os.getenv("CHAT_DB_COMPRESSION", CODEC_ZLIB)).strip().lower() or CODEC_ZLIB
+        if codec == CODEC_ZSTD and zstandard is None:
+            print("⚠️ 未安装 zstandard，文本压缩改用 zlib")
+            codec = CODEC_ZLIB
+        if codec not in (CODEC_ZLIB, CODEC_ZSTD, CODEC_OFF):
+            print(f"⚠️ 未知的压缩算法 {codec}，改用 zlib")
+            codec = CODEC_ZLIB
+        self.codec = codec
+        self.min_bytes = max(1, min_bytes if min_bytes is not None else env_int("CHAT_DB_COMPRESS_MIN_BYTES", 1024))
+        default_level = 3 if codec == CODEC_ZSTD else 6
+        self.level = level if level is not None else env_int("CHAT_DB_COMPRESS_LEVEL", default_level)
+
+        # zstd 字典：id -> 字典，写入时使用最新训练的一个
+        self._dicts: Dict[int, Any] = {}
+        self._dict_id: Optional[int] = None
+        self._compressor = None
+        self._decompressors: Dict[Optional[int], Any] = {}
+        if codec == CODEC_ZSTD:
+            self._compressor = zstandard.ZstdCompressor(level=self.level)
+
+        # 指标
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_ms = 0.0
+        self.decompressed = 0
+        self.decompressed_bytes = 0
+        self.decompress_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.codec != CODEC_OFF
+
+    @property
+    def dictionary_id(self) -> Optional[int]:
+        return self._dict_id
+
+    def load_dictionary(self, dict_id: int, data: bytes, use_for_writes: bool = True):
+        """载入已训练的 zstd 字典（读取旧数据需要全部字典）"""
+        if zstandard is None:
+            return
+        self._dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+        if use_for_writes and self.codec == CODEC_ZSTD:
+            self._dict_id = dict_id
+            self._compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._dicts[dict_id])
+
+    @staticmethod
+    def train_dictionary(samples: List[str], size: int = 64 * 1024) -> Optional[bytes]:
+        """用已有文本训练 zstd 字典，样本不足或未安装 zstandard 时返回 None"""
+        if zstandard is None or len(samples) < 50:
+            return None
+        try:
+            return zstandard.train_dictionary(size, [s.encode("utf-8") for s in samples]).as_bytes()
+        except Exception as e:
+            print(f"⚠️ zstd 字典训练失败: {e}")
+            return None
+
+    def encode(self, text: Optional[str]) -> Union[str, bytes, None]:
+        """写入前调用：超过阈值时返回压缩后的 BLOB，否则原样返回"""
+        if text is None or not self.enabled:
+            return text
+        raw = text.encode("utf-8")
+        if len(raw) < self.min_bytes:
+            self.skipped += 1
+            return text
+        started = time.perf_counter()
+        size = struct.pack(">I", len(raw))
+        if self.codec == CODEC_ZSTD:
+            payload = self._compressor.compress(raw)
+            if self._dict_id is not None:
+                blob = bytes([MARKER_ZSTD_DICT]) + struct.pack(">I", self._dict_id) + size + payload
+            else:
+                blob = bytes([MARKER_ZSTD]) + size + payload
+        else:
+            blob = bytes([MARKER_ZLIB]) + size + zlib.compress(raw, self.level)
+        self.compress_ms += (time.perf_counter() - started) * 1000
+        # 压缩后没有变小的（如已压缩过的数据）保持原文
+        if len(blob) >= len(raw):
+            self.skipped += 1
+            return text
+        self.compressed += 1
+        self.raw_bytes += len(raw)
+        self.stored_bytes += len(blob)
+        return blob
+
+    def decode(self, value: Union[str, bytes, None]) -> Optional[str]:
+        """读取后调用：BLOB 按标记解压，TEXT（未压缩或旧数据）原样返回"""
+        if value is None or isinstance(value, str):
+            return value
+        started = time.perf_counter()
+        marker = value[0]
+        if marker == MARKER_ZLIB:
+            raw = zlib.decompress(value[5:])
+        elif marker in (MARKER_ZSTD, MARKER_ZSTD_DICT):
+            if zstandard is None:
+                raise RuntimeError("数据使用 zstd 压缩，但未安装 zstandard")
+            dict_id = struct.unpack_from(">I", value, 1)[0] if marker == MARKER_ZSTD_DICT else None
+            raw = self._decompressor(dict_id).decompress(value[9:] if dict_id is not None else value[5:])
+        else:
+            raise ValueError(f"未知的压缩标记: {marker}")
+        self.decompressed += 1
+        self.decompressed_bytes += len(raw)
+        self.decompress_ms += (time.perf_counter() - started) * 1000
+        return raw.decode("utf-8")
+
+    def _decompressor(self, dict_id: Optional[int]):
+        decompressor = self._decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id is not None and dict_id not in self._dicts:
+                raise RuntimeError(f"缺少 zstd 字典 {dict_id}")
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._dicts[dict_id]) if dict_id is not None else zstandard.ZstdDecompressor()
+            self._decompressors[dict_id] = decompressor
+        return decompressor
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "codec": self.codec,
+            "min_bytes": self.min_bytes,
+            "level": self.level,
+            "dictionary_id": self._dict_id,
+            "compressed": self.compressed,
+            "skipped": self.skipped,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "ratio": round(self.stored_bytes / self.raw_bytes, 4) if self.raw_bytes else None,
+            "compress_ms": round(self.compress_ms, 3),
+            "avg_compress_ms": round(self.compress_ms / self.compressed, 4) if self.compressed else 0.0,
+            "decompressed": self.decompressed,
+            "decompressed_bytes": self.decompressed_bytes,
+            "decompress_ms": round(self.decompress_ms, 3),
+            "avg_decompress_ms": round(self.decompress_ms / self.decompressed, 4) if self.decompressed else 0.0,
+            "decompress_mb_per_s": round(self.decompressed_bytes / 1024 / 1024 / (self.decompress_ms / 1000), 1) if self.decompress_ms else None
+        }
+
+
+def merge_codec_stats(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """合并多个 TextCodec.stats()（分片存储），累计值相加后重新计算比率与平均值"""
+    merged = dict(items[0])
+    for key in ("compressed", "skipped", "raw_bytes", "stored_bytes", "compress_ms",
+                "decompressed", "decompressed_bytes", "decompress_ms"):
+        merged[key] = sum(item[key] for item in items)
+    merged["dictionary_id"] = [item["dictionary_id"] for item in items]
+    merged["ratio"] = round(merged["stored_bytes"] / merged["raw_bytes"], 4) if merged["raw_bytes"] else None
+    merged["avg_compress_ms"] = round(merged["compress_ms"] / merged["compressed"], 4) if merged["compressed"] else 0.0
+    merged["avg_decompress_ms"] = round(merged["decompress_ms"] / merged["decompressed"], 4) if merged["decompressed"] else 0.0
+    merged["decompress_mb_per_s"] = (
+        round(merged["decompressed_bytes"] / 1024 / 1024 / (merged["decompress_ms"] / 1000), 1) if merged["decompress_ms"] else None
+    )
+    return merged
+
+
+class CompressionMigration:
+    """后台逐批压缩旧数据中未压缩的大文本，每批单独提交，批次之间让出写连接"""
+
+    def __init__(self, db, batch_size: int = None, pause: float = None):
+        """
+        Args:
+            db: ChatDatabase 实例（需提供 compress_batch）
+            batch_size: 每批处理的行数
+            pause: 批次之间的间隔秒数
+        """
+        self.db = db
+        self.batch_size = max(1, batch_size if batch_size is not None else env_int("CHAT_DB_COMPRESS_BATCH", 200))
+        self.pause = max(0.0, pause if pause is not None else env_int("CHAT_DB_COMPRESS_PAUSE_MS", 50) / 1000)
+        self._task: Optional[asyncio.Task] = None
+        self.done = False
+        self.rows = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        if not self.db.compression_enabled:
+            self.done = True
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        try:
+            await self.db.ensure_compression_dictionary()
+            for table in ("chat_records", "chat_tool_results"):
+                last_id = 0
+                while True:
+                    progress = await self.db.compress_batch(table, last_id, self.batch_size)
+                    if progress is None:
+                        break
+                    last_id, rows, raw_bytes, stored_bytes = progress
+                    self.rows += rows
+                    self.raw_bytes += raw_bytes
+                    self.stored_bytes += stored_bytes
+                    await asyncio.sleep(self.pause)
+            self.done = True
+            if self.rows:
+                print(f"🗜️ 旧数据压缩完成: {self.rows} 行, {self.raw_bytes} → {self.stored_bytes} 字节")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"❌ 旧数据压缩失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "done": self.done,
+            "rows": self.rows,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "saved_bytes": self.raw_bytes - self.stored_bytes,
+            "last_error": self.last_error
+        }
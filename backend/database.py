@@ -6,37 +6,340 @@ SQLite数据库管理
 
 import os
 import json
+import base64
+import asyncio
 import aiosqlite
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 from datetime import datetime
 from pathlib import Path
 
+from search_index import index_text, build_match_query, session_token, snippet_pattern, build_snippet, leading_snippet
+from compression import TextCodec, stored_size
+from storage import ChatStorage, TOOLS_FULL, TOOLS_CALLS, TOOLS_NONE, TOOL_LOAD_MODES
+from env import env_int
 
-class ChatDatabase:
+
+# 连接级PRAGMA：WAL下读写互不阻塞；synchronous=NORMAL 在WAL下仍保证一致性，只在断电时可能丢失最后的事务
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",        # 约16MB页缓存
+    "PRAGMA mmap_size=268435456",      # 256MB内存映射读取
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+# 每个连接缓存的预编译语句数量
+STATEMENT_CACHE_SIZE = 256
+
+def encode_cursor(record: Dict[str, Any]) -> str:
+    """将记录的 (created_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([record.get('created_at'), record.get('id')], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """解析分页游标，格式错误时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return str(created_at), int(record_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+
+
+# 表结构版本（PRAGMA user_version），旧数据库在 initialize() 中按版本逐步迁移
+SCHEMA_VERSION = 3
+
+# 工具调用与结果表：每次调用一行，体积较大的结果正文单独存放，按需读取
+TOOL_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS chat_tool_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        record_id INTEGER NOT NULL,
+        session_id TEXT,
+        position INTEGER NOT NULL,      -- 在本轮对话中的调用顺序
+        tool_id TEXT,
+        tool_name TEXT,
+        tool_args TEXT,                 -- JSON；只有结果没有调用信息时为NULL
+        progress TEXT,
+        success INTEGER,                -- 1 成功 / 0 失败 / NULL 无结果
+        error TEXT,
+        result_size INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (record_id) REFERENCES chat_records(id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_tool_results (
+        call_id INTEGER PRIMARY KEY,    -- chat_tool_calls.id
+        result TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_tool_calls_record ON chat_tool_calls(record_id, position)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_tool_calls_tool_id ON chat_tool_calls(tool_id)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_tool_calls_name ON chat_tool_calls(tool_name, created_at)",
+    # 覆盖按天统计的查询，无需回表
+    "CREATE INDEX IF NOT EXISTS idx_chat_tool_calls_created ON chat_tool_calls(created_at, tool_name, success, result_size)",
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_chat_records_tools_delete
+    AFTER DELETE ON chat_records
+    BEGIN
+        DELETE FROM chat_tool_results WHERE call_id IN (SELECT id FROM chat_tool_calls WHERE record_id = OLD.id);
+        DELETE FROM chat_tool_calls WHERE record_id = OLD.id;
+    END
+    """,
+)
+
+
+# 全文索引：每条对话记录一行（rowid 即 chat_records.id），中日韩文字按单字建索引，见 search_index.py
+# session_key 为会话ID的哈希，按会话过滤时直接在索引内求交集
+# 无原文（content=''）：只保存倒排索引，摘要在检索时从结果页记录的原文生成；
+# 删除记录前由 _unindex_records 按写入时相同的文本从索引中移除（无原文的索引不支持按 rowid 删除）
+SEARCH_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(
+        session_key, user_input, ai_response, tool_results,
+        content = '',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+)
+# 排序权重：会话键（不参与评分）、用户问题、AI回复、工具结果
+SEARCH_RANK = "bm25(0.0, 1.0, 1.0, 0.5)"
+
+
+def _search_values(session_id: str, user_input: str, ai_response: str, tool_results: List[Any]) -> Tuple[str, str, str, str]:
+    """一条记录在全文索引中的各列；写入与删除索引必须使用相同的值"""
+    results_text = "\n".join(
+        result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+        for result in tool_results if result is not None
+    )
+    return session_token(session_id), index_text(user_input), index_text(ai_response), index_text(results_text)
+
+
+# 已训练的 zstd 压缩字典（见 compression.py），读取旧数据需要保留全部字典
+COMPRESSION_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS chat_compression_dicts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+)
+# 透明压缩的列：(表, 主键, 列)
+COMPRESSED_COLUMNS = (
+    ("chat_records", "id", "ai_response"),
+    ("chat_tool_results", "call_id", "result"),
+)
+
+
+# 归档索引：已移出数据库的会话在归档文件中的位置
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS chat_archive (
+        session_id TEXT PRIMARY KEY,
+        archive_file TEXT NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        record_count INTEGER NOT NULL,
+        first_record TIMESTAMP,
+        last_record TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # 按最近活跃时间挑选过期会话
+    "CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated ON chat_sessions(updated_at)",
+)
+
+
+# 会话在数据库中仍有记录（已整体归档的会话不再作为归档候选）
+_HAS_RECORDS = "EXISTS (SELECT 1 FROM chat_records r WHERE r.session_id = s.session_id)"
+
+
+def tool_rows(mcp_tools_called: List[Dict[str, Any]] = None, mcp_results: List[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """按 tool_id 合并工具调用与结果，每次调用一行；没有对应调用的结果追加在末尾"""
+    rows: List[Dict[str, Any]] = []
+    by_id: Dict[Any, Dict[str, Any]] = {}
+    for call in mcp_tools_called or []:
+        row = {
+            "tool_id": call.get("tool_id"),
+            "tool_name": call.get("tool_name"),
+            "tool_args": call.get("tool_args") if call.get("tool_args") is not None else {},
+            "progress": call.get("progress"),
+            "success": None,
+            "error": None,
+            "result": None,
+            "result_size": None
+        }
+        rows.append(row)
+        if row["tool_id"] is not None:
+            by_id.setdefault(row["tool_id"], row)
+    for result in mcp_results or []:
+        row = by_id.get(result.get("tool_id"))
+        if row is None or row["success"] is not None:
+            row = {"tool_id": result.get("tool_id"), "tool_name": result.get("tool_name"), "tool_args": None, "progress": None}
+            rows.append(row)
+        row["tool_name"] = row.get("tool_name") or result.get("tool_name")
+        row["success"] = bool(result.get("success", "error" not in result))
+        row["error"] = result.get("error")
+        row["result"] = result.get("result")
+        size = result.get("result_size")
+        if size is None and row["result"] is not None:
+            size = len(str(row["result"]))
+        row["result_size"] = size
+    return rows
+
+# 统计计数表及维护它们的触发器：写入/删除记录时增量更新，get_stats 无需扫描 chat_records
+STATS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS chat_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_records INTEGER NOT NULL DEFAULT 0,
+        total_sessions INTEGER NOT NULL DEFAULT 0,
+        total_conversations INTEGER NOT NULL DEFAULT 0,
+        latest_record TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_session_counts (
+        session_id TEXT PRIMARY KEY,
+        record_count INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_conversation_counts (
+        session_id TEXT NOT NULL,
+        conversation_id INTEGER NOT NULL,
+        record_count INTEGER NOT NULL,
+        PRIMARY KEY (session_id, conversation_id)
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_chat_records_stats_insert
+    AFTER INSERT ON chat_records
+    BEGIN
+        INSERT INTO chat_session_counts (session_id, record_count) VALUES (NEW.session_id, 1)
+            ON CONFLICT(session_id) DO UPDATE SET record_count = record_count + 1;
+        INSERT INTO chat_conversation_counts (session_id, conversation_id, record_count)
+            VALUES (NEW.session_id, COALESCE(NEW.conversation_id, 0), 1)
+            ON CONFLICT(session_id, conversation_id) DO UPDATE SET record_count = record_count + 1;
+        UPDATE chat_stats SET
+            total_records = total_records + 1,
+            total_sessions = total_sessions + (
+                SELECT record_count = 1 FROM chat_session_counts WHERE session_id = NEW.session_id),
+            total_conversations = total_conversations + (
+                SELECT record_count = 1 FROM chat_conversation_counts
+                WHERE session_id = NEW.session_id AND conversation_id = COALESCE(NEW.conversation_id, 0)),
+            latest_record = MAX(COALESCE(latest_record, ''), NEW.created_at)
+        WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_chat_records_stats_delete
+    AFTER DELETE ON chat_records
+    BEGIN
+        UPDATE chat_session_counts SET record_count = record_count - 1 WHERE session_id = OLD.session_id;
+        UPDATE chat_conversation_counts SET record_count = record_count - 1
+            WHERE session_id = OLD.session_id AND conversation_id = COALESCE(OLD.conversation_id, 0);
+        UPDATE chat_stats SET
+            total_records = total_records - 1,
+            total_sessions = total_sessions - (
+                SELECT record_count = 0 FROM chat_session_counts WHERE session_id = OLD.session_id),
+            total_conversations = total_conversations - (
+                SELECT record_count = 0 FROM chat_conversation_counts
+                WHERE session_id = OLD.session_id AND conversation_id = COALESCE(OLD.conversation_id, 0)),
+            -- 走 created_at 索引，只读取一行
+            latest_record = (SELECT MAX(created_at) FROM chat_records)
+        WHERE id = 1;
+        DELETE FROM chat_session_counts WHERE session_id = OLD.session_id AND record_count <= 0;
+        DELETE FROM chat_conversation_counts
+            WHERE session_id = OLD.session_id AND conversation_id = COALESCE(OLD.conversation_id, 0) AND record_count <= 0;
+    END
+    """,
+)
+
+
+class ChatDatabase(ChatStorage):
     """聊天记录数据库管理类"""
     
-    def __init__(self, db_path: str = "chat_history.db"):
+    def __init__(self, db_path: str = "chat_history.db", id_base: int = 0):
         """初始化数据库连接
         
         Args:
             db_path: 数据库文件路径，默认为当前目录下的chat_history.db
+            id_base: 记录与工具调用的自增ID起点，分片存储用它保证各分片的ID互不重叠
         """
         # 确保使用绝对路径
         if not os.path.isabs(db_path):
             db_path = Path(__file__).parent / db_path
         
         self.db_path = str(db_path)
+        self.id_base = id_base
         print(f"📁 数据库路径: {self.db_path}")
-    
+
+        # 连接池：一个写连接 + 若干只读连接，在 initialize() 中打开、close() 中释放
+        self.reader_count = max(1, env_int("CHAT_DB_READERS", 4))
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        # SQLite 未编译 FTS5 时关闭全文检索
+        self.search_enabled = False
+        # auto_vacuum=INCREMENTAL 是否生效（旧数据库需显式转换）
+        self.incremental_vacuum_enabled = False
+        # ai_response 与工具结果的透明压缩
+        self.codec = TextCodec()
+
+    async def _open_connection(self, readonly: bool = False) -> aiosqlite.Connection:
+        """打开一个长连接并应用PRAGMA"""
+        conn = await aiosqlite.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        # 统计压缩列的原始大小（只读BLOB头部）
+        await conn.create_function("stored_size", 1, stored_size, deterministic=True)
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @asynccontextmanager
+    async def _read(self):
+        """借用一个只读连接"""
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        """独占写连接；异常时回滚未提交的事务"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                raise
+
     async def initialize(self):
-        """初始化数据库表结构"""
+        """初始化连接池与数据库表结构"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # 创建聊天会话表
+            self._writer = await self._open_connection()
+            # WAL 为持久化设置，只需在写连接上设置一次
+            cursor = await self._writer.execute("PRAGMA journal_mode=WAL")
+            journal_mode = (await cursor.fetchone())[0]
+            if str(journal_mode).lower() != "wal":
+                print(f"⚠️ 未能启用WAL模式，当前日志模式: {journal_mode}")
+            await self._enable_incremental_vacuum()
+
+            async with self._write() as db:
+                # 创建聊天会话表（每个会话一行，同时作为conversation_id计数器）
                 await db.execute("""
                     CREATE TABLE IF NOT EXISTS chat_sessions (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        session_id TEXT NOT NULL,
+                        session_id TEXT NOT NULL UNIQUE,
+                        last_conversation_id INTEGER NOT NULL DEFAULT 0,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
@@ -53,9 +356,9 @@ class ChatDatabase:
                         user_input TEXT,
                         user_timestamp TIMESTAMP,
                         
-                        -- MCP工具相关
-                        mcp_tools_called TEXT,  -- JSON格式存储调用的工具信息
-                        mcp_results TEXT,       -- JSON格式存储工具返回结果
+                        -- MCP工具相关（旧版本的JSON存储，现已迁移到 chat_tool_calls / chat_tool_results）
+                        mcp_tools_called TEXT,
+                        mcp_results TEXT,
                         
                         -- AI回复
                         ai_response TEXT,
@@ -69,10 +372,12 @@ class ChatDatabase:
                 """)
                 
                 # 创建索引以提高查询性能
+                # 按会话取最近记录的查询直接走 (session_id, created_at)，它同时覆盖按 session_id 的过滤
                 await db.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_chat_records_session 
-                    ON chat_records(session_id)
+                    CREATE INDEX IF NOT EXISTS idx_chat_records_session_created 
+                    ON chat_records(session_id, created_at)
                 """)
+                await db.execute("DROP INDEX IF EXISTS idx_chat_records_session")
                 
                 await db.execute("""
                     CREATE INDEX IF NOT EXISTS idx_chat_records_conversation 
@@ -83,31 +388,421 @@ class ChatDatabase:
                     CREATE INDEX IF NOT EXISTS idx_chat_records_created 
                     ON chat_records(created_at)
                 """)
+
+                for statement in TOOL_SCHEMA:
+                    await db.execute(statement)
+
+                await self._migrate(db)
+
+                for statement in ARCHIVE_SCHEMA:
+                    await db.execute(statement)
+                for statement in COMPRESSION_SCHEMA:
+                    await db.execute(statement)
+                await self._load_compression_dicts(db)
+                await self._init_search(db)
+
+                # 统计计数表与触发器；旧数据库首次升级时做一次全量统计
+                for statement in STATS_SCHEMA:
+                    await db.execute(statement)
+                cursor = await db.execute("SELECT 1 FROM chat_stats WHERE id = 1")
+                if await cursor.fetchone() is None:
+                    await self._recount_stats(db)
+
+                if self.id_base:
+                    await self._reserve_id_range(db)
                 
                 await db.commit()
                 print("✅ 数据库表结构初始化完成")
-                return True
+
+            self._readers = [await self._open_connection(readonly=True) for _ in range(self.reader_count)]
+            self._reader_pool = asyncio.Queue()
+            for conn in self._readers:
+                self._reader_pool.put_nowait(conn)
+            print(f"🔗 数据库连接池就绪 (1 写 + {self.reader_count} 读, WAL)")
+            return True
                 
         except Exception as e:
             print(f"❌ 数据库初始化失败: {e}")
+            await self.close()
             return False
     
-    async def start_conversation(self, session_id: str = "default") -> int:
-        """开始新的对话，返回conversation_id"""
+    async def _reserve_id_range(self, db: aiosqlite.Connection):
+        """将自增ID的起点提升到 id_base（已超过时不变）"""
+        for table in ("chat_records", "chat_tool_calls"):
+            cursor = await db.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+            row = await cursor.fetchone()
+            if row is None:
+                await db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, self.id_base))
+            elif row[0] < self.id_base:
+                await db.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (self.id_base, table))
+
+    async def _migrate(self, db: aiosqlite.Connection):
+        """按 PRAGMA user_version 升级旧数据库（不提交）"""
+        cursor = await db.execute("PRAGMA user_version")
+        version = (await cursor.fetchone())[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        if version < 1:
+            cursor = await db.execute("PRAGMA table_info(chat_sessions)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if "last_conversation_id" not in columns:
+                # 旧表 session_id 无唯一约束，INSERT OR IGNORE 每次都会新增一行：去重后重建，并用现有记录初始化计数器
+                await db.execute("""
+                    CREATE TABLE chat_sessions_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_id TEXT NOT NULL UNIQUE,
+                        last_conversation_id INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await db.execute("""
+                    INSERT INTO chat_sessions_new (session_id, last_conversation_id, created_at, updated_at)
+                    SELECT session_id,
+                           COALESCE((SELECT MAX(conversation_id) FROM chat_records r WHERE r.session_id = s.session_id), 0),
+                           MIN(created_at), MAX(updated_at)
+                    FROM chat_sessions s
+                    WHERE session_id IS NOT NULL
+                    GROUP BY session_id
+                """)
+                # 只有记录、没有会话行的会话
+                await db.execute("""
+                    INSERT INTO chat_sessions_new (session_id, last_conversation_id, created_at, updated_at)
+                    SELECT session_id, COALESCE(MAX(conversation_id), 0), MIN(created_at), MAX(created_at)
+                    FROM chat_records
+                    WHERE session_id IS NOT NULL
+                      AND session_id NOT IN (SELECT session_id FROM chat_sessions_new)
+                    GROUP BY session_id
+                """)
+                cursor = await db.execute("SELECT COUNT(*) FROM chat_sessions")
+                before = (await cursor.fetchone())[0]
+                await db.execute("DROP TABLE chat_sessions")
+                await db.execute("ALTER TABLE chat_sessions_new RENAME TO chat_sessions")
+                cursor = await db.execute("SELECT COUNT(*) FROM chat_sessions")
+                after = (await cursor.fetchone())[0]
+                print(f"🔧 已迁移 chat_sessions：{before} 行去重为 {after} 个会话")
+
+        if version < 2:
+            await self._migrate_tool_payloads(db)
+
+        if version < 3:
+            # 旧的全文索引保存了一份未压缩的原文：删除后由 _init_search 重建为无原文的索引
+            cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_search'")
+            if await cursor.fetchone() is not None:
+                await db.execute("DROP TRIGGER IF EXISTS trg_chat_records_search_delete")
+                await db.execute("DROP TABLE chat_search")
+                print("🔧 已删除保存原文的全文索引，将重建为无原文的索引")
+
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    async def _enable_incremental_vacuum(self):
+        """启用 auto_vacuum=INCREMENTAL，空闲页由后台任务分批回收
+        
+        WAL 模式下切换需要一次完整 VACUUM：新数据库几乎没有开销，直接切换；
+        已有数据库的 VACUUM 会阻塞启动并需要约两倍文件大小的磁盘空间，
+        仅在设置 CHAT_DB_VACUUM_CONVERT=1 时执行，否则保持原模式（空闲页留在freelist中复用）
+        """
+        cursor = await self._writer.execute("PRAGMA auto_vacuum")
+        if (await cursor.fetchone())[0] == 2:
+            self.incremental_vacuum_enabled = True
+            return
+        cursor = await self._writer.execute("SELECT COUNT(*) FROM sqlite_master")
+        has_tables = (await cursor.fetchone())[0] > 0
+        if has_tables and not env_int("CHAT_DB_VACUUM_CONVERT", 0):
+            print("ℹ️ 数据库未启用增量回收，空闲页将保留在freelist中复用"
+                  "（设置 CHAT_DB_VACUUM_CONVERT=1 后重启可执行一次性转换）")
+            return
+        await self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if has_tables:
+            print("🧹 正在将数据库转换为增量回收模式（一次性VACUUM）...")
+        await self._writer.execute("VACUUM")
+        self.incremental_vacuum_enabled = True
+        if has_tables:
+            print("✅ 数据库已启用 auto_vacuum=INCREMENTAL")
+
+    async def _load_compression_dicts(self, db: aiosqlite.Connection):
+        """载入全部 zstd 字典，最新的一个用于写入"""
+        cursor = await db.execute("SELECT id, data FROM chat_compression_dicts ORDER BY id")
+        rows = await cursor.fetchall()
+        for index, (dict_id, data) in enumerate(rows):
+            self.codec.load_dictionary(dict_id, data, use_for_writes=index == len(rows) - 1)
+
+    @property
+    def compression_enabled(self) -> bool:
+        return self.codec.enabled
+
+    async def ensure_compression_dictionary(self, sample_limit: int = 2000):
+        """使用 zstd 且还没有字典时，用已有的大文本训练一个字典"""
+        if self.codec.codec != "zstd" or self.codec.dictionary_id is not None:
+            return
+        samples: List[str] = []
+        async with self._read() as db:
+            for table, key, column in COMPRESSED_COLUMNS:
+                cursor = await db.execute(f"""
+                    SELECT {column} FROM {table}
+                    WHERE {column} IS NOT NULL AND length(CAST({column} AS BLOB)) >= ?
+                    ORDER BY {key} DESC LIMIT ?
+                """, (self.codec.min_bytes, sample_limit // 2))
+                samples.extend(self.codec.decode(row[0]) for row in await cursor.fetchall())
+        data = TextCodec.train_dictionary(samples)
+        if data is None:
+            return
+        async with self._write() as db:
+            cursor = await db.execute("INSERT INTO chat_compression_dicts (data) VALUES (?)", (data,))
+            await db.commit()
+            dict_id = cursor.lastrowid
+        self.codec.load_dictionary(dict_id, data)
+        print(f"🗜️ 已训练 zstd 压缩字典 (id={dict_id}, {len(samples)} 个样本, {len(data)} 字节)")
+
+    async def compress_batch(self, table: str, last_id: int, batch_size: int = 200) -> Optional[Tuple[int, int, int, int]]:
+        """压缩一批超过阈值的未压缩旧数据（单独提交）
+        
+        Returns:
+            (本批最后的主键, 压缩的行数, 原始字节数, 压缩后字节数)；没有剩余数据时返回 None
+        """
+        key, column = next((k, c) for t, k, c in COMPRESSED_COLUMNS if t == table)
+        async with self._read() as db:
+            cursor = await db.execute(f"""
+                SELECT {key}, {column} FROM {table}
+                WHERE {key} > ? AND typeof({column}) = 'text' AND length(CAST({column} AS BLOB)) >= ?
+                ORDER BY {key} LIMIT ?
+            """, (last_id, self.codec.min_bytes, batch_size))
+            rows = await cursor.fetchall()
+        if not rows:
+            return None
+
+        updates = []
+        raw_bytes = stored_bytes = 0
+        for row_id, text in rows:
+            value = self.codec.encode(text)
+            if isinstance(value, bytes):
+                updates.append((value, row_id))
+                raw_bytes += len(text.encode("utf-8"))
+                stored_bytes += len(value)
+        if updates:
+            async with self._write() as db:
+                await db.executemany(
+                    f"UPDATE {table} SET {column} = ? WHERE {key} = ? AND typeof({column}) = 'text'", updates
+                )
+                await db.commit()
+        return rows[-1][0], len(updates), raw_bytes, stored_bytes
+
+    async def get_compression_stats(self, scan: bool = False) -> Dict[str, Any]:
+        """压缩指标；scan=True 时扫描压缩列，统计已压缩/未压缩的行数与存储字节
+
+        saved_bytes 为压缩列原文与存储字节之差。全文索引不保存原文（见 SEARCH_SCHEMA），
+        数据库中没有这些文本的未压缩副本，因此它就是压缩对数据量的实际节省；
+        table_bytes 为各表（含索引、全文索引的内部表）实际占用的页字节数，SQLite 未启用 dbstat 时为 None
+        """
+        stats: Dict[str, Any] = {"codec": self.codec.stats()}
+        if not scan:
+            return stats
+        columns = {}
+        async with self._read() as db:
+            for table, key, column in COMPRESSED_COLUMNS:
+                cursor = await db.execute(f"""
+                    SELECT typeof({column}) = 'blob' AS compressed, COUNT(*),
+                           SUM(length(CAST({column} AS BLOB))),
+                           SUM(CASE WHEN typeof({column}) = 'blob' THEN stored_size({column}) ELSE length(CAST({column} AS BLOB)) END)
+                    FROM {table} WHERE {column} IS NOT NULL
+                    GROUP BY 1
+                """)
+                summary = {"compressed_rows": 0, "plain_rows": 0, "stored_bytes": 0, "raw_bytes": 0}
+                for compressed, count, stored, raw in await cursor.fetchall():
+                    summary["compressed_rows" if compressed else "plain_rows"] += count
+                    summary["stored_bytes"] += stored or 0
+                    summary["raw_bytes"] += raw or 0
+                summary["saved_bytes"] = summary["raw_bytes"] - summary["stored_bytes"]
+                columns[f"{table}.{column}"] = summary
+            stats["table_bytes"] = await self._table_bytes(db)
+        stats["columns"] = columns
+        stats["saved_bytes"] = sum(c["saved_bytes"] for c in columns.values())
+        return stats
+
+    async def _table_bytes(self, db: aiosqlite.Connection) -> Optional[Dict[str, int]]:
+        """按表汇总实际占用的页字节数（索引计入所属的表，FTS5 内部表计入 chat_search）"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # 确保session存在
+            cursor = await db.execute("""
+                SELECT COALESCE(m.tbl_name, d.name), SUM(d.pgsize)
+                FROM dbstat d LEFT JOIN sqlite_master m ON m.name = d.name
+                GROUP BY 1
+            """)
+            rows = await cursor.fetchall()
+        except aiosqlite.OperationalError:
+            return None
+        tables: Dict[str, int] = {}
+        for name, size in rows:
+            if name.startswith("chat_search_"):
+                name = "chat_search"
+            tables[name] = tables.get(name, 0) + (size or 0)
+        return dict(sorted(tables.items(), key=lambda item: -item[1]))
+
+    async def _init_search(self, db: aiosqlite.Connection):
+        """创建全文索引；首次创建时为已有记录建立索引（不提交）"""
+        cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_search'")
+        exists = await cursor.fetchone() is not None
+        try:
+            for statement in SEARCH_SCHEMA:
+                await db.execute(statement)
+        except Exception as e:
+            self.search_enabled = False
+            print(f"⚠️ 当前SQLite不支持FTS5，全文检索不可用: {e}")
+            return
+        self.search_enabled = True
+        if exists:
+            return
+
+        await db.execute("INSERT INTO chat_search (chat_search, rank) VALUES ('rank', ?)", (SEARCH_RANK,))
+        indexed = 0
+        last_id = 0
+        while True:
+            cursor = await db.execute("""
+                SELECT id, session_id, user_input, ai_response FROM chat_records WHERE id > ? ORDER BY id LIMIT 500
+            """, (last_id,))
+            batch = await cursor.fetchall()
+            if not batch:
+                break
+            for record_id, session_id, user_input, ai_response in batch:
+                results = await self._load_tool_results(db, record_id)
+                await self._index_record(db, record_id, session_id, user_input, self.codec.decode(ai_response), results)
+                last_id = record_id
+            indexed += len(batch)
+        if indexed:
+            print(f"🔎 已为 {indexed} 条历史记录建立全文索引")
+
+    async def _index_record(
+        self,
+        db: aiosqlite.Connection,
+        record_id: int,
+        session_id: str,
+        user_input: str,
+        ai_response: str,
+        tool_results: List[Any]
+    ):
+        """写入一条记录的全文索引（不提交）"""
+        if not self.search_enabled:
+            return
+        await db.execute("""
+            INSERT INTO chat_search (rowid, session_key, user_input, ai_response, tool_results) VALUES (?, ?, ?, ?, ?)
+        """, (record_id, *_search_values(session_id, user_input, ai_response, tool_results)))
+
+    async def _load_tool_results(self, db: aiosqlite.Connection, record_id: int) -> List[str]:
+        """一条记录的全部工具结果（已解压），按调用顺序"""
+        cursor = await db.execute("""
+            SELECT r.result FROM chat_tool_calls c JOIN chat_tool_results r ON r.call_id = c.id
+            WHERE c.record_id = ? ORDER BY c.position
+        """, (record_id,))
+        return [self.codec.decode(row[0]) for row in await cursor.fetchall()]
+
+    async def _unindex_records(self, db: aiosqlite.Connection, where: str, params: Tuple = ()):
+        """删除 chat_records 中满足条件的记录之前，从全文索引中移除它们（不提交）
+
+        无原文的索引需要提供写入时的文本才能删除，这里按相同方式从记录与工具结果重新生成
+        """
+        if not self.search_enabled:
+            return
+        last_id = 0
+        while True:
+            cursor = await db.execute(f"""
+                SELECT id, session_id, user_input, ai_response FROM chat_records
+                WHERE ({where}) AND id > ? ORDER BY id LIMIT 500
+            """, (*params, last_id))
+            batch = await cursor.fetchall()
+            if not batch:
+                break
+            for record_id, session_id, user_input, ai_response in batch:
+                results = await self._load_tool_results(db, record_id)
                 await db.execute("""
-                    INSERT OR IGNORE INTO chat_sessions (session_id) VALUES (?)
-                """, (session_id,))
-                
-                # 获取下一个conversation_id
-                cursor = await db.execute("""
-                    SELECT COALESCE(MAX(conversation_id), 0) + 1 
-                    FROM chat_records WHERE session_id = ?
-                """, (session_id,))
-                conversation_id = (await cursor.fetchone())[0]
-                
+                    INSERT INTO chat_search (chat_search, rowid, session_key, user_input, ai_response, tool_results)
+                    VALUES ('delete', ?, ?, ?, ?, ?)
+                """, (record_id, *_search_values(session_id, user_input, self.codec.decode(ai_response), results)))
+                last_id = record_id
+
+    async def _migrate_tool_payloads(self, db: aiosqlite.Connection, batch_size: int = 500):
+        """将旧记录中 JSON 格式的工具调用与结果拆分到工具表（不提交）"""
+        moved = 0
+        last_id = 0
+        while True:
+            cursor = await db.execute("""
+                SELECT id, session_id, mcp_tools_called, mcp_results, created_at FROM chat_records
+                WHERE id > ? AND (mcp_tools_called IS NOT NULL OR mcp_results IS NOT NULL)
+                ORDER BY id LIMIT ?
+            """, (last_id, batch_size))
+            batch = await cursor.fetchall()
+            if not batch:
+                break
+            for record_id, session_id, tools_json, results_json, created_at in batch:
+                try:
+                    calls = json.loads(tools_json or '[]')
+                    results = json.loads(results_json or '[]')
+                except json.JSONDecodeError:
+                    calls, results = [], []
+                await self._insert_tool_rows(db, record_id, session_id, tool_rows(calls, results), created_at)
+                last_id = record_id
+            await db.executemany(
+                "UPDATE chat_records SET mcp_tools_called = NULL, mcp_results = NULL WHERE id = ?",
+                [(row[0],) for row in batch]
+            )
+            moved += len(batch)
+        if moved:
+            print(f"🔧 已将 {moved} 条记录的工具调用迁移到 chat_tool_calls / chat_tool_results")
+
+    async def _insert_tool_rows(
+        self,
+        db: aiosqlite.Connection,
+        record_id: int,
+        session_id: str,
+        rows: List[Dict[str, Any]],
+        created_at: str = None
+    ):
+        """写入一条对话记录的工具调用与结果（不提交）"""
+        for position, row in enumerate(rows):
+            cursor = await db.execute("""
+                INSERT INTO chat_tool_calls (
+                    record_id, session_id, position, tool_id, tool_name, tool_args,
+                    progress, success, error, result_size, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            """, (
+                record_id, session_id, position, row["tool_id"], row["tool_name"],
+                json.dumps(row["tool_args"], ensure_ascii=False) if row["tool_args"] is not None else None,
+                row["progress"], None if row["success"] is None else int(row["success"]),
+                row["error"], row["result_size"], created_at
+            ))
+            if row["result"] is not None:
+                result = row["result"] if isinstance(row["result"], str) else json.dumps(row["result"], ensure_ascii=False)
+                await db.execute(
+                    "INSERT INTO chat_tool_results (call_id, result) VALUES (?, ?)",
+                    (cursor.lastrowid, self.codec.encode(result))
+                )
+
+    async def _next_conversation_id(self, db: aiosqlite.Connection, session_id: str) -> int:
+        """在给定连接上从会话计数器原子地分配下一个conversation_id（不提交）"""
+        await db.execute("""
+            INSERT INTO chat_sessions (session_id, last_conversation_id) VALUES (?, 1)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_conversation_id = last_conversation_id + 1,
+                updated_at = CURRENT_TIMESTAMP
+        """, (session_id,))
+        cursor = await db.execute("""
+            SELECT last_conversation_id FROM chat_sessions WHERE session_id = ?
+        """, (session_id,))
+        return (await cursor.fetchone())[0]
+
+    async def _touch_session(self, db: aiosqlite.Connection, session_id: str, conversation_id: int):
+        """使用调用方指定的conversation_id时，确保会话存在且计数器不落后（不提交）"""
+        await db.execute("""
+            INSERT INTO chat_sessions (session_id, last_conversation_id) VALUES (?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_conversation_id = MAX(last_conversation_id, excluded.last_conversation_id),
+                updated_at = CURRENT_TIMESTAMP
+        """, (session_id, conversation_id))
+
+    async def start_conversation(self, session_id: str = "default") -> int:
+        """开始新的对话，分配并返回conversation_id"""
+        try:
+            async with self._write() as db:
+                conversation_id = await self._next_conversation_id(db, session_id)
                 await db.commit()
                 return conversation_id
                 
@@ -115,6 +810,46 @@ class ChatDatabase:
             print(f"❌ 开始对话失败: {e}")
             return 1  # 默认返回1
     
+    async def _insert_record(
+        self,
+        db: aiosqlite.Connection,
+        user_input: str,
+        mcp_tools_called: List[Dict[str, Any]] = None,
+        mcp_results: List[Dict[str, Any]] = None,
+        ai_response: str = "",
+        session_id: str = "default",
+        conversation_id: int = None,
+        user_timestamp: str = None,
+        ai_timestamp: str = None
+    ) -> int:
+        """在给定连接上插入一条对话记录（不提交），返回conversation_id"""
+        # 与插入在同一连接、同一事务中完成
+        if conversation_id is None:
+            conversation_id = await self._next_conversation_id(db, session_id)
+        else:
+            await self._touch_session(db, session_id, conversation_id)
+        
+        now = datetime.now().isoformat()
+        
+        # 工具调用与结果写入独立的表，chat_records 中的 JSON 列不再使用
+        cursor = await db.execute("""
+            INSERT INTO chat_records (
+                session_id, conversation_id, 
+                user_input, user_timestamp,
+                ai_response, ai_timestamp
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            session_id, conversation_id,
+            user_input, user_timestamp or now,
+            self.codec.encode(ai_response), ai_timestamp or now
+        ))
+        record_id = cursor.lastrowid
+        rows = tool_rows(mcp_tools_called, mcp_results)
+        if rows:
+            await self._insert_tool_rows(db, record_id, session_id, rows)
+        await self._index_record(db, record_id, session_id, user_input, ai_response, [row["result"] for row in rows])
+        return conversation_id
+
     async def save_conversation(
         self, 
         user_input: str,
@@ -135,28 +870,16 @@ class ChatDatabase:
             conversation_id: 对话ID，如果为None则自动生成
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                if conversation_id is None:
-                    conversation_id = await self.start_conversation(session_id)
-                
-                # 将工具调用和结果转换为JSON
-                mcp_tools_json = json.dumps(mcp_tools_called or [], ensure_ascii=False)
-                mcp_results_json = json.dumps(mcp_results or [], ensure_ascii=False)
-                
-                await db.execute("""
-                    INSERT INTO chat_records (
-                        session_id, conversation_id, 
-                        user_input, user_timestamp,
-                        mcp_tools_called, mcp_results,
-                        ai_response, ai_timestamp
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    session_id, conversation_id,
-                    user_input, datetime.now().isoformat(),
-                    mcp_tools_json, mcp_results_json,
-                    ai_response, datetime.now().isoformat()
-                ))
-                
+            async with self._write() as db:
+                conversation_id = await self._insert_record(
+                    db,
+                    user_input=user_input,
+                    mcp_tools_called=mcp_tools_called,
+                    mcp_results=mcp_results,
+                    ai_response=ai_response,
+                    session_id=session_id,
+                    conversation_id=conversation_id
+                )
                 await db.commit()
                 print(f"💾 对话记录已保存 (session={session_id}, conversation={conversation_id})")
                 return True
@@ -164,12 +887,31 @@ class ChatDatabase:
         except Exception as e:
             print(f"❌ 保存对话记录失败: {e}")
             return False
+
+    async def save_conversations(self, records: List[Dict[str, Any]]) -> int:
+        """在同一个事务中批量保存对话记录（一次提交）
+        
+        Args:
+            records: 每项为 save_conversation 的关键字参数，可额外带 user_timestamp / ai_timestamp
+        
+        Returns:
+            写入的记录数；事务失败时抛出异常，调用方决定是否逐条重试
+        """
+        if not records:
+            return 0
+        async with self._write() as db:
+            for record in records:
+                await self._insert_record(db, **record)
+            await db.commit()
+        print(f"💾 已批量保存 {len(records)} 条对话记录")
+        return len(records)
     
     async def get_chat_history(
         self, 
         session_id: str = "default", 
         limit: int = 50,
-        conversation_id: int = None
+        conversation_id: int = None,
+        tools: str = TOOLS_FULL
     ) -> List[Dict[str, Any]]:
         """获取聊天历史记录
         
@@ -177,15 +919,16 @@ class ChatDatabase:
             session_id: 会话ID
             limit: 返回记录数量限制
             conversation_id: 特定对话ID，如果指定则只返回该对话
+            tools: 工具数据加载方式（full / calls / none），只需要问答文本时用 none
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read() as db:
                 if conversation_id is not None:
                     # 获取特定对话
                     cursor = await db.execute("""
                         SELECT * FROM chat_records 
                         WHERE session_id = ? AND conversation_id = ?
-                        ORDER BY created_at ASC
+                        ORDER BY created_at ASC, id ASC
                     """, (session_id, conversation_id))
                 else:
                     # 获取最近的对话记录
@@ -193,27 +936,15 @@ class ChatDatabase:
                         SELECT * FROM (
                             SELECT * FROM chat_records 
                             WHERE session_id = ?
-                            ORDER BY created_at DESC 
+                            ORDER BY created_at DESC, id DESC
                             LIMIT ?
-                        ) ORDER BY created_at ASC
+                        ) ORDER BY created_at ASC, id ASC
                     """, (session_id, limit))
                 
                 rows = await cursor.fetchall()
                 columns = [desc[0] for desc in cursor.description]
-                
-                records = []
-                for row in rows:
-                    record = dict(zip(columns, row))
-                    
-                    # 解析JSON字段
-                    try:
-                        record['mcp_tools_called'] = json.loads(record['mcp_tools_called'] or '[]')
-                        record['mcp_results'] = json.loads(record['mcp_results'] or '[]')
-                    except json.JSONDecodeError:
-                        record['mcp_tools_called'] = []
-                        record['mcp_results'] = []
-                    
-                    records.append(record)
+                records = [self._row_to_record(columns, row) for row in rows]
+                await self._attach_tools(db, records, tools)
                 
                 # 如果不是特定对话，需要反转顺序（最新的在前面）
                 if conversation_id is None:
@@ -225,10 +956,324 @@ class ChatDatabase:
             print(f"❌ 获取聊天历史失败: {e}")
             return []
     
+    def _row_to_record(self, columns: List[str], row: tuple) -> Dict[str, Any]:
+        """将查询行转换为记录字典（工具数据由 _attach_tools 填充）"""
+        record = dict(zip(columns, row))
+        record.pop('mcp_tools_called', None)
+        record.pop('mcp_results', None)
+        if 'ai_response' in record:
+            record['ai_response'] = self.codec.decode(record['ai_response'])
+        return record
+
+    def _call_to_dicts(self, row: Dict[str, Any], with_result: bool) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """将 chat_tool_calls 行还原为 mcp_tools_called / mcp_results 中的条目"""
+        call = None
+        if row["tool_args"] is not None:
+            try:
+                tool_args = json.loads(row["tool_args"])
+            except json.JSONDecodeError:
+                tool_args = {}
+            call = {
+                "tool_id": row["tool_id"],
+                "tool_name": row["tool_name"],
+                "tool_args": tool_args,
+                "progress": row["progress"]
+            }
+        result = None
+        if row["success"] == 0:
+            result = {"tool_id": row["tool_id"], "tool_name": row["tool_name"], "error": row["error"], "success": False}
+        elif row["success"] == 1:
+            result = {"tool_id": row["tool_id"], "tool_name": row["tool_name"], "result_size": row["result_size"], "success": True}
+            if with_result:
+                result["result"] = self.codec.decode(row.get("result"))
+        return call, result
+
+    async def _attach_tools(self, db: aiosqlite.Connection, records: List[Dict[str, Any]], tools: str = TOOLS_FULL):
+        """为记录批量加载工具调用（一次按 record_id 索引查询）"""
+        if tools == TOOLS_NONE or not records:
+            return
+        with_result = tools == TOOLS_FULL
+        by_id = {}
+        for record in records:
+            record['mcp_tools_called'] = []
+            record['mcp_results'] = []
+            by_id[record['id']] = record
+        ids = list(by_id)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            result_column = "r.result" if with_result else "NULL"
+            cursor = await db.execute(f"""
+                SELECT c.record_id, c.tool_id, c.tool_name, c.tool_args, c.progress,
+                       c.success, c.error, c.result_size, {result_column} AS result
+                FROM chat_tool_calls c
+                {"LEFT JOIN chat_tool_results r ON r.call_id = c.id" if with_result else ""}
+                WHERE c.record_id IN ({placeholders})
+                ORDER BY c.record_id, c.position
+            """, chunk)
+            columns = [desc[0] for desc in cursor.description]
+            for values in await cursor.fetchall():
+                row = dict(zip(columns, values))
+                call, result = self._call_to_dicts(row, with_result)
+                record = by_id[row["record_id"]]
+                if call is not None:
+                    record['mcp_tools_called'].append(call)
+                if result is not None:
+                    record['mcp_results'].append(result)
+
+    async def get_tool_calls(self, record_id: int) -> List[Dict[str, Any]]:
+        """按需读取单条记录的工具调用及完整结果"""
+        try:
+            async with self._read() as db:
+                cursor = await db.execute("""
+                    SELECT c.id, c.tool_id, c.tool_name, c.tool_args, c.progress,
+                           c.success, c.error, c.result_size, r.result, c.created_at
+                    FROM chat_tool_calls c
+                    LEFT JOIN chat_tool_results r ON r.call_id = c.id
+                    WHERE c.record_id = ?
+                    ORDER BY c.position
+                """, (record_id,))
+                columns = [desc[0] for desc in cursor.description]
+                calls = []
+                for values in await cursor.fetchall():
+                    row = dict(zip(columns, values))
+                    row["result"] = self.codec.decode(row["result"])
+                    try:
+                        row["tool_args"] = json.loads(row["tool_args"]) if row["tool_args"] is not None else None
+                    except json.JSONDecodeError:
+                        pass
+                    row["success"] = None if row["success"] is None else bool(row["success"])
+                    calls.append(row)
+                return calls
+        except Exception as e:
+            print(f"❌ 获取工具调用失败: {e}")
+            return []
+
+    async def get_tool_usage(self, days: int = 7, tool_name: str = None) -> List[Dict[str, Any]]:
+        """按天、按工具统计调用次数与失败次数（走 created_at 覆盖索引）"""
+        conditions = ["created_at >= datetime('now', ?)"]
+        params: List[Any] = [f"-{max(1, days)} days"]
+        if tool_name:
+            conditions.append("tool_name = ?")
+            params.append(tool_name)
+        try:
+            async with self._read() as db:
+                cursor = await db.execute(f"""
+                    SELECT date(created_at) AS day, tool_name,
+                           COUNT(*) AS calls,
+                           SUM(success = 0) AS failures,
+                           SUM(success IS NULL) AS unfinished,
+                           CAST(AVG(result_size) AS INTEGER) AS avg_result_size
+                    FROM chat_tool_calls
+                    WHERE {' AND '.join(conditions)}
+                    GROUP BY day, tool_name
+                    ORDER BY day DESC, calls DESC
+                """, params)
+                columns = [desc[0] for desc in cursor.description]
+                return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+        except Exception as e:
+            print(f"❌ 获取工具统计失败: {e}")
+            return []
+
+    async def _query_keyset(
+        self,
+        session_id: str,
+        limit: int,
+        before: Optional[Tuple[str, int]] = None,
+        after: Optional[Tuple[str, int]] = None,
+        ascending: bool = True,
+        tools: str = TOOLS_FULL
+    ) -> List[Dict[str, Any]]:
+        """按 (created_at, id) 键集查询一批记录，返回值按查询方向排列"""
+        conditions = ["session_id = ?"]
+        params: List[Any] = [session_id]
+        if after is not None:
+            conditions.append("(created_at, id) > (?, ?)")
+            params.extend(after)
+        if before is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend(before)
+        order = "ASC" if ascending else "DESC"
+        params.append(limit)
+        async with self._read() as db:
+            cursor = await db.execute(f"""
+                SELECT * FROM chat_records
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at {order}, id {order}
+                LIMIT ?
+            """, params)
+            rows = await cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+            records = [self._row_to_record(columns, row) for row in rows]
+            await self._attach_tools(db, records, tools)
+        return records
+
+    async def get_history_page(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        tools: str = TOOLS_FULL
+    ) -> Dict[str, Any]:
+        """基于游标的分页读取（按时间正序返回）
+        
+        Args:
+            session_id: 会话ID
+            limit: 每页记录数
+            before: 返回该游标之前（更早）的最近 limit 条；未指定 after 时的默认方向
+            after: 返回该游标之后（更新）的最早 limit 条
+            tools: 工具数据加载方式（full / calls / none）
+        
+        Returns:
+            {"records": [...], "before": 更早一页的游标, "after": 更新一页的游标, "has_more": 翻页方向上是否还有记录}
+        
+        Raises:
+            ValueError: 游标格式错误
+        """
+        before_key = decode_cursor(before) if before else None
+        after_key = decode_cursor(after) if after else None
+        forward = after_key is not None
+        # 多取一条判断翻页方向上是否还有记录
+        rows = await self._query_keyset(session_id, limit + 1, before_key, after_key, ascending=forward, tools=tools)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not forward:
+            rows.reverse()
+        return {
+            "records": rows,
+            "before": encode_cursor(rows[0]) if rows else before,
+            "after": encode_cursor(rows[-1]) if rows else after,
+            "has_more": has_more
+        }
+
+    async def iter_history(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        batch_size: int = 100,
+        tools: str = TOOLS_FULL
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """与 get_history_page 相同的范围，按时间正序分批产出记录
+        
+        每批单独借用读连接，慢速消费者不会长时间占用连接池。
+        
+        Raises:
+            ValueError: 游标格式错误
+        """
+        before_key = decode_cursor(before) if before else None
+        start_key = decode_cursor(after) if after else None
+        if start_key is None:
+            # 默认方向取最近的 limit 条：先沿索引找到这一页之前的边界，再从边界开始正序读取
+            async with self._read() as db:
+                conditions = "session_id = ?" + (" AND (created_at, id) < (?, ?)" if before_key else "")
+                params = [session_id] + (list(before_key) if before_key else []) + [limit]
+                cursor = await db.execute(f"""
+                    SELECT created_at, id FROM chat_records
+                    WHERE {conditions}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 1 OFFSET ?
+                """, params)
+                boundary = await cursor.fetchone()
+            start_key = (boundary[0], boundary[1]) if boundary else None
+
+        remaining = limit
+        while remaining > 0:
+            batch = await self._query_keyset(session_id, min(batch_size, remaining), before_key, start_key, ascending=True, tools=tools)
+            for record in batch:
+                yield record
+            if len(batch) < min(batch_size, remaining):
+                break
+            remaining -= len(batch)
+            start_key = (batch[-1]['created_at'], batch[-1]['id'])
+
+    async def search(
+        self,
+        query: str,
+        session_id: str = None,
+        limit: int = 20,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """全文检索用户问题、AI回复与工具结果，按相关度排序
+        
+        Args:
+            query: 关键词，多个关键词以空白分隔，需全部命中
+            session_id: 只在该会话中检索
+            limit: 每页结果数
+            offset: 跳过的结果数
+        
+        Returns:
+            {"results": [...], "has_more": bool}；snippet 中命中部分以 <mark> 标记
+        
+        Raises:
+            ValueError: 关键词为空
+            RuntimeError: 全文检索不可用
+        """
+        if not self.search_enabled:
+            raise RuntimeError("全文检索不可用（SQLite未启用FTS5）")
+        match = build_match_query(query or "", session_id)
+        if match is None:
+            raise ValueError("搜索关键词不能为空")
+
+        pattern = snippet_pattern(query)
+        results = []
+        async with self._read() as db:
+            # 先在索引内排序分页，再只为这一页读取原文生成摘要
+            cursor = await db.execute("""
+                SELECT r.id AS record_id, r.session_id, r.conversation_id, r.created_at,
+                       r.user_input, r.ai_response, s.rank AS score
+                FROM (
+                    SELECT rowid, rank
+                    FROM chat_search
+                    WHERE chat_search MATCH ?
+                    ORDER BY rank
+                    LIMIT ? OFFSET ?
+                ) s
+                JOIN chat_records r ON r.id = s.rowid
+                ORDER BY s.rank
+            """, (match, limit + 1, max(0, offset)))
+            columns = [desc[0] for desc in cursor.description]
+            rows = await cursor.fetchall()
+
+            for row in rows[:limit]:
+                result = dict(zip(columns, row))
+                user_input = result["user_input"] or ""
+                ai_response = result.pop("ai_response")
+                # 取第一个包含命中词的列；工具结果只在前两列都未命中时读取
+                matched_in, snippet = "user_input", build_snippet(user_input, pattern)
+                if snippet is None:
+                    matched_in, snippet = "ai_response", build_snippet(self.codec.decode(ai_response), pattern)
+                if snippet is None:
+                    tool_results = await self._load_tool_results(db, result["record_id"])
+                    results_text = "\n".join(text for text in tool_results if text is not None)
+                    matched_in, snippet = "tool_results", build_snippet(results_text, pattern)
+                if snippet is None:
+                    matched_in, snippet = "user_input", leading_snippet(user_input)
+                result.update(
+                    user_input=user_input[:200], matched_in=matched_in, snippet=snippet,
+                    score=round(-result["score"], 6)
+                )
+                results.append(result)
+        return {"results": results, "has_more": len(rows) > limit}
+
+    async def get_session_counts(self, session_id: str) -> Dict[str, int]:
+        """从统计计数表读取会话的记录数与对话数"""
+        async with self._read() as db:
+            cursor = await db.execute("""
+                SELECT
+                    COALESCE((SELECT record_count FROM chat_session_counts WHERE session_id = ?), 0),
+                    (SELECT COUNT(*) FROM chat_conversation_counts WHERE session_id = ?)
+            """, (session_id, session_id))
+            records, conversations = await cursor.fetchone()
+        return {"records": records, "conversations": conversations}
+
     async def clear_history(self, session_id: str = "default") -> bool:
-        """清空指定会话的聊天历史"""
+        """清空指定会话的聊天历史（包括已归档的记录索引）"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._write() as db:
+                await self._unindex_records(db, "session_id = ?", (session_id,))
                 await db.execute("""
                     DELETE FROM chat_records WHERE session_id = ?
                 """, (session_id,))
@@ -236,6 +1281,10 @@ class ChatDatabase:
                 await db.execute("""
                     DELETE FROM chat_sessions WHERE session_id = ?
                 """, (session_id,))
+
+                await db.execute("""
+                    DELETE FROM chat_archive WHERE session_id = ?
+                """, (session_id,))
                 
                 await db.commit()
                 print(f"🗑️ 已清空会话 {session_id} 的聊天历史")
@@ -245,31 +1294,207 @@ class ChatDatabase:
             print(f"❌ 清空聊天历史失败: {e}")
             return False
     
-    async def get_stats(self) -> Dict[str, Any]:
-        """获取数据库统计信息"""
+    async def clear_all_history(self) -> bool:
+        """清空所有会话的聊天历史"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # 总记录数
-                cursor = await db.execute("SELECT COUNT(*) FROM chat_records")
-                total_records = (await cursor.fetchone())[0]
-                
-                # 会话数
-                cursor = await db.execute("SELECT COUNT(DISTINCT session_id) FROM chat_records")
-                total_sessions = (await cursor.fetchone())[0]
-                
-                # 对话数
-                cursor = await db.execute("SELECT COUNT(DISTINCT conversation_id) FROM chat_records")
-                total_conversations = (await cursor.fetchone())[0]
-                
-                # 最近记录时间
-                cursor = await db.execute("SELECT MAX(created_at) FROM chat_records")
-                latest_record = (await cursor.fetchone())[0]
+            async with self._write() as db:
+                if self.search_enabled:
+                    await db.execute("INSERT INTO chat_search (chat_search) VALUES ('delete-all')")
+                await db.execute("DELETE FROM chat_records")
+                await db.execute("DELETE FROM chat_sessions")
+                await db.execute("DELETE FROM chat_archive")
+                await db.commit()
+                print("🗑️ 已清空所有聊天历史")
+                return True
+        except Exception as e:
+            print(f"❌ 清空所有聊天历史失败: {e}")
+            return False
+
+    # ─────────── 保留策略与归档 ───────────
+
+    async def get_expired_sessions(
+        self,
+        max_age_days: float = 0,
+        max_sessions: int = 0,
+        min_idle_hours: float = 0,
+        limit: int = 50
+    ) -> List[str]:
+        """按保留策略挑选需要归档的会话（最久未活跃的优先）
+        
+        Args:
+            max_age_days: 超过该天数未活跃的会话过期，0 表示不限制
+            max_sessions: 只保留最近活跃的这么多个会话，0 表示不限制
+            min_idle_hours: 最近这段时间内活跃过的会话不归档
+            limit: 最多返回的会话数
+        """
+        idle_cutoff = f"-{max(0.0, min_idle_hours) * 3600:.0f} seconds"
+        expired: List[str] = []
+        async with self._read() as db:
+            if max_age_days > 0:
+                cursor = await db.execute(f"""
+                    SELECT session_id FROM chat_sessions s
+                    WHERE updated_at < datetime('now', ?) AND updated_at < datetime('now', ?)
+                    AND {_HAS_RECORDS}
+                    ORDER BY updated_at LIMIT ?
+                """, (f"-{max_age_days * 86400:.0f} seconds", idle_cutoff, limit))
+                expired.extend(row[0] for row in await cursor.fetchall())
+            if max_sessions > 0 and len(expired) < limit:
+                cursor = await db.execute(f"""
+                    SELECT session_id FROM (
+                        SELECT session_id, updated_at FROM chat_sessions s
+                        WHERE {_HAS_RECORDS}
+                        ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                    )
+                    WHERE updated_at < datetime('now', ?)
+                    ORDER BY updated_at LIMIT ?
+                """, (max_sessions, idle_cutoff, limit))
+                expired.extend(row[0] for row in await cursor.fetchall() if row[0] not in expired)
+        return expired[:limit]
+
+    async def get_session_activity(self, min_idle_hours: float = 0, limit: int = 20) -> List[Tuple[str, str]]:
+        """最久未活跃且仍有记录的会话及其最近活跃时间，最早的在前"""
+        async with self._read() as db:
+            cursor = await db.execute(f"""
+                SELECT session_id, updated_at FROM chat_sessions s
+                WHERE updated_at < datetime('now', ?) AND {_HAS_RECORDS}
+                ORDER BY updated_at LIMIT ?
+            """, (f"-{max(0.0, min_idle_hours) * 3600:.0f} seconds", limit))
+            return [(row[0], row[1]) for row in await cursor.fetchall()]
+
+    async def get_storage_info(self) -> Dict[str, int]:
+        """数据库页使用情况（字节）"""
+        async with self._read() as db:
+            values = []
+            for pragma in ("page_size", "page_count", "freelist_count"):
+                cursor = await db.execute(f"PRAGMA {pragma}")
+                values.append((await cursor.fetchone())[0])
+        page_size, page_count, freelist_count = values
+        return {
+            "page_size": page_size,
+            "file_bytes": page_size * page_count,
+            "used_bytes": page_size * (page_count - freelist_count),
+            "free_bytes": page_size * freelist_count,
+            "freelist_pages": freelist_count
+        }
+
+    async def export_session(self, session_id: str) -> List[Dict[str, Any]]:
+        """读取会话的全部记录（含工具调用与结果），按时间正序"""
+        counts = await self.get_session_counts(session_id)
+        if counts["records"] == 0:
+            return []
+        return [record async for record in self.iter_history(session_id, limit=counts["records"] + 1000, tools=TOOLS_FULL)]
+
+    async def archive_session(self, session_id: str, entry: Dict[str, Any], max_record_id: int) -> int:
+        """登记归档位置并删除已归档的记录（同一事务）
+        
+        只删除 id 不超过 max_record_id 的记录，导出之后新写入的记录保留在数据库中；
+        会话行保留，以免会话恢复使用后 conversation_id 从头分配
+        
+        Returns:
+            删除的记录数
+        """
+        async with self._write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO chat_archive (
+                    session_id, archive_file, offset, length, record_count, first_record, last_record
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (
+                session_id, entry["archive_file"], entry["offset"], entry["length"],
+                entry["record_count"], entry.get("first_record"), entry.get("last_record")
+            ))
+            await self._unindex_records(db, "session_id = ? AND id <= ?", (session_id, max_record_id))
+            cursor = await db.execute(
+                "DELETE FROM chat_records WHERE session_id = ? AND id <= ?", (session_id, max_record_id)
+            )
+            deleted = cursor.rowcount
+            await db.commit()
+            return deleted
+
+    async def get_archive_entry(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """查询会话的归档位置"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT * FROM chat_archive WHERE session_id = ?", (session_id,))
+            row = await cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([desc[0] for desc in cursor.description], row))
+
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        """回收一批空闲页，每批单独持有写锁，返回回收的页数
+        
+        未启用增量回收的数据库不做任何事，空闲页留给后续写入复用
+        """
+        if not self.incremental_vacuum_enabled:
+            return 0
+        async with self._write() as db:
+            cursor = await db.execute("PRAGMA freelist_count")
+            before = (await cursor.fetchone())[0]
+            if before == 0:
+                return 0
+            # execute() 只单步执行一次（只回收一页），executescript 会执行到结束
+            await db.executescript(f"PRAGMA incremental_vacuum({max(1, int(pages))})")
+            cursor = await db.execute("PRAGMA freelist_count")
+            after = (await cursor.fetchone())[0]
+            return before - after
+
+    async def _recount_stats(self, db: aiosqlite.Connection):
+        """全表扫描重建统计计数（不提交）"""
+        await db.execute("DELETE FROM chat_session_counts")
+        await db.execute("""
+            INSERT INTO chat_session_counts (session_id, record_count)
+            SELECT session_id, COUNT(*) FROM chat_records GROUP BY session_id
+        """)
+        await db.execute("DELETE FROM chat_conversation_counts")
+        await db.execute("""
+            INSERT INTO chat_conversation_counts (session_id, conversation_id, record_count)
+            SELECT session_id, COALESCE(conversation_id, 0), COUNT(*) FROM chat_records
+            GROUP BY session_id, COALESCE(conversation_id, 0)
+        """)
+        await db.execute("""
+            INSERT OR REPLACE INTO chat_stats (id, total_records, total_sessions, total_conversations, latest_record)
+            VALUES (
+                1,
+                (SELECT COUNT(*) FROM chat_records),
+                (SELECT COUNT(*) FROM chat_session_counts),
+                (SELECT COUNT(*) FROM chat_conversation_counts),
+                (SELECT MAX(created_at) FROM chat_records)
+            )
+        """)
+
+    async def recount_stats(self) -> bool:
+        """按需全量重新统计，用于校正计数"""
+        try:
+            async with self._write() as db:
+                await self._recount_stats(db)
+                await db.commit()
+                print("📊 数据库统计已重新计算")
+                return True
+        except Exception as e:
+            print(f"❌ 重新统计失败: {e}")
+            return False
+
+    async def get_stats(self, recount: bool = False) -> Dict[str, Any]:
+        """获取数据库统计信息
+        
+        Args:
+            recount: 为True时先全表重新统计，否则直接读取增量维护的计数
+        """
+        if recount:
+            await self.recount_stats()
+        try:
+            async with self._read() as db:
+                cursor = await db.execute("""
+                    SELECT total_records, total_sessions, total_conversations, latest_record
+                    FROM chat_stats WHERE id = 1
+                """)
+                row = await cursor.fetchone() or (0, 0, 0, None)
                 
                 return {
-                    "total_records": total_records,
-                    "total_sessions": total_sessions,
-                    "total_conversations": total_conversations,
-                    "latest_record": latest_record,
+                    "total_records": row[0],
+                    "total_sessions": row[1],
+                    # 按 (会话, 对话) 计数
+                    "total_conversations": row[2],
+                    "latest_record": row[3],
                     "database_path": self.db_path
                 }
                 
@@ -278,5 +1503,15 @@ class ChatDatabase:
             return {}
     
     async def close(self):
-        """关闭数据库连接（在aiosqlite中不需要显式关闭）"""
-        pass
\ No newline at end of file
+        """关闭连接池中的所有连接"""
+        connections = ([self._writer] if self._writer else []) + self._readers
+        self._writer = None
+        self._readers = []
+        self._reader_pool = None
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                print(f"⚠️ 关闭数据库连接失败: {e}")
+        if connections:
+            print("🔒 数据库连接已关闭")
@@ -0,0 +1,20 @@
+# env.py
+"""
+从环境变量读取数值配置：未设置或格式错误时使用默认值
+"""
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
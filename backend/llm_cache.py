@@ -0,0 +1,85 @@
+# llm_cache.py
+"""
+大模型响应的精确匹配缓存
+以 消息列表 + 模型名 + 温度 + 已绑定工具集 的稳定哈希为键，缓存单轮推理的完整结果（文本与工具调用）
+"""
+
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+
+def make_llm_cache_key(messages: List[Dict[str, Any]], model_name: str, temperature: float, tools_signature: str) -> str:
+    """生成稳定的缓存键"""
+    payload = json.dumps(
+        {
+            "messages": messages,
+            "model": model_name,
+            "temperature": temperature,
+            "tools": tools_signature
+        },
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """带TTL、条数上限与总字节上限的LRU缓存"""
+
+    def __init__(self, ttl: float, max_entries: int = 500, max_bytes: int = 50 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self._data: "OrderedDict[str, Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _evict(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self._total_bytes -= size
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存的单轮结果 {"content": str, "tool_calls": list}"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._evict(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key: str, content: str, tool_calls: List[Dict[str, Any]]):
+        value = {"content": content, "tool_calls": tool_calls}
+        size = len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._evict(key)
+        self._data[key] = (time.monotonic() + self.ttl, size, value)
+        self._total_bytes += size
+        while len(self._data) > self.max_entries or self._total_bytes > self.max_bytes:
+            self._evict(next(iter(self._data)))
+
+    def clear(self):
+        self._data.clear()
+        self._total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._data),
+            "bytes": self._total_bytes
+        }
@@ -4,43 +4,70 @@ FastAPI 后端主文件
 提供WebSocket聊天接口和REST API
 """
 
-import json
 import asyncio
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Union
 from datetime import datetime
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 import os
 from dotenv import load_dotenv, find_dotenv
 import uvicorn
 
 from mcp_agent import WebMCPAgent
-from database import ChatDatabase
+from database import ChatDatabase, encode_cursor, decode_cursor, TOOL_LOAD_MODES, TOOLS_FULL, TOOLS_NONE
+from sharded_database import ShardedChatDatabase
+from write_queue import ConversationWriteQueue
+from retention import RetentionManager, page_records
+from compression import CompressionMigration
+from tool_results import stored_result
+from outbound import OutboundQueue
+from serializers import negotiate, dumps_line, serializer_info, FastJSONResponse, MessageDecodeError
+from sessions import ChatSession, RESUME_TTL, CLOSE_SESSION_REPLACED, valid_session_id
+from turns import TurnRunner, TURN_POLICY_REJECT, TURN_QUEUED, TURN_REJECTED
+from env import env_int
 
 # 全局变量
 mcp_agent = None
-chat_db = None  # SQLite数据库实例
+chat_db = None  # 聊天记录存储（ChatStorage：单文件或按会话分片）
+write_queue = None  # 对话记录写回队列
+retention = None  # 保留策略与归档
+compression_migration = None  # 旧数据的后台压缩
 active_connections: List[WebSocket] = []
 
+# 每轮对话加载的历史记录候选条数
+HISTORY_MAX_RECORDS = env_int("HISTORY_MAX_RECORDS", 30)
+
+# 聊天记录分片数，大于1时按会话分散到多个SQLite文件
+CHAT_DB_SHARDS = env_int("CHAT_DB_SHARDS", 1)
+
+# 分页接口单页最多返回的记录数（NDJSON流式输出不受此限制）
+HISTORY_PAGE_MAX = env_int("HISTORY_PAGE_MAX", 1000)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    global mcp_agent, chat_db
+    global mcp_agent, chat_db, write_queue, retention, compression_migration
     
     # 启动时初始化
     print("🚀 启动 MCP Web 智能助手...")
     
     # 初始化数据库
-    chat_db = ChatDatabase()
+    chat_db = ShardedChatDatabase(CHAT_DB_SHARDS) if CHAT_DB_SHARDS > 1 else ChatDatabase()
     db_success = await chat_db.initialize()
     if not db_success:
         print("❌ 数据库初始化失败")
         raise Exception("数据库初始化失败")
+    write_queue = ConversationWriteQueue(chat_db)
+    write_queue.start()
+    retention = RetentionManager(chat_db)
+    retention.start()
+    compression_migration = CompressionMigration(chat_db)
+    compression_migration.start()
     
     # 初始化MCP智能体
     mcp_agent = WebMCPAgent()
@@ -54,9 +81,17 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    # 关闭时清理资源
+    # 关闭时清理资源：先结束进行中的对话，已生成的部分进入写回队列
+    await manager.close()
     if mcp_agent:
         await mcp_agent.close()
+    if retention:
+        await retention.close()
+    if compression_migration:
+        await compression_migration.close()
+    # 先提交队列中尚未落库的对话记录
+    if write_queue:
+        await write_queue.close()
     if chat_db:
         await chat_db.close()
     print("👋 MCP Web 智能助手已关闭")
@@ -72,7 +107,8 @@ app = FastAPI(
     title="MCP Web智能助手",
     description="基于MCP的智能助手Web版",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # 配置CORS
@@ -94,42 +130,351 @@ class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
         self.connection_sessions: Dict[WebSocket, str] = {}  # 连接到会话ID的映射
+        self.outbound: Dict[WebSocket, OutboundQueue] = {}  # 每个连接的发送队列
+        self.sessions: Dict[str, ChatSession] = {}  # 会话的运行状态，断开后保留 WS_RESUME_TTL 秒以便恢复
     
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        # 为每个连接生成唯一的会话ID
-        session_id = str(uuid.uuid4())
+        # 按客户端请求的子协议选择编码：msgpack（二进制帧）或 JSON（默认，orjson）
+        serializer, subprotocol = negotiate(websocket.scope.get("subprotocols"))
+        await websocket.accept(subprotocol=subprotocol)
+        queue = OutboundQueue(websocket, serializer=serializer)
+        # 客户端可在连接URL中协商流式片段的合并窗口，如 /ws/chat?batch_ms=30
+        try:
+            batch = queue.configure(websocket.query_params.get("batch_ms"), websocket.query_params.get("batch_chars"))
+        except (TypeError, ValueError):
+            batch = queue.configure()
+        queue.start()
         self.active_connections.append(websocket)
+        self.outbound[websocket] = queue
+
+        # 重连时带上 session_id、resume_token 与最后收到的序号 last_seq 即可恢复会话；
+        # 会话不存在（已过期或服务重启）或令牌不符时建立新会话，不使用客户端提供的ID
+        requested = websocket.query_params.get("session_id")
+        try:
+            last_seq = max(0, int(websocket.query_params.get("last_seq", "0")))
+        except ValueError:
+            last_seq = 0
+        session = self.sessions.get(requested) if valid_session_id(requested) else None
+        resumed = session is not None and session.check_token(websocket.query_params.get("resume_token"))
+
+        if resumed:
+            if session.websocket is not None:
+                # 同一会话的旧连接尚未被发现断开，由新连接接替
+                await self._release(session.websocket, "会话已在新的连接中恢复")
+        else:
+            if requested:
+                print(f"⚠️ 无法恢复会话 {requested[:64]}（已过期或令牌无效），建立新会话")
+            session = ChatSession(str(uuid.uuid4()))
+            session.turns = TurnRunner(lambda user_input: run_chat_turn(session, user_input))
+            self.sessions[session.session_id] = session
+        session_id = session.session_id
         self.connection_sessions[websocket] = session_id
-        print(f"📱 新连接建立，会话ID: {session_id}，当前连接数: {len(self.active_connections)}")
-        
-        # 向前端发送会话ID
+
+        # 断线期间的事件：缓冲中仍完整保留时补发，否则（会话无法恢复或缓冲已被覆盖）告知客户端存在缺口
+        if not resumed:
+            missed = None if requested else []
+        elif not last_seq:
+            missed = []
+        elif last_seq > session.replay.last_seq:
+            missed = None
+        else:
+            missed = session.replay.since(last_seq)
         await self.send_personal_message({
             "type": "session_info",
-            "session_id": session_id
+            "session_id": session_id,
+            "resume_token": session.resume_token,
+            "batch": batch,
+            "encoding": serializer.name,
+            "resumed": resumed,
+            "last_seq": session.replay.last_seq,
+            "replayed": len(missed) if missed else 0,
+            "replay_gap": missed is None
         }, websocket)
+        # 补发过程中可能产生新事件，反复追赶直到没有遗漏，再绑定连接（两步之间没有 await，不会漏发）
+        seq = last_seq if missed else session.replay.last_seq
+        while missed:
+            for event in missed:
+                if not await queue.put(event):
+                    break
+                seq = event["seq"]
+            missed = session.replay.since(seq) or []
+        session.attach(websocket)
+        if resumed:
+            session.resumed += 1
+        print(f"📱 {'会话已恢复' if resumed else '新连接建立'}，会话ID: {session_id}，当前连接数: {len(self.active_connections)}")
         
         return session_id
     
-    def disconnect(self, websocket: WebSocket):
+    async def _release(self, websocket: WebSocket, reason: str):
+        """关闭被新连接接替的旧连接"""
+        self.connection_sessions.pop(websocket, None)
+        queue = self.outbound.pop(websocket, None)
+        if queue:
+            await queue.abort(reason, CLOSE_SESSION_REPLACED)
+            await queue.close()
+
+    async def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
-        if websocket in self.connection_sessions:
-            session_id = self.connection_sessions[websocket]
-            del self.connection_sessions[websocket]
+        queue = self.outbound.pop(websocket, None)
+        if queue:
+            await queue.close()
+        session_id = self.connection_sessions.pop(websocket, None)
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None and session.websocket is websocket:
+            session.detach()
+            # 会话保留一段时间等待重连，进行中的对话继续执行，事件进入重放缓冲
+            session.expiry = asyncio.create_task(self._expire(session, RESUME_TTL))
+        if session_id:
             print(f"📱 连接断开，会话ID: {session_id}，当前连接数: {len(self.active_connections)}")
+
+    async def _expire(self, session: ChatSession, ttl: float):
+        """到期仍未恢复的会话：取消进行中的对话（保存已生成的部分）并释放"""
+        try:
+            await asyncio.sleep(ttl)
+        except asyncio.CancelledError:
+            return
+        if session.attached or self.sessions.get(session.session_id) is not session:
+            return
+        session.expiry = None
+        del self.sessions[session.session_id]
+        await session.turns.close()
     
+    async def close(self):
+        """服务关闭时取消全部会话中进行的对话（保存已生成的部分）"""
+        for session in self.sessions.values():
+            if session.expiry is not None:
+                session.expiry.cancel()
+        await asyncio.gather(*(session.turns.close() for session in self.sessions.values()))
+
+    async def receive(self, websocket: WebSocket) -> Union[str, bytes]:
+        """接收一帧客户端消息（文本或二进制），连接断开时抛出 WebSocketDisconnect"""
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        return message["bytes"] if message.get("bytes") is not None else message.get("text", "")
+
+    def decode(self, websocket: WebSocket, data: Union[str, bytes]) -> Any:
+        """按连接协商的编码解码客户端消息"""
+        queue = self.outbound.get(websocket)
+        if queue is None:
+            raise MessageDecodeError("连接已关闭")
+        return queue.serializer.loads(data)
+
+    def get_session(self, websocket: WebSocket) -> Optional[ChatSession]:
+        """获取WebSocket连接对应的会话"""
+        return self.sessions.get(self.connection_sessions.get(websocket))
+
     def get_session_id(self, websocket: WebSocket) -> str:
         """获取WebSocket连接对应的会话ID"""
         return self.connection_sessions.get(websocket, "default")
     
-    async def send_personal_message(self, message: dict, websocket: WebSocket):
+    async def send_personal_message(self, message: dict, websocket: WebSocket) -> bool:
+        """放入连接的发送队列（不编号、不重放）；连接已断开（包括因接收过慢被断开）时返回 False"""
+        queue = self.outbound.get(websocket)
+        if queue is None:
+            return False
+        return await queue.put(message)
+
+    async def send_event(self, session: ChatSession, message: dict) -> bool:
+        """会话事件：编号并放入重放缓冲，会话当前有连接时同时发送；会话已结束时返回 False"""
+        if self.sessions.get(session.session_id) is not session:
+            return False
+        event = session.replay.stamp(message)
+        if session.websocket is not None:
+            await self.send_personal_message(event, session.websocket)
+        return True
+
+    def is_open(self, websocket: WebSocket) -> bool:
+        queue = self.outbound.get(websocket)
+        return queue is not None and not queue.closed
+
+    def connection_stats(self) -> List[Dict[str, Any]]:
+        """各会话的发送队列、重放缓冲与对话轮次指标（包括已断开、等待恢复的会话）"""
+        stats = []
+        for session_id, session in self.sessions.items():
+            queue = self.outbound.get(session.websocket) if session.websocket is not None else None
+            stats.append({
+                "session_id": session_id,
+                **(queue.stats() if queue else {}),
+                **session.stats(),
+                "turns": session.turns.stats()
+            })
+        return stats
+
+manager = ConnectionManager()
+
+async def run_chat_turn(session: ChatSession, user_input: str):
+    """执行一轮对话并保存；事件经会话编号后发送，断线期间进入重放缓冲。
+    被取消（cancel 消息或会话过期）时保存已生成的部分"""
+    print(f"📨 收到用户消息: {user_input[:50]}...")
+
+    # 确认收到用户消息
+    await manager.send_event(session, {
+        "type": "user_msg_received",
+        "content": user_input
+    })
+
+    # 收集对话数据
+    conversation_data = {
+        "user_input": user_input,
+        "mcp_tools_called": [],
+        "mcp_results": [],
+        "ai_response_parts": []
+    }
+
+    # 获取当前连接的聊天历史
+    current_session_id = session.session_id
+    # 取最近若干条作为候选，实际保留多少由智能体按Token预算决定
+    # 上一轮的记录可能仍在写回队列中，先等它落库
+    try:
+        await write_queue.wait_session(current_session_id)
+        history = await chat_db.get_chat_history(
+            session_id=current_session_id, limit=HISTORY_MAX_RECORDS, tools=TOOLS_NONE
+        )
+    except Exception as e:
+        print(f"❌ 读取聊天历史失败: {e}")
+        await manager.send_event(session, {
+            "type": "error",
+            "content": f"处理消息时出错: {str(e)}"
+        })
+        return
+
+    # 流式处理并推送AI响应
+    thinking_mark = None
+    response_mark = None
+    cancelled = False
+    stream = mcp_agent.chat_stream(user_input, history=history)
+    try:
+        async for response_chunk in stream:
+            # 完整工具结果只暂存在服务端，前端按需分块获取
+            full_result = response_chunk.pop("full_result", None)
+            if full_result is not None and response_chunk.get("truncated"):
+                session.tool_results.put(response_chunk.get("tool_id"), full_result)
+
+            # 转发给客户端（编号后放入发送队列，断线期间只进入重放缓冲）；会话已结束时停止本轮，已生成的内容照常保存
+            if not await manager.send_event(session, response_chunk):
+                print(f"⚠️ 会话已结束，提前结束本轮对话 (session={current_session_id})")
+                break
+
+            # 收集不同类型的响应数据
+            chunk_type = response_chunk.get("type")
+
+            if chunk_type == "tool_start":
+                # 记录工具调用开始
+                tool_call = {
+                    "tool_id": response_chunk.get("tool_id"),
+                    "tool_name": response_chunk.get("tool_name"),
+                    "tool_args": response_chunk.get("tool_args"),
+                    "progress": response_chunk.get("progress")
+                }
+                conversation_data["mcp_tools_called"].append(tool_call)
+
+            elif chunk_type == "tool_end":
+                # 记录工具执行结果
+                tool_result = {
+                    "tool_id": response_chunk.get("tool_id"),
+                    "tool_name": response_chunk.get("tool_name"),
+                    "result": stored_result(full_result) if full_result is not None else response_chunk.get("result"),
+                    "result_size": response_chunk.get("result_size"),
+                    "success": True
+                }
+                conversation_data["mcp_results"].append(tool_result)
+
+            elif chunk_type == "tool_error":
+                # 记录工具执行错误
+                tool_error = {
+                    "tool_id": response_chunk.get("tool_id"),
+                    "error": response_chunk.get("error"),
+                    "success": False
+                }
+                conversation_data["mcp_results"].append(tool_error)
+
+            elif chunk_type == "ai_thinking_start":
+                # 记录本轮思考内容的起始位置
+                thinking_mark = len(conversation_data["ai_response_parts"])
+
+            elif chunk_type == "tool_plan":
+                # 本轮确定为工具调用轮，思考内容需保留
+                thinking_mark = None
+
+            elif chunk_type == "ai_response_start":
+                # 本轮内容已先作为思考推送时，回复会完整重发一次，避免重复保存
+                if thinking_mark is not None:
+                    del conversation_data["ai_response_parts"][thinking_mark:]
+                    thinking_mark = None
+                response_mark = len(conversation_data["ai_response_parts"])
+
+            elif chunk_type == "ai_response_retract":
+                # 本轮出现工具调用，已收集的回复片段改为本轮的思考内容
+                thinking_mark = response_mark
+
+            elif chunk_type == "ai_response_chunk":
+                # 收集AI回复内容片段
+                conversation_data["ai_response_parts"].append(
+                    response_chunk.get("content", "")
+                )
+
+            elif chunk_type == "ai_thinking_chunk":
+                # 收集AI思考内容片段到回复中
+                conversation_data["ai_response_parts"].append(
+                    response_chunk.get("content", "")
+                )
+
+            elif chunk_type == "error":
+                # 记录错误信息
+                print(f"❌ MCP处理错误: {response_chunk.get('content')}")
+                # 即使出错也要保存对话记录
+                break
+
+        # 组装完整的AI回复
+        ai_response = "".join(conversation_data["ai_response_parts"])
+
+        # 如果没有AI回复但有错误，添加错误信息
+        if not ai_response and conversation_data["mcp_results"]:
+            error_results = [r for r in conversation_data["mcp_results"] if not r.get("success", True)]
+            if error_results:
+                ai_response = f"处理过程中遇到错误：\n" + "\n".join([r.get("error", "未知错误") for r in error_results])
+
+        print(f"💾 准备保存对话记录，AI回复长度: {len(ai_response)}")
+
+    except Exception as e:
+        print(f"❌ MCP流式处理异常: {e}")
+        import traceback
+        traceback.print_exc()
+
+        # 即使异常也要保存对话记录
+        ai_response = f"处理请求时出错: {str(e)}"
+        conversation_data["ai_response_parts"] = [ai_response]
+
+    except asyncio.CancelledError:
+        # 用户取消或连接断开：关闭流即取消进行中的大模型请求与工具调用，已生成的部分照常保存
+        cancelled = True
+        ai_response = "".join(conversation_data["ai_response_parts"])
+        print(f"⏹️ 本轮对话已取消 (session={current_session_id})，已生成 {len(ai_response)} 字符")
+
+    finally:
+        await stream.aclose()
+
+    # 放入写回队列，由后台任务批量提交到数据库（shield：保存过程中不再被取消打断）
+    if write_queue:
         try:
-            await websocket.send_text(json.dumps(message, ensure_ascii=False))
+            await asyncio.shield(write_queue.submit(
+                user_input=conversation_data["user_input"],
+                mcp_tools_called=conversation_data["mcp_tools_called"],
+                mcp_results=conversation_data["mcp_results"],
+                ai_response=ai_response,
+                session_id=current_session_id
+            ))
         except Exception as e:
-            print(f"❌ 发送消息失败: {e}")
+            print(f"❌ 保存对话记录异常: {e}")
+
+    if cancelled:
+        await manager.send_event(session, {
+            "type": "turn_cancelled",
+            "content": ai_response
+        })
 
-manager = ConnectionManager()
 
 @app.websocket("/ws/chat")
 async def websocket_chat(websocket: WebSocket):
@@ -139,10 +484,14 @@ async def websocket_chat(websocket: WebSocket):
     try:
         while True:
             # 接收客户端消息
-            data = await websocket.receive_text()
+            data = await manager.receive(websocket)
+            session = manager.get_session(websocket)
+            if session is None:
+                # 会话已在新的连接中恢复，旧连接不再处理消息
+                break
             
             try:
-                message = json.loads(data)
+                message = manager.decode(websocket, data)
                 
                 if message.get("type") == "user_msg":
                     user_input = message.get("content", "").strip()
@@ -154,119 +503,64 @@ async def websocket_chat(websocket: WebSocket):
                         }, websocket)
                         continue
                     
-                    print(f"📨 收到用户消息: {user_input[:50]}...")
-                    
-                    # 确认收到用户消息
-                    await manager.send_personal_message({
-                        "type": "user_msg_received",
-                        "content": user_input
-                    }, websocket)
-                    
-                    # 收集对话数据
-                    conversation_data = {
-                        "user_input": user_input,
-                        "mcp_tools_called": [],
-                        "mcp_results": [],
-                        "ai_response_parts": []
-                    }
-                    
-                    # 获取当前连接的聊天历史
-                    current_session_id = manager.get_session_id(websocket)
-                    history = await chat_db.get_chat_history(session_id=current_session_id, limit=10) # 限制最近10条
+                    # 对话在独立任务中执行，接收循环继续处理心跳与取消
+                    runner = session.turns
+                    status, position = runner.submit(user_input)
+                    if status == TURN_QUEUED:
+                        await manager.send_personal_message({
+                            "type": "user_msg_queued",
+                            "content": user_input,
+                            "position": position
+                        }, websocket)
+                    elif status == TURN_REJECTED:
+                        await manager.send_personal_message({
+                            "type": "user_msg_rejected",
+                            "content": user_input,
+                            "reason": "上一轮对话尚未结束" if runner.policy == TURN_POLICY_REJECT else f"排队消息已达上限（{runner.max_pending}条）"
+                        }, websocket)
+
+                elif message.get("type") == "cancel":
+                    # 取消进行中的一轮（含排队中的消息），部分结果由对话任务保存后回复 turn_cancelled
+                    active, dropped = session.turns.cancel()
+                    if not active:
+                        await manager.send_personal_message({
+                            "type": "cancel_ignored",
+                            "content": "当前没有进行中的对话",
+                            "dropped": dropped
+                        }, websocket)
+                    elif dropped:
+                        print(f"⏹️ 已丢弃 {dropped} 条排队消息")
 
-                    # 流式处理并推送AI响应
+                elif message.get("type") == "tool_result_request":
+                    # 按需分块推送被截断的完整工具结果
+                    tool_id = message.get("tool_id")
+                    store = session.tool_results
+                    if store.get(tool_id) is None:
+                        await manager.send_personal_message({
+                            "type": "tool_result_unavailable",
+                            "tool_id": tool_id,
+                            "content": "完整结果已过期或不存在"
+                        }, websocket)
+                        continue
+                    for result_chunk in store.iter_chunks(tool_id):
+                        if not await manager.send_personal_message(result_chunk, websocket):
+                            break
+
+                elif message.get("type") == "configure":
+                    # 连接建立后调整流式片段的合并窗口，batch_ms=0 表示不等待
+                    queue = manager.outbound.get(websocket)
+                    if queue is None:
+                        continue
                     try:
-                        async for response_chunk in mcp_agent.chat_stream(user_input, history=history):
-                            # 转发给客户端
-                            await manager.send_personal_message(response_chunk, websocket)
-                            
-                            # 收集不同类型的响应数据
-                            chunk_type = response_chunk.get("type")
-                            
-                            if chunk_type == "tool_start":
-                                # 记录工具调用开始
-                                tool_call = {
-                                    "tool_id": response_chunk.get("tool_id"),
-                                    "tool_name": response_chunk.get("tool_name"),
-                                    "tool_args": response_chunk.get("tool_args"),
-                                    "progress": response_chunk.get("progress")
-                                }
-                                conversation_data["mcp_tools_called"].append(tool_call)
-                            
-                            elif chunk_type == "tool_end":
-                                # 记录工具执行结果
-                                tool_result = {
-                                    "tool_id": response_chunk.get("tool_id"),
-                                    "tool_name": response_chunk.get("tool_name"),
-                                    "result": response_chunk.get("result"),
-                                    "success": True
-                                }
-                                conversation_data["mcp_results"].append(tool_result)
-                            
-                            elif chunk_type == "tool_error":
-                                # 记录工具执行错误
-                                tool_error = {
-                                    "tool_id": response_chunk.get("tool_id"),
-                                    "error": response_chunk.get("error"),
-                                    "success": False
-                                }
-                                conversation_data["mcp_results"].append(tool_error)
-                            
-                            elif chunk_type == "ai_response_chunk":
-                                # 收集AI回复内容片段
-                                conversation_data["ai_response_parts"].append(
-                                    response_chunk.get("content", "")
-                                )
-                            
-                            elif chunk_type == "ai_thinking_chunk":
-                                # 收集AI思考内容片段到回复中
-                                conversation_data["ai_response_parts"].append(
-                                    response_chunk.get("content", "")
-                                )
-                            
-                            elif chunk_type == "error":
-                                # 记录错误信息
-                                print(f"❌ MCP处理错误: {response_chunk.get('content')}")
-                                # 即使出错也要保存对话记录
-                                break
-                        
-                        # 组装完整的AI回复
-                        ai_response = "".join(conversation_data["ai_response_parts"])
-                        
-                        # 如果没有AI回复但有错误，添加错误信息
-                        if not ai_response and conversation_data["mcp_results"]:
-                            error_results = [r for r in conversation_data["mcp_results"] if not r.get("success", True)]
-                            if error_results:
-                                ai_response = f"处理过程中遇到错误：\n" + "\n".join([r.get("error", "未知错误") for r in error_results])
-                        
-                        print(f"💾 准备保存对话记录，AI回复长度: {len(ai_response)}")
-                        
-                    except Exception as e:
-                        print(f"❌ MCP流式处理异常: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        
-                        # 即使异常也要保存对话记录
-                        ai_response = f"处理请求时出错: {str(e)}"
-                        conversation_data["ai_response_parts"] = [ai_response]
-                    
-                    # 保存完整对话到数据库
-                    if chat_db:
-                        try:
-                            success = await chat_db.save_conversation(
-                                user_input=conversation_data["user_input"],
-                                mcp_tools_called=conversation_data["mcp_tools_called"],
-                                mcp_results=conversation_data["mcp_results"],
-                                ai_response=ai_response,
-                                session_id=current_session_id
-                            )
-                            if success:
-                                print(f"✅ 对话记录保存成功")
-                            else:
-                                print(f"❌ 对话记录保存失败")
-                        except Exception as e:
-                            print(f"❌ 保存对话记录异常: {e}")
-                
+                        batch = queue.configure(message.get("batch_ms"), message.get("batch_chars"))
+                    except (TypeError, ValueError):
+                        await manager.send_personal_message({
+                            "type": "error",
+                            "content": "batch_ms / batch_chars 必须为数字"
+                        }, websocket)
+                        continue
+                    await manager.send_personal_message({"type": "configured", "batch": batch}, websocket)
+
                 elif message.get("type") == "ping":
                     # 心跳响应
                     await manager.send_personal_message({
@@ -280,10 +574,10 @@ async def websocket_chat(websocket: WebSocket):
                         "content": f"未知消息类型: {message.get('type')}"
                     }, websocket)
                     
-            except json.JSONDecodeError:
+            except MessageDecodeError:
                 await manager.send_personal_message({
                     "type": "error",
-                    "content": "消息格式错误，请发送有效的JSON"
+                    "content": "消息格式错误，请发送有效的JSON（或协商的 MessagePack）"
                 }, websocket)
             except Exception as e:
                 print(f"❌ WebSocket消息处理异常: {e}")
@@ -293,12 +587,16 @@ async def websocket_chat(websocket: WebSocket):
                     "type": "error",
                     "content": f"处理消息时出错: {str(e)}"
                 }, websocket)
+
+        await manager.disconnect(websocket)
                 
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        await manager.disconnect(websocket)
     except Exception as e:
-        print(f"❌ WebSocket错误: {e}")
-        manager.disconnect(websocket)
+        # 发送队列因接收过慢关闭连接后，接收端会在这里退出
+        if manager.is_open(websocket):
+            print(f"❌ WebSocket错误: {e}")
+        await manager.disconnect(websocket)
 
 # ─────────── REST API 接口 ───────────
 
@@ -322,52 +620,190 @@ async def get_tools():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取工具列表失败: {str(e)}")
 
+def _validate_cursors(before: str = None, after: str = None, tools: str = TOOLS_FULL):
+    """校验分页游标与工具加载方式，格式错误时返回400"""
+    if tools not in TOOL_LOAD_MODES:
+        raise HTTPException(status_code=400, detail=f"tools 参数只能是 {', '.join(TOOL_LOAD_MODES)}")
+    try:
+        for cursor in (before, after):
+            if cursor:
+                decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _ndjson_history(
+    meta: Dict[str, Any],
+    session_id: str,
+    limit: int,
+    before: str = None,
+    after: str = None,
+    tools: str = TOOLS_FULL
+) -> StreamingResponse:
+    """以NDJSON逐行输出历史记录：meta 行、每条记录一行、最后一行 end（带下一页游标）"""
+    async def generate():
+        yield dumps_line({"type": "meta", **meta})
+        first = last = None
+        returned = 0
+        try:
+            async for record in chat_db.iter_history(session_id=session_id, limit=limit, before=before, after=after, tools=tools):
+                first = first or record
+                last = record
+                returned += 1
+                yield dumps_line({"type": "record", "data": record})
+        except Exception as e:
+            print(f"❌ 流式输出历史记录失败: {e}")
+            yield dumps_line({"type": "error", "content": str(e)})
+            return
+        yield dumps_line({
+            "type": "end",
+            "returned": returned,
+            "before": encode_cursor(first) if first else before,
+            "after": encode_cursor(last) if last else after
+        })
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.get("/api/search")
+async def search_history(q: str, session_id: str = None, limit: int = 20, offset: int = 0):
+    """全文检索聊天记录（用户问题、AI回复、工具结果），按相关度排序"""
+    if not chat_db:
+        raise HTTPException(status_code=503, detail="数据库未初始化")
+    
+    if session_id:
+        await write_queue.wait_session(session_id)
+    limit = max(1, min(limit, 100))
+    try:
+        page = await chat_db.search(q, session_id=session_id, limit=limit, offset=offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
+    
+    return FastJSONResponse({
+        "success": True,
+        "data": page["results"],
+        "query": q,
+        "session_id": session_id,
+        "offset": offset,
+        "returned": len(page["results"]),
+        "has_more": page["has_more"]
+    })
+
+@app.get("/api/tools/stats")
+async def get_tool_stats(days: int = 7, tool_name: str = None):
+    """按天、按工具统计调用次数与失败次数"""
+    if not chat_db:
+        raise HTTPException(status_code=503, detail="数据库未初始化")
+    
+    usage = await chat_db.get_tool_usage(days=days, tool_name=tool_name)
+    return {
+        "success": True,
+        "data": usage,
+        "days": days
+    }
+
 @app.get("/api/history")
-async def get_history(limit: int = 50, session_id: str = "default", conversation_id: int = None):
-    """获取聊天历史"""
+async def get_history(
+    limit: int = 50,
+    session_id: str = "default",
+    conversation_id: int = None,
+    before: str = None,
+    after: str = None,
+    stream: bool = False,
+    tools: str = TOOLS_FULL
+):
+    """获取聊天历史
+    
+    按 (created_at, id) 游标分页，记录按时间正序返回：
+    before 取更早的一页，after 取更新的一页，都不指定时取最近的 limit 条；
+    stream=true 时以 NDJSON 逐条输出；
+    tools=calls 时不返回工具结果正文，tools=none 时不返回工具数据，结果可通过 /api/history/{record_id}/tools 按需获取
+    """
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
+    _validate_cursors(before, after, tools)
     
     try:
-        records = await chat_db.get_chat_history(
-            session_id=session_id, 
-            limit=limit,
-            conversation_id=conversation_id
-        )
+        await write_queue.wait_session(session_id)
+        if stream and conversation_id is None:
+            return _ndjson_history({"session_id": session_id}, session_id, max(1, limit), before, after, tools)
+
+        if conversation_id is not None:
+            records = await chat_db.get_chat_history(
+                session_id=session_id, 
+                limit=limit,
+                conversation_id=conversation_id,
+                tools=tools
+            )
+            page = {"records": records, "before": None, "after": None, "has_more": False}
+        else:
+            page = await chat_db.get_history_page(
+                session_id=session_id,
+                limit=max(1, min(limit, HISTORY_PAGE_MAX)),
+                before=before,
+                after=after,
+                tools=tools
+            )
         
         # 获取统计信息
         stats = await chat_db.get_stats()
         
-        return {
+        return FastJSONResponse({
             "success": True,
-            "data": records,
+            "data": page["records"],
             "total": stats.get("total_records", 0),
-            "returned": len(records),
+            "returned": len(page["records"]),
             "session_id": session_id,
-            "conversation_id": conversation_id
-        }
+            "conversation_id": conversation_id,
+            "cursors": {"before": page["before"], "after": page["after"]},
+            "has_more": page["has_more"]
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取历史记录失败: {str(e)}")
 
+@app.get("/api/history/{record_id}/tools")
+async def get_record_tools(record_id: int):
+    """按需获取单条记录的工具调用与完整结果"""
+    if not chat_db:
+        raise HTTPException(status_code=503, detail="数据库未初始化")
+    
+    calls = await chat_db.get_tool_calls(record_id)
+    return {
+        "success": True,
+        "data": calls,
+        "record_id": record_id
+    }
+
 @app.delete("/api/history")
-async def clear_history(session_id: str = None):
-    """清空聊天历史"""
+async def clear_history(session_id: str = None, all: bool = False):
+    """清空指定会话的聊天历史；清空所有会话需显式传入 all=true"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
+    if not session_id and not all:
+        raise HTTPException(status_code=400, detail="请指定 session_id，或传入 all=true 清空所有聊天历史")
     
     try:
-        # 如果没有提供session_id，则清空所有历史（保持向后兼容）
+        # 先提交写回队列中的记录，避免清空后又被写入
+        await write_queue.flush()
         if session_id:
             success = await chat_db.clear_history(session_id=session_id)
             message = f"会话 {session_id} 的聊天历史已清空"
         else:
-            success = await chat_db.clear_history()
+            success = await chat_db.clear_all_history()
             message = "所有聊天历史已清空"
         
         if success:
             return {"success": True, "message": message}
         else:
             raise HTTPException(status_code=500, detail="清空历史记录失败")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清空历史记录失败: {str(e)}")
 
@@ -388,7 +824,17 @@ async def get_status():
             "agent_initialized": mcp_agent is not None,
             "database_initialized": chat_db is not None,
             "tools_count": len(mcp_agent.tools) if mcp_agent else 0,
+            "tool_cache": mcp_agent.tool_cache.stats() if mcp_agent else {},
+            "llm_cache": mcp_agent.llm_cache.stats() if mcp_agent else {},
+            "mcp_servers": mcp_agent.discovery_report if mcp_agent else {},
+            "circuit_breakers": mcp_agent.get_breaker_states() if mcp_agent else {},
+            "write_queue": write_queue.stats() if write_queue else {},
+            "serialization": serializer_info(),
+            "retention": retention.stats() if retention else {},
             "active_connections": len(manager.active_connections),
+            "outbound_queued": sum(queue.depth for queue in manager.outbound.values()),
+            "active_turns": sum(1 for session in manager.sessions.values() if session.turns.busy),
+            "resumable_sessions": sum(1 for session in manager.sessions.values() if not session.attached),
             "chat_records_count": db_stats.get("total_records", 0),
             "chat_sessions_count": db_stats.get("total_sessions", 0),
             "chat_conversations_count": db_stats.get("total_conversations", 0),
@@ -398,14 +844,26 @@ async def get_status():
         }
     }
 
+@app.get("/api/connections")
+async def get_connections():
+    """各WebSocket连接的发送队列深度与丢弃、合并、背压等指标"""
+    return {
+        "success": True,
+        "data": manager.connection_stats()
+    }
+
 @app.get("/api/database/stats")
-async def get_database_stats():
-    """获取数据库详细统计信息"""
+async def get_database_stats(recount: bool = False):
+    """获取数据库详细统计信息，recount=true 时全表重新统计"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
     
     try:
-        stats = await chat_db.get_stats()
+        stats = await chat_db.get_stats(recount=recount)
+        stats["write_queue"] = write_queue.stats() if write_queue else {}
+        stats["retention"] = retention.stats() if retention else {}
+        stats["compression"] = (await chat_db.get_compression_stats())["codec"]
+        stats["storage"] = await chat_db.get_storage_info()
         return {
             "success": True,
             "data": stats
@@ -413,38 +871,132 @@ async def get_database_stats():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取数据库统计失败: {str(e)}")
 
+@app.get("/api/database/compression")
+async def get_compression_stats(scan: bool = False):
+    """获取文本压缩指标；scan=true 时扫描压缩列统计实际节省的空间"""
+    if not chat_db:
+        raise HTTPException(status_code=503, detail="数据库未初始化")
+    
+    try:
+        stats = await chat_db.get_compression_stats(scan=scan)
+        stats["migration"] = compression_migration.stats() if compression_migration else {}
+        return {
+            "success": True,
+            "data": stats
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取压缩统计失败: {str(e)}")
+
 @app.get("/api/share/{session_id}")
-async def get_shared_chat(session_id: str, limit: int = 100):
-    """获取分享的聊天记录（只读）"""
+async def get_shared_chat(
+    session_id: str,
+    limit: int = 100,
+    before: str = None,
+    after: str = None,
+    stream: bool = False
+):
+    """获取分享的聊天记录（只读），分页与流式参数同 /api/history"""
     if not chat_db:
         raise HTTPException(status_code=503, detail="数据库未初始化")
+    _validate_cursors(before, after)
     
     try:
+        await write_queue.wait_session(session_id)
+        if await chat_db.get_archive_entry(session_id):
+            return await _shared_archived_chat(session_id, limit, before, after, stream)
+        counts = await chat_db.get_session_counts(session_id)
+        if counts["records"] == 0:
+            raise HTTPException(status_code=404, detail="未找到该会话的聊天记录")
+
+        if stream:
+            return _ndjson_history({
+                "session_id": session_id,
+                "session_records": counts["records"],
+                "session_conversations": counts["conversations"],
+                "shared_at": datetime.now().isoformat(),
+                "readonly": True
+            }, session_id, max(1, limit), before, after)
+
         # 获取指定会话的聊天历史
-        records = await chat_db.get_chat_history(
-            session_id=session_id, 
-            limit=limit
+        page = await chat_db.get_history_page(
+            session_id=session_id,
+            limit=max(1, min(limit, HISTORY_PAGE_MAX)),
+            before=before,
+            after=after
         )
+        records = page["records"]
         
-        if not records:
-            raise HTTPException(status_code=404, detail="未找到该会话的聊天记录")
-        
-        # 获取会话统计信息
-        stats = await chat_db.get_stats()
-        
-        return {
+        return FastJSONResponse({
             "success": True,
             "data": records,
             "session_id": session_id,
             "total_records": len(records),
+            "session_records": counts["records"],
+            "cursors": {"before": page["before"], "after": page["after"]},
+            "has_more": page["has_more"],
             "shared_at": datetime.now().isoformat(),
             "readonly": True
-        }
+        })
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取分享聊天记录失败: {str(e)}")
 
+async def _shared_archived_chat(session_id: str, limit: int, before: str, after: str, stream: bool):
+    """分享已归档的会话：合并归档文件与数据库中仍保留的记录，在内存中分页"""
+    records = await retention.load_session(session_id) + await chat_db.export_session(session_id)
+    conversations = len({r.get("conversation_id") for r in records})
+    page = page_records(records, max(1, limit if stream else min(limit, HISTORY_PAGE_MAX)), before, after)
+    shared_at = datetime.now().isoformat()
+
+    if stream:
+        async def generate():
+            yield dumps_line({
+                "type": "meta",
+                "session_id": session_id,
+                "session_records": len(records),
+                "session_conversations": conversations,
+                "shared_at": shared_at,
+                "readonly": True,
+                "archived": True
+            })
+            for record in page["records"]:
+                yield dumps_line({"type": "record", "data": record})
+            yield dumps_line({
+                "type": "end",
+                "returned": len(page["records"]),
+                "before": page["before"],
+                "after": page["after"]
+            })
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    return FastJSONResponse({
+        "success": True,
+        "data": page["records"],
+        "session_id": session_id,
+        "total_records": len(page["records"]),
+        "session_records": len(records),
+        "cursors": {"before": page["before"], "after": page["after"]},
+        "has_more": page["has_more"],
+        "shared_at": shared_at,
+        "readonly": True,
+        "archived": True
+    })
+
+@app.post("/api/retention/run")
+async def run_retention():
+    """立即执行一次保留策略（归档过期会话并回收空间）"""
+    if not chat_db or not retention:
+        raise HTTPException(status_code=503, detail="数据库未初始化")
+    
+    try:
+        await write_queue.flush()
+        result = await retention.run_once()
+        return {"success": True, "data": result}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"执行保留策略失败: {str(e)}")
+
 # ─────────── 静态文件服务（可选） ───────────
 
 # 如果要让FastAPI直接服务前端文件，取消下面的注释
@@ -453,10 +1005,7 @@ async def get_shared_chat(session_id: str, limit: int = 100):
 if __name__ == "__main__":
     # 开发环境启动
     # 端口可通过环境变量 BACKEND_PORT 覆盖，默认 8003，与前端配置一致
-    try:
-        port = int(os.getenv("BACKEND_PORT", "8003"))
-    except Exception:
-        port = 8003
+    port = env_int("BACKEND_PORT", 8003)
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
@@ -5,16 +5,51 @@ MCP智能体封装 - 为Web后端使用
 
 import os
 import json
+import time
+import uuid
 import asyncio
-from typing import Dict, List, Any, AsyncGenerator
+from typing import Dict, List, Any, AsyncGenerator, Optional
 from pathlib import Path
 from datetime import datetime, timedelta
 
 from dotenv import load_dotenv, find_dotenv
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import SystemMessage, AIMessage
 from langchain_mcp_adapters.client import MultiServerMCPClient
 
+from tool_registry import ToolRegistry
+from tool_cache import ToolResultCache
+from tool_schema_cache import ToolSchemaCache, config_hash, serialize_tool
+from token_budget import HistoryBudget
+from tool_results import preview_result, prompt_result
+from llm_cache import LLMResponseCache, make_llm_cache_key
+from circuit_breaker import CircuitBreaker, CircuitOpenError, HALF_OPEN
+from env import env_int, env_float
+
+# 回放缓存的大模型响应时每个 ai_thinking_chunk 的字符数
+LLM_CACHE_REPLAY_CHUNK = 64
+
+# mcp.json 中由智能体自身使用、不传递给 MultiServerMCPClient 的服务器配置项
+AGENT_SERVER_OPTIONS = ("max_concurrency", "cache", "tool_timeout", "tool_timeouts", "circuit_breaker")
+
+
+def new_tool_call_id() -> str:
+    """生成全局唯一的工具调用ID：会话内暂存的完整结果与前端的工具卡片都按ID定位"""
+    return f"call_{uuid.uuid4().hex[:12]}"
+
+
+def _http_client_factory(headers=None, timeout=None, auth=None):
+    """MCP客户端使用的httpx工厂 - 禁用HTTP/2"""
+    import httpx
+
+    return httpx.AsyncClient(
+        http2=False,  # 禁用HTTP/2
+        headers=headers,
+        timeout=timeout,
+        auth=auth
+    )
+
+
 # ─────────── 1. MCP配置管理 ───────────
 class MCPConfig:
     """MCP配置管理"""
@@ -36,6 +71,22 @@ class MCPConfig:
         self.save_config(self.default_config)
         return self.default_config
 
+    def read_config(self) -> Optional[Dict[str, Any]]:
+        """只读加载配置文件，文件不存在或内容无效时返回None（不会写回默认配置）"""
+        try:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            return config if isinstance(config, dict) else None
+        except Exception:
+            return None
+
+    def last_modified(self) -> Optional[float]:
+        """配置文件的修改时间，文件不存在时返回None"""
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+
     def save_config(self, config: Dict[str, Any]):
         """保存配置文件"""
         try:
@@ -54,11 +105,27 @@ class WebMCPAgent:
         config_path = Path(__file__).parent / "mcp.json"
         self.config = MCPConfig(str(config_path))
         self.llm = None
+        # 未绑定工具的大模型，注册表变化时基于它重新 bind_tools
+        self.base_llm = None
         self.mcp_client = None
-        self.tools = []
-        # 新增：按服务器分组的工具存储
-        self.tools_by_server = {}
+        # 工具注册表：按服务器分组 + 工具名索引
+        self.registry = ToolRegistry()
         self.server_configs = {}
+        # mcp.json 中各服务器的原始配置，用于热重载时比较差异
+        self.raw_server_configs: Dict[str, Dict[str, Any]] = {}
+        # 服务器级的非连接配置（如并发上限）
+        self.server_options: Dict[str, Dict[str, Any]] = {}
+        self._server_semaphores: Dict[str, asyncio.Semaphore] = {}
+        # 只读工具的结果缓存（按 mcp.json 中的 cache 配置启用）
+        self.tool_cache = ToolResultCache()
+        # 每个服务器的熔断器
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._reload_lock = asyncio.Lock()
+        self._watch_task = None
+        # 服务器发现结果：状态、工具数、耗时；以及超过启动期限仍在后台获取的任务
+        self.discovery_report: Dict[str, Dict[str, Any]] = {}
+        self._late_discovery = set()
+        self._revalidate_task = None
 
         # 加载 .env 并设置API环境变量（不覆盖已存在的环境变量）
         try:
@@ -73,14 +140,34 @@ class WebMCPAgent:
         self.model_name = os.getenv("OPENAI_MODEL", os.getenv("OPENAI_MODEL_NAME", "deepseek-chat")).strip()
 
         # 数值配置，带默认
-        try:
-            self.temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.2"))
-        except Exception:
-            self.temperature = 0.2
-        try:
-            self.timeout = int(os.getenv("OPENAI_TIMEOUT", "60"))
-        except Exception:
-            self.timeout = 60
+        self.temperature = env_float("OPENAI_TEMPERATURE", 0.2)
+        self.timeout = env_int("OPENAI_TIMEOUT", 60)
+        # MCP服务器发现的整体期限（秒），超时的服务器不阻塞启动
+        self.startup_timeout = env_float("MCP_STARTUP_TIMEOUT", 30.0)
+        # 工具定义的本地缓存文件，设为空字符串则不使用缓存
+        schema_cache_file = os.getenv("MCP_TOOL_SCHEMA_CACHE", str(Path(__file__).parent / ".mcp_tools_cache.json")).strip()
+        self.schema_cache = ToolSchemaCache(schema_cache_file) if schema_cache_file else None
+        # mcp.json 变更检查间隔（秒），0 表示不监听
+        self.config_watch_interval = env_float("MCP_CONFIG_WATCH_INTERVAL", 2.0)
+        # 单个MCP服务器默认的工具并发上限，可在 mcp.json 中按服务器用 max_concurrency 覆盖
+        self.tool_concurrency = max(1, env_int("MCP_TOOL_CONCURRENCY", 4))
+
+        # 提示词Token预算：历史记录按预算保留，超出部分压缩为摘要
+        prompt_budget = env_int("PROMPT_TOKEN_BUDGET", 8000)
+        summary_budget = env_int("HISTORY_SUMMARY_TOKENS", 500)
+        self.history_budget = HistoryBudget(prompt_budget=prompt_budget, summary_budget=summary_budget)
+
+        # 大模型响应缓存（LLM_CACHE_TTL 秒，默认0即关闭）
+        llm_cache_ttl = env_float("LLM_CACHE_TTL", 0.0)
+        llm_cache_entries = env_int("LLM_CACHE_MAX_ENTRIES", 500)
+        llm_cache_bytes = env_int("LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024)
+        self.llm_cache = LLMResponseCache(ttl=llm_cache_ttl, max_entries=llm_cache_entries, max_bytes=llm_cache_bytes)
+        self._tools_signature = ""
+
+        # 工具调用超时与熔断默认值，可在 mcp.json 中按服务器/工具覆盖
+        self.tool_timeout = env_float("MCP_TOOL_TIMEOUT", 60.0)
+        self.breaker_threshold = env_int("MCP_BREAKER_FAILURES", 5)
+        self.breaker_recovery = env_float("MCP_BREAKER_RECOVERY", 30.0)
 
         # 将关键配置同步到环境（供底层SDK使用），不覆盖外部已设值
         if self.api_key and not os.getenv("OPENAI_API_KEY"):
@@ -95,85 +182,59 @@ class WebMCPAgent:
             if not os.getenv("OPENAI_API_KEY"):
                 raise RuntimeError("缺少 OPENAI_API_KEY，请在 .env 或系统环境中配置")
 
+            # 后台加载Token编码，不阻塞启动（离线时退回估算）
+            self.history_budget.load_encoding()
+
             # ChatOpenAI 支持从环境变量读取 base_url
-            self.llm = ChatOpenAI(
+            self.base_llm = ChatOpenAI(
                 model=self.model_name,
                 temperature=self.temperature,
                 timeout=self.timeout,
                 max_retries=3,
             )
+            self.llm = self.base_llm
 
             # 加载MCP配置并连接
             mcp_config = self.config.load_config()
-            self.server_configs = mcp_config.get("servers", {})
+            raw_configs = mcp_config.get("servers", {})
 
-            if not self.server_configs:
+            if not raw_configs:
                 print("❌ 没有配置MCP服务器")
                 return False
 
-            print("🔗 正在连接MCP服务器...")
-            
-            # 先测试服务器连接
-            import aiohttp
-            import asyncio
-            
-            for server_name, server_config in self.server_configs.items():
-                try:
-                    url = server_config.get('url')
-                    if not url:
-                        print(f"⚠️ 服务器 {server_name} 缺少 url 配置，跳过连接测试")
-                        continue
-                    print(f"🧪 测试连接到 {server_name}: {url}")
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                            print(f"✅ {server_name} 连接测试成功 (状态: {response.status})")
-                except Exception as test_e:
-                    print(f"⚠️ {server_name} 连接测试失败: {test_e}")
-            
-            # 创建MCP客户端 - 强制清除缓存并禁用HTTP/2
-            import httpx
-
-            def http_client_factory(headers=None, timeout=None, auth=None):
-                return httpx.AsyncClient(
-                    http2=False,  # 禁用HTTP/2
-                    headers=headers,
-                    timeout=timeout,
-                    auth=auth
-                )
-
-            # 更新服务器配置以使用自定义的httpx客户端工厂
-            for server_name in self.server_configs:
-                # 避免污染原配置对象，复制后添加工厂
-                server_cfg = dict(self.server_configs[server_name])
-                server_cfg['httpx_client_factory'] = http_client_factory
-                self.server_configs[server_name] = server_cfg
+            # 创建MCP客户端 - 使用禁用HTTP/2的httpx客户端工厂
+            self._apply_server_configs(raw_configs)
 
-            self.mcp_client = MultiServerMCPClient(self.server_configs)
+            # 优先使用本地缓存的工具定义，未命中的服务器再实时获取
+            cached = self._load_cached_tools(list(raw_configs.keys()))
+            cold = [server_name for server_name in raw_configs if server_name not in cached]
+            if cached:
+                print(f"📦 从缓存加载工具定义: {list(cached.keys())}")
 
-            # 改为串行获取工具，避免并发问题
-            print("🔧 正在逐个获取服务器工具...")
-            for server_name in self.server_configs.keys():
-                try:
-                    print(f"─── 正在从服务器 '{server_name}' 获取工具 ───")
-                    server_tools = await self.mcp_client.get_tools(server_name=server_name)
-                    self.tools.extend(server_tools)
-                    self.tools_by_server[server_name] = server_tools
-                    print(f"✅ 从 {server_name} 获取到 {len(server_tools)} 个工具")
-                except Exception as e:
-                    print(f"❌ 从服务器 '{server_name}' 获取工具失败: {e}")
-                    self.tools_by_server[server_name] = []
+            # 并发探测服务器并获取工具，整体受启动期限约束
+            loaded = {}
+            if cold:
+                print(f"🔗 正在并发连接 {len(cold)} 个MCP服务器 (期限 {self.startup_timeout}s)...")
+                loaded = await self._discover_servers(cold)
+            self.registry.update(set_servers={**cached, **loaded})
             
             # 验证工具来源，确保只有配置文件中的服务器
             print(f"🔍 配置的服务器: {list(self.server_configs.keys())}")
             print(f"🔍 实际获取到的工具数量: {len(self.tools)}")
-            
-            # 分组逻辑已在上面的循环中完成，无需额外调用
 
             print(f"✅ 成功连接，获取到 {len(self.tools)} 个工具")
             print(f"📊 服务器分组情况: {dict((name, len(tools)) for name, tools in self.tools_by_server.items())}")
 
             # 绑定工具到大模型
-            self.llm = self.llm.bind_tools(self.tools)
+            self._rebind_tools()
+
+            # 缓存的工具定义在后台向服务器重新校验
+            if cached:
+                self._revalidate_task = asyncio.create_task(self._revalidate_cached(list(cached.keys())))
+
+            # 监听 mcp.json 变化，增量增删服务器
+            if self.config_watch_interval > 0:
+                self._watch_task = asyncio.create_task(self._watch_config())
 
             print("🤖 Web MCP智能助手已启动！")
             return True
@@ -192,6 +253,262 @@ class WebMCPAgent:
                     pass
             return False
 
+    @property
+    def tools(self) -> List[Any]:
+        """当前全部工具"""
+        return self.registry.tools
+
+    @property
+    def tools_by_server(self) -> Dict[str, List[Any]]:
+        """按服务器分组的当前工具"""
+        return self.registry.tools_by_server
+
+    def _prepare_server_config(self, server_name: str, raw_config: Dict[str, Any]) -> Dict[str, Any]:
+        """拆分服务器配置：智能体自身的配置项存入 server_options，其余作为MCP连接配置"""
+        # 避免污染原配置对象，复制后添加工厂
+        server_cfg = dict(raw_config)
+        self.server_options[server_name] = {
+            key: server_cfg.pop(key) for key in AGENT_SERVER_OPTIONS if key in server_cfg
+        }
+        server_cfg['httpx_client_factory'] = _http_client_factory
+        return server_cfg
+
+    def _apply_server_configs(self, raw_configs: Dict[str, Dict[str, Any]]):
+        """根据原始配置重建连接配置与MCP客户端"""
+        self.server_options = {}
+        server_configs = {
+            server_name: self._prepare_server_config(server_name, raw_config)
+            for server_name, raw_config in raw_configs.items()
+        }
+        self.mcp_client = MultiServerMCPClient(server_configs)
+        self.server_configs = server_configs
+        self.raw_server_configs = {name: dict(cfg) for name, cfg in raw_configs.items()}
+
+    async def _discover_server(self, client: MultiServerMCPClient, server_name: str, session=None) -> List[Any]:
+        """探测单个服务器并获取工具列表，结果与耗时写入 discovery_report；失败时返回空列表"""
+        import aiohttp
+
+        started = time.monotonic()
+        report = {"status": "pending", "tools": 0, "elapsed": None, "error": None}
+        self.discovery_report[server_name] = report
+
+        url = self.raw_server_configs.get(server_name, {}).get('url')
+        if session is None or not url:
+            print(f"⚠️ 服务器 {server_name} 缺少 url 配置，跳过连接测试")
+        else:
+            try:
+                print(f"🧪 测试连接到 {server_name}: {url}")
+                probe_timeout = aiohttp.ClientTimeout(total=min(10, self.startup_timeout))
+                async with session.get(url, timeout=probe_timeout) as response:
+                    print(f"✅ {server_name} 连接测试成功 (状态: {response.status})")
+            except Exception as test_e:
+                print(f"⚠️ {server_name} 连接测试失败: {test_e}")
+
+        try:
+            print(f"─── 正在从服务器 '{server_name}' 获取工具 ───")
+            server_tools = await client.get_tools(server_name=server_name)
+            report.update(status="ok", tools=len(server_tools), source="live")
+            print(f"✅ 从 {server_name} 获取到 {len(server_tools)} 个工具")
+            self._save_tool_schemas(server_name, server_tools)
+            return server_tools
+        except Exception as e:
+            report.update(status="failed", error=str(e))
+            print(f"❌ 从服务器 '{server_name}' 获取工具失败: {e}")
+            return []
+        finally:
+            report["elapsed"] = round(time.monotonic() - started, 3)
+            report["slow"] = report["elapsed"] > self.startup_timeout / 2
+
+    async def _discover_servers(self, server_names: List[str]) -> Dict[str, List[Any]]:
+        """并发发现多个服务器，只等待到启动期限
+
+        期限内完成的服务器直接返回；超时的服务器在后台继续获取，完成后再加入注册表。
+        """
+        import aiohttp
+
+        if not server_names:
+            return {}
+        session = aiohttp.ClientSession()
+        client = self.mcp_client
+        tasks = {
+            asyncio.create_task(self._discover_server(client, server_name, session)): server_name
+            for server_name in server_names
+        }
+        done, pending = await asyncio.wait(tasks.keys(), timeout=self.startup_timeout)
+        loaded = {tasks[task]: task.result() for task in done}
+
+        slow = [name for name in loaded if self.discovery_report[name].get("slow")]
+        if slow:
+            print(f"🐢 响应较慢的服务器: {slow}")
+        if pending:
+            late = {task: tasks[task] for task in pending}
+            for server_name in late.values():
+                self.discovery_report[server_name]["status"] = "timeout"
+            print(f"⏰ 超过启动期限，暂时跳过: {list(late.values())}（后台继续获取）")
+            late_task = asyncio.create_task(self._finish_late_discovery(late, session))
+            self._late_discovery.add(late_task)
+            late_task.add_done_callback(self._late_discovery.discard)
+        else:
+            await session.close()
+        return loaded
+
+    async def _finish_late_discovery(self, late: Dict[asyncio.Task, str], session):
+        """等待超过启动期限的服务器完成发现，并在配置未变时加入注册表"""
+        expected = {server_name: self.raw_server_configs.get(server_name) for server_name in late.values()}
+        async def wait_one(task, server_name):
+            return server_name, await task
+
+        try:
+            for next_done in asyncio.as_completed([wait_one(task, name) for task, name in late.items()]):
+                server_name, server_tools = await next_done
+                self.discovery_report.get(server_name, {})["late"] = True
+                if self.raw_server_configs.get(server_name) != expected[server_name]:
+                    # 期间配置已变更或服务器已移除，结果作废
+                    continue
+                if server_tools:
+                    self.registry.set_server_tools(server_name, server_tools)
+                    self._rebind_tools()
+                    print(f"✅ 服务器 {server_name} 延迟加入，当前 {len(self.tools)} 个工具")
+        except asyncio.CancelledError:
+            for task in late:
+                task.cancel()
+            raise
+        finally:
+            await session.close()
+
+    def _server_config_hash(self, server_name: str) -> str:
+        """服务器连接配置的哈希（不含智能体自身的配置项）"""
+        raw_config = self.raw_server_configs.get(server_name, {})
+        return config_hash({k: v for k, v in raw_config.items() if k not in AGENT_SERVER_OPTIONS})
+
+    def _save_tool_schemas(self, server_name: str, server_tools: List[Any]):
+        """将服务器的工具定义写入本地缓存"""
+        if self.schema_cache is None:
+            return
+        try:
+            definitions = [serialize_tool(tool) for tool in server_tools]
+            self.schema_cache.save(server_name, self._server_config_hash(server_name), definitions)
+        except Exception as e:
+            print(f"⚠️ 缓存服务器 {server_name} 的工具定义失败: {e}")
+
+    def _load_cached_tools(self, server_names: List[str]) -> Dict[str, List[Any]]:
+        """用缓存的工具定义重建工具对象（调用时按连接配置新建会话）"""
+        if self.schema_cache is None:
+            return {}
+        from mcp.types import Tool as MCPTool
+        from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+
+        self.schema_cache.prune(server_names)
+        cached = {}
+        for server_name in server_names:
+            definitions = self.schema_cache.load(server_name, self._server_config_hash(server_name))
+            if not definitions:
+                continue
+            try:
+                cached[server_name] = [
+                    convert_mcp_tool_to_langchain_tool(
+                        None, MCPTool(**definition), connection=self.server_configs[server_name]
+                    )
+                    for definition in definitions
+                ]
+                self.discovery_report[server_name] = {
+                    "status": "cached", "tools": len(cached[server_name]), "elapsed": 0.0,
+                    "error": None, "source": "cache"
+                }
+            except Exception as e:
+                print(f"⚠️ 服务器 {server_name} 的缓存工具定义无效，将实时获取: {e}")
+                cached.pop(server_name, None)
+        return cached
+
+    async def _revalidate_cached(self, server_names: List[str]):
+        """后台向服务器重新获取工具；成功则更新注册表，失败则继续使用缓存"""
+        try:
+            loaded = await self._discover_servers(server_names)
+            fresh = {
+                server_name: server_tools for server_name, server_tools in loaded.items()
+                if self.discovery_report.get(server_name, {}).get("status") == "ok"
+            }
+            for server_name in server_names:
+                if server_name not in fresh:
+                    self.discovery_report[server_name].update(
+                        source="cache", tools=len(self.tools_by_server.get(server_name, []))
+                    )
+                    print(f"⚠️ 服务器 {server_name} 校验失败，继续使用缓存的工具定义")
+            if fresh:
+                self.registry.update(set_servers=fresh)
+                self._rebind_tools()
+                print(f"✅ 已用实时工具定义替换缓存: {list(fresh.keys())}")
+        except Exception as e:
+            print(f"❌ 缓存工具定义校验失败: {e}")
+
+    def _rebind_tools(self):
+        """基于当前注册表重新绑定工具，整体替换 self.llm"""
+        try:
+            definitions = sorted((serialize_tool(tool) for tool in self.tools), key=lambda d: d["name"])
+            self._tools_signature = config_hash({"tools": definitions})
+        except Exception:
+            # 无法序列化时以注册表版本区分，保证工具变化后不会命中旧缓存
+            self._tools_signature = f"version:{self.registry.version}"
+        self.llm = self.base_llm.bind_tools(self.tools)
+
+    async def reload_servers(self, raw_configs: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+        """按新的服务器配置增量更新：只连接新增/变更的服务器，移除已删除的服务器
+
+        进行中的对话继续使用旧的工具与模型对象，更新完成后一次性切换。
+        """
+        async with self._reload_lock:
+            old_configs = self.raw_server_configs
+            added = [name for name in raw_configs if name not in old_configs]
+            removed = [name for name in old_configs if name not in raw_configs]
+            changed = [name for name in raw_configs if name in old_configs and raw_configs[name] != old_configs[name]]
+            diff = {"added": added, "removed": removed, "changed": changed}
+            if not (added or removed or changed):
+                return diff
+
+            print(f"🔄 MCP配置变更: 新增 {added}，移除 {removed}，变更 {changed}")
+            previous_options = self.server_options
+            self._apply_server_configs(raw_configs)
+
+            loaded = await self._discover_servers(added + changed)
+            for server_name in removed:
+                self.discovery_report.pop(server_name, None)
+
+            for server_name in removed + changed:
+                self._server_semaphores.pop(server_name, None)
+                self._breakers.pop(server_name, None)
+                self.tool_cache.clear(server_name)
+            for server_name in raw_configs:
+                if self.server_options.get(server_name) != previous_options.get(server_name):
+                    self._server_semaphores.pop(server_name, None)
+                    self._breakers.pop(server_name, None)
+                    self.tool_cache.clear(server_name)
+
+            self.registry.update(set_servers=loaded, remove_servers=removed)
+            self._rebind_tools()
+            print(f"✅ 工具注册表已更新 (版本 {self.registry.version})，当前 {len(self.tools)} 个工具")
+            return diff
+
+    async def _watch_config(self):
+        """轮询 mcp.json 的修改时间，变化后热重载服务器"""
+        last_mtime = self.config.last_modified()
+        while True:
+            try:
+                await asyncio.sleep(self.config_watch_interval)
+                mtime = self.config.last_modified()
+                if mtime is None or mtime == last_mtime:
+                    continue
+                config = self.config.read_config()
+                if config is None:
+                    # 可能正在写入，下次再试
+                    print("⚠️ mcp.json 暂时无法解析，等待下次检查")
+                    continue
+                last_mtime = mtime
+                await self.reload_servers(config.get("servers", {}))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ MCP配置热重载失败: {e}")
+
     def _get_system_prompt(self) -> str:
         """获取系统提示词"""
         now = datetime.now()
@@ -218,12 +535,18 @@ class WebMCPAgent:
             yield {"type": "status", "content": "开始分析用户需求..."}
 
             # 构建消息历史
+            system_prompt = self._get_system_prompt()
             messages = [
-                {"role": "system", "content": self._get_system_prompt()}
+                {"role": "system", "content": system_prompt}
             ]
 
-            # 添加历史记录
+            # 添加历史记录（按Token预算裁剪，按时间正序）
             if history:
+                self.history_budget.load_encoding()
+                reserved = self.history_budget.count(system_prompt) + self.history_budget.count(user_input)
+                history, summary = self.history_budget.fit(history, reserved_tokens=reserved)
+                if summary:
+                    messages.append({"role": "system", "content": summary})
                 for record in history:
                     messages.append({"role": "user", "content": record['user_input']})
                     if record.get('ai_response'):
@@ -233,16 +556,20 @@ class WebMCPAgent:
 
             max_iterations = 10
             iteration = 0
+            # 本轮对话固定使用开始时绑定的模型，热重载不会影响进行中的对话
+            llm = self.llm
 
             while iteration < max_iterations:
                 iteration += 1
 
                 yield {"type": "status", "content": f"第 {iteration} 轮推理..."}
 
-                # 调用大模型进行推理（保持原有逻辑）
+                # 单次流式推理：边接收边推送内容，同时累积工具调用片段（命中响应缓存时回放）
+                round_result: Dict[str, Any] = {}
                 try:
                     print(f"🧠 第 {iteration} 轮推理开始...")
-                    response = await self.llm.ainvoke(messages)
+                    async for event in self._stream_round(llm, messages, iteration, round_result):
+                        yield event
                     print(f"✅ 第 {iteration} 轮推理完成")
                 except Exception as e:
                     print(f"❌ 大模型调用失败: {e}")
@@ -252,35 +579,23 @@ class WebMCPAgent:
                     }
                     return
 
-                # 流式显示AI思考内容（新增功能）
-                if response.content:
-                    # 开始AI思考
-                    yield {
-                        "type": "ai_thinking_start",
-                        "iteration": iteration
-                    }
+                response = round_result.get("message")
+                thinking_content = round_result.get("content", "")
+                responded = round_result.get("responded", False)
+                if responded and response is not None and getattr(response, 'tool_calls', None):
+                    # 工具调用未以片段形式出现时，在流结束后才能判定
+                    responded = False
+                    yield {"type": "ai_response_retract", "iteration": iteration}
 
-                    # 重新流式生成思考内容（真流式）
-                    thinking_content = ""
-                    async for chunk in self.llm.astream(messages):
-                        if hasattr(chunk, 'content') and chunk.content:
-                            content = chunk.content
-                            thinking_content += content
-                            yield {
-                                "type": "ai_thinking_chunk",
-                                "content": content,
-                                "iteration": iteration
-                            }
-
-                    # 结束AI思考
+                if thinking_content and not responded:
                     yield {
                         "type": "ai_thinking_end",
                         "content": thinking_content,
                         "iteration": iteration
                     }
 
-                # 检查是否有工具调用（保持原有逻辑）
-                if hasattr(response, 'tool_calls') and response.tool_calls:
+                # 检查是否有工具调用（由同一次流式结果判定）
+                if response is not None and getattr(response, 'tool_calls', None):
                     print(f"🔧 检测到 {len(response.tool_calls)} 个工具调用")
                     yield {
                         "type": "tool_plan",
@@ -288,109 +603,64 @@ class WebMCPAgent:
                         "tool_count": len(response.tool_calls)
                     }
 
-                    # 串行执行每个工具调用
-                    for i, tool_call in enumerate(response.tool_calls, 1):
-                        tool_name = tool_call['name']
-                        tool_args = tool_call.get('args', {})
-                        tool_id = tool_call.get('id', f"call_{i}")
-
-                        print(f"🔧 执行工具 {i}/{len(response.tool_calls)}: {tool_name}")
-
-                        # 推送工具开始执行
-                        yield {
-                            "type": "tool_start",
-                            "tool_id": tool_id,
-                            "tool_name": tool_name,
-                            "tool_args": tool_args,
-                            "progress": f"{i}/{len(response.tool_calls)}"
-                        }
-
-                        try:
-                            # 查找对应的工具
-                            target_tool = None
-                            for tool in self.tools:
-                                if tool.name == tool_name:
-                                    target_tool = tool
-                                    break
-
-                            if target_tool is None:
-                                error_msg = f"工具 '{tool_name}' 未找到"
-                                print(f"❌ {error_msg}")
-                                yield {
-                                    "type": "tool_error",
-                                    "tool_id": tool_id,
-                                    "error": error_msg
-                                }
-                                tool_result = f"错误: {error_msg}"
-                            else:
-                                # 执行工具
-                                print(f"🔧 正在执行工具: {tool_name}")
-                                tool_result = await target_tool.ainvoke(tool_args)
-                                print(f"✅ 工具执行完成: {tool_name}")
-
-                                # 推送工具执行结果
-                                yield {
-                                    "type": "tool_end",
-                                    "tool_id": tool_id,
-                                    "tool_name": tool_name,
-                                    "result": str(tool_result)
-                                }
-
-                        except Exception as e:
-                            error_msg = f"工具执行出错: {e}"
-                            print(f"❌ {error_msg}")
-                            yield {
-                                "type": "tool_error",
-                                "tool_id": tool_id,
-                                "error": error_msg
-                            }
-                            tool_result = f"错误: {error_msg}"
+                    # 并发执行本轮全部工具调用，事件按实际开始/结束顺序推送
+                    # 模型未返回ID时生成唯一ID，避免覆盖同一会话中其他调用暂存的完整结果
+                    tool_calls = [
+                        {**tool_call, "id": tool_call.get('id') or new_tool_call_id()}
+                        for tool_call in response.tool_calls
+                    ]
+                    events: asyncio.Queue = asyncio.Queue()
+                    runner = asyncio.create_task(self._run_tool_calls(tool_calls, events))
+                    try:
+                        while True:
+                            event = await events.get()
+                            if event is None:
+                                break
+                            yield event
+                        tool_results = await runner
+                    finally:
+                        if not runner.done():
+                            runner.cancel()
 
-                        # 将工具结果添加到消息历史
-                        messages.append({
-                            "role": "assistant",
-                            "content": response.content or "",
-                            "tool_calls": [tool_call]
-                        })
+                    # 单条assistant消息携带全部工具调用，工具结果按调用顺序追加
+                    messages.append({
+                        "role": "assistant",
+                        "content": response.content or "",
+                        "tool_calls": tool_calls
+                    })
+                    for tool_call, tool_result in zip(tool_calls, tool_results):
                         messages.append({
                             "role": "tool",
-                            "tool_call_id": tool_id,
-                            "name": tool_name,
-                            "content": str(tool_result)
+                            "tool_call_id": tool_call['id'],
+                            "name": tool_call['name'],
+                            "content": tool_result
                         })
 
                     # 继续下一轮推理
                     continue
 
                 else:
-                    # 没有工具调用 - 这是最终回复，不显示在思维流中
-                    # 确保 thinking_content 已定义
-                    try:
-                        tc_len = len(thinking_content)  # 可能未定义
-                    except Exception:
-                        tc_len = 0
-                    print(f"💬 当前内容为最终回复，长度: {tc_len}")
+                    # 没有工具调用 - 本轮已按回复流式推送的内容即为最终回复，无需再次请求大模型或重发
+                    final_response = thinking_content
+                    print(f"💬 当前内容为最终回复，长度: {len(final_response)}")
 
-                    # 发送最终回复开始信号
-                    yield {
-                        "type": "ai_response_start",  
-                        "content": "AI正在回复..."
-                    }
-
-                    # 重新流式生成回复（因为上面已经用ainvoke获取了思考内容）
-                    final_response = ""
-                    async for chunk in self.llm.astream(messages):
-                        if hasattr(chunk, 'content') and chunk.content:
-                            content = chunk.content
-                            final_response += content
+                    if not responded:
+                        # 本轮没有内容，或内容已作为思考推送（出现过未能解析的工具调用片段）
+                        yield {
+                            "type": "ai_response_start",
+                            "content": "AI正在回复...",
+                            "iteration": iteration
+                        }
+                        if final_response:
                             yield {
                                 "type": "ai_response_chunk",
-                                "content": content
+                                "content": final_response,
+                                "iteration": iteration
                             }
 
                     yield {
                         "type": "ai_response_end",
-                        "content": final_response
+                        "length": len(final_response)
                     }
 
                     return
@@ -413,6 +683,266 @@ class WebMCPAgent:
                 "content": f"处理请求时出错: {str(e)}"
             }
 
+    def _get_tool_timeout(self, server_name: str, tool_name: str) -> float:
+        """工具调用超时：tool_timeouts 中的单工具配置 > 服务器 tool_timeout > MCP_TOOL_TIMEOUT"""
+        options = self.server_options.get(server_name, {})
+        timeout = (options.get("tool_timeouts") or {}).get(tool_name, options.get("tool_timeout", self.tool_timeout))
+        try:
+            return max(0.1, float(timeout))
+        except Exception:
+            return self.tool_timeout
+
+    def _get_breaker(self, server_name: str) -> CircuitBreaker:
+        """获取服务器的熔断器（按需创建）"""
+        breaker = self._breakers.get(server_name)
+        if breaker is None:
+            options = self.server_options.get(server_name, {}).get("circuit_breaker") or {}
+            try:
+                threshold = int(options.get("failure_threshold", self.breaker_threshold))
+                recovery = float(options.get("recovery_timeout", self.breaker_recovery))
+            except Exception:
+                threshold, recovery = self.breaker_threshold, self.breaker_recovery
+            breaker = CircuitBreaker(server_name, failure_threshold=threshold, recovery_timeout=recovery)
+            self._breakers[server_name] = breaker
+        return breaker
+
+    def get_breaker_states(self) -> Dict[str, Dict[str, Any]]:
+        """各服务器的熔断器状态（未发生过调用的服务器视为关闭）"""
+        return {
+            server_name: self._get_breaker(server_name).snapshot()
+            for server_name in self.server_configs
+        }
+
+    def _get_server_semaphore(self, server_name: str) -> asyncio.Semaphore:
+        """获取服务器的并发限制信号量（按需创建）"""
+        semaphore = self._server_semaphores.get(server_name)
+        if semaphore is None:
+            options = self.server_options.get(server_name, {})
+            try:
+                limit = max(1, int(options.get("max_concurrency", self.tool_concurrency)))
+            except Exception:
+                limit = self.tool_concurrency
+            semaphore = asyncio.Semaphore(limit)
+            self._server_semaphores[server_name] = semaphore
+        return semaphore
+
+    async def _stream_round(self, llm, messages: List[Dict[str, Any]], iteration: int, result: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        """执行单轮流式推理
+
+        本轮尚未出现工具调用时，内容按最终回复实时推送（ai_response_start / ai_response_chunk）；
+        出现工具调用后本轮为工具调用轮：已推送的回复以 ai_response_retract 改为本轮的思考内容，
+        后续内容以 ai_thinking_chunk 推送。
+        本轮合并后的消息与完整文本写入 result["message"] / result["content"]，
+        result["responded"] 表示本轮内容是否已作为最终回复推送。
+        """
+        cache_key = None
+        if self.llm_cache.enabled:
+            cache_key = make_llm_cache_key(messages, self.model_name, self.temperature, self._tools_signature)
+            cached = self.llm_cache.get(cache_key)
+            if cached is not None:
+                # 按与实时流相同的事件协议回放，前端无需区分；缓存中已知是否有工具调用，无需先按回复推送
+                print(f"⚡ 第 {iteration} 轮命中大模型响应缓存")
+                content = cached["content"]
+                responded = bool(content) and not cached["tool_calls"]
+                if content:
+                    if responded:
+                        yield {"type": "ai_response_start", "content": "AI正在回复...", "iteration": iteration}
+                    else:
+                        yield {"type": "ai_thinking_start", "iteration": iteration}
+                    for start in range(0, len(content), LLM_CACHE_REPLAY_CHUNK):
+                        yield {
+                            "type": "ai_response_chunk" if responded else "ai_thinking_chunk",
+                            "content": content[start:start + LLM_CACHE_REPLAY_CHUNK],
+                            "iteration": iteration
+                        }
+                result["content"] = content
+                # 缓存中的工具调用ID来自首次响应，回放时重新分配，避免与同一会话或其他会话中的调用重复
+                tool_calls = [{**tool_call, "id": new_tool_call_id()} for tool_call in cached["tool_calls"]]
+                result["message"] = AIMessage(content=content, tool_calls=tool_calls)
+                result["responded"] = responded
+                return
+
+        responding = False
+        thinking_started = False
+        has_tool_calls = False
+        thinking_content = ""
+        response = None
+        async for chunk in llm.astream(messages):
+            # AIMessageChunk 支持相加，会自动合并 tool_call_chunks
+            response = chunk if response is None else response + chunk
+
+            if not has_tool_calls and getattr(chunk, 'tool_call_chunks', None):
+                has_tool_calls = True
+                if responding:
+                    # 本轮实为工具调用轮：已按回复推送的内容改为思考内容（客户端自行移动，不重发文本）
+                    responding = False
+                    thinking_started = True
+                    yield {"type": "ai_response_retract", "iteration": iteration}
+
+            if hasattr(chunk, 'content') and chunk.content:
+                content = chunk.content
+                thinking_content += content
+                if has_tool_calls:
+                    if not thinking_started:
+                        thinking_started = True
+                        yield {
+                            "type": "ai_thinking_start",
+                            "iteration": iteration
+                        }
+                    yield {
+                        "type": "ai_thinking_chunk",
+                        "content": content,
+                        "iteration": iteration
+                    }
+                else:
+                    if not responding:
+                        responding = True
+                        yield {
+                            "type": "ai_response_start",
+                            "content": "AI正在回复...",
+                            "iteration": iteration
+                        }
+                    yield {
+                        "type": "ai_response_chunk",
+                        "content": content,
+                        "iteration": iteration
+                    }
+
+        result["responded"] = responding
+        result["content"] = thinking_content
+        result["message"] = response
+
+        tool_calls = list(getattr(response, 'tool_calls', None) or [])
+        if cache_key and (thinking_content or tool_calls):
+            self.llm_cache.set(cache_key, thinking_content, [
+                {"name": tc['name'], "args": tc.get('args', {}), "id": tc.get('id')}
+                for tc in tool_calls
+            ])
+
+    async def _run_tool_call(self, index: int, total: int, tool_call: Dict[str, Any], events: asyncio.Queue) -> str:
+        """执行单个工具调用，并将 tool_start/tool_end/tool_error 事件写入队列"""
+        tool_name = tool_call['name']
+        tool_args = tool_call.get('args', {})
+        tool_id = tool_call['id']
+        start_event = {
+            "type": "tool_start",
+            "tool_id": tool_id,
+            "tool_name": tool_name,
+            "tool_args": tool_args,
+            "progress": f"{index}/{total}"
+        }
+
+        # 通过注册表索引查找对应的工具
+        target_tool = self.registry.get(tool_name)
+
+        if target_tool is None:
+            error_msg = f"工具 '{tool_name}' 未找到"
+            print(f"❌ {error_msg}")
+            await events.put(start_event)
+            await events.put({
+                "type": "tool_error",
+                "tool_id": tool_id,
+                "error": error_msg
+            })
+            return f"错误: {error_msg}"
+
+        server_name = self.registry.server_of(tool_name) or ""
+        started = False
+
+        async def emit_start():
+            nonlocal started
+            if not started:
+                started = True
+                await events.put(start_event)
+
+        async def invoke():
+            # 熔断中的服务器直接失败，不占用并发名额
+            breaker = self._get_breaker(server_name)
+            breaker.before_call()
+            # 本次调用是否占用了半开状态的试探名额：在任何位置被取消（包括等待并发名额时）都要释放
+            probing = breaker.state == HALF_OPEN
+            try:
+                async with self._get_server_semaphore(server_name):
+                    print(f"🔧 执行工具 {index}/{total}: {tool_name}")
+                    await emit_start()
+                    timeout = self._get_tool_timeout(server_name, tool_name)
+                    try:
+                        result = await asyncio.wait_for(target_tool.ainvoke(tool_args), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        breaker.record_failure(f"超时 ({timeout}s)")
+                        raise TimeoutError(f"工具 '{tool_name}' 执行超时（{timeout}秒），已取消")
+                    except Exception as e:
+                        breaker.record_failure(str(e))
+                        raise
+                    breaker.record_success()
+                    return result
+            except asyncio.CancelledError:
+                if probing:
+                    breaker.release_probe()
+                raise
+
+        cache_policy = self.tool_cache.resolve_policy(
+            self.server_options.get(server_name, {}).get("cache"), tool_name
+        )
+        source = "miss"
+        try:
+            if cache_policy:
+                tool_result, source = await self.tool_cache.call(
+                    server_name, tool_name, tool_args, cache_policy, invoke
+                )
+            else:
+                tool_result = await invoke()
+            # 命中缓存时不会进入 invoke，此处补发开始事件
+            await emit_start()
+            print(f"✅ 工具执行完成: {tool_name}" + (" (缓存)" if source != "miss" else ""))
+        except CircuitOpenError as e:
+            error_msg = str(e)
+            print(f"🚫 {error_msg}")
+            await emit_start()
+            await events.put({
+                "type": "tool_error",
+                "tool_id": tool_id,
+                "error": error_msg,
+                "circuit_open": True
+            })
+            return f"错误: {error_msg}"
+        except Exception as e:
+            error_msg = f"工具执行出错: {e}"
+            print(f"❌ {error_msg}")
+            await emit_start()
+            await events.put({
+                "type": "tool_error",
+                "tool_id": tool_id,
+                "error": error_msg
+            })
+            return f"错误: {error_msg}"
+
+        # 推送工具执行结果：前端只收到预览，完整结果通过 full_result 交给调用方暂存
+        result_text = str(tool_result)
+        preview, truncated = preview_result(result_text)
+        await events.put({
+            "type": "tool_end",
+            "tool_id": tool_id,
+            "tool_name": tool_name,
+            "result": preview,
+            "result_size": len(result_text),
+            "truncated": truncated,
+            "cached": source != "miss",
+            "full_result": result_text
+        })
+        # 写入提示词的结果按上限截断
+        return prompt_result(result_text)
+
+    async def _run_tool_calls(self, tool_calls: List[Dict[str, Any]], events: asyncio.Queue) -> List[str]:
+        """并发执行一轮中的全部工具调用，结果按调用顺序返回，结束时写入 None 作为结束标记"""
+        try:
+            return await asyncio.gather(*(
+                self._run_tool_call(i, len(tool_calls), tool_call, events)
+                for i, tool_call in enumerate(tool_calls, 1)
+            ))
+        finally:
+            await events.put(None)
+
     def get_tools_info(self) -> Dict[str, Any]:
         """获取工具信息列表，按MCP服务器分组"""
         if not self.tools_by_server:
@@ -490,6 +1020,14 @@ class WebMCPAgent:
 
     async def close(self):
         """关闭连接"""
+        if self._watch_task:
+            self._watch_task.cancel()
+            self._watch_task = None
+        if self._revalidate_task:
+            self._revalidate_task.cancel()
+            self._revalidate_task = None
+        for task in list(self._late_discovery):
+            task.cancel()
         try:
             if self.mcp_client and hasattr(self.mcp_client, 'close'):
                 await self.mcp_client.close()
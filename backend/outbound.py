@@ -0,0 +1,287 @@
+# outbound.py
+"""
+WebSocket 连接的发送队列
+每个连接一个有界队列与一个发送任务，生成回复的协程只负责入队，不再等待慢速客户端；
+客户端跟不上时合并或丢弃状态类消息，内容类消息只排队不丢弃，长时间发不出去的连接会被断开；
+连续的同类型流式片段在一个时间 / 长度窗口内合并为一帧（微批），窗口可按连接协商
+"""
+
+import time
+import asyncio
+from collections import deque
+from typing import Dict, Any, Optional
+
+from fastapi import WebSocket
+
+from serializers import json_serializer
+from env import env_int, env_float
+
+# 可合并的状态类消息：队列中只保留同类型的最新一条，队列满时直接丢弃
+MERGEABLE_TYPES = frozenset({"status", "pong"})
+
+# 可微批的流式片段：与队尾同类型（且除 content、seq 外字段相同）的片段拼接到队尾
+BATCHABLE_TYPES = frozenset({"ai_thinking_chunk", "ai_response_chunk"})
+
+# WebSocket 关闭码：慢速消费者（1013 Try Again Later）、发送失败（1011 Internal Error）
+CLOSE_SLOW_CONSUMER = 1013
+CLOSE_SEND_FAILED = 1011
+
+
+class OutboundQueue:
+    """单个连接的有界发送队列"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_size: int = None,
+        send_timeout: float = None,
+        slow_timeout: float = None,
+        batch_ms: float = None,
+        batch_chars: int = None,
+        serializer=None
+    ):
+        """
+        Args:
+            websocket: 连接
+            max_size: 队列最多缓存的消息数
+            send_timeout: 单条消息的发送超时（秒），超时视为连接失效
+            slow_timeout: 队列满时内容类消息最多等待多少秒，超时后断开连接
+            batch_ms: 流式片段的合并窗口（毫秒），0 为不等待（队列积压时仍会合并）
+            batch_chars: 合并后单帧的最大字符数，达到后立即发送
+            serializer: 消息编码（serializers.py），二进制编码以 bytes 帧发送；默认 JSON
+        """
+        self.websocket = websocket
+        self.serializer = serializer or json_serializer
+        self.max_size = max(1, max_size if max_size is not None else env_int("WS_SEND_QUEUE_SIZE", 256))
+        self.send_timeout = max(0.1, send_timeout if send_timeout is not None else env_float("WS_SEND_TIMEOUT", 10))
+        self.slow_timeout = max(0.1, slow_timeout if slow_timeout is not None else env_float("WS_SLOW_CONSUMER_TIMEOUT", 15))
+
+        self._queue: deque = deque()
+        self._changed = asyncio.Condition()
+        self._writer: Optional[asyncio.Task] = None
+        self._sending = False
+        self._draining = False
+        self._tail_since = 0.0  # 队尾片段开始累积的时间
+        self.batch_ms = 0.0
+        self.batch_chars = 0
+        self.configure(
+            batch_ms if batch_ms is not None else env_float("WS_BATCH_MS", 16),
+            batch_chars if batch_chars is not None else env_int("WS_BATCH_MAX_CHARS", 8192)
+        )
+        self.closed = False
+        self.close_reason: Optional[str] = None
+
+        # 指标
+        self.enqueued = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.backpressure_waits = 0
+        self.max_depth = 0
+        self.send_ms_total = 0.0
+        self.max_send_ms = 0.0
+
+    def start(self):
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._run())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def configure(self, batch_ms: float = None, batch_chars: int = None) -> Dict[str, Any]:
+        """设置本连接的微批窗口，超出服务端上限（WS_BATCH_MAX_MS）的取上限，返回生效的值"""
+        if batch_ms is not None:
+            self.batch_ms = min(max(0.0, float(batch_ms)), max(0.0, env_float("WS_BATCH_MAX_MS", 100)))
+        if batch_chars is not None:
+            self.batch_chars = max(1, int(batch_chars))
+        return {"batch_ms": self.batch_ms, "batch_chars": self.batch_chars}
+
+    async def put(self, message: Dict[str, Any]) -> bool:
+        """放入一条消息；连接已关闭（或因过慢被断开）时返回 False"""
+        if self.closed:
+            return False
+        async with self._changed:
+            if message.get("type") in MERGEABLE_TYPES:
+                self._put_mergeable(message)
+                return True
+
+            while len(self._queue) >= self.max_size and not self.closed:
+                # 先腾出状态类消息占用的位置，仍然满时等待发送任务
+                if self._drop_mergeable():
+                    continue
+                self.backpressure_waits += 1
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: len(self._queue) < self.max_size or self.closed),
+                        self.slow_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self._abort_nowait(f"客户端接收过慢，{self.slow_timeout:g} 秒内未能发送队列中的 {len(self._queue)} 条消息", CLOSE_SLOW_CONSUMER)
+            if self.closed:
+                return False
+            if message.get("type") in BATCHABLE_TYPES and self._coalesce(message):
+                return True
+            self._append(message)
+            return True
+
+    def _coalesce(self, message: Dict[str, Any]) -> bool:
+        """与队尾的同类片段合并；只合并到队尾，保证与其他消息的先后顺序不变"""
+        if not self._queue:
+            return False
+        tail = self._queue[-1]
+        if tail.get("type") != message.get("type"):
+            return False
+        content = tail.get("content") or ""
+        addition = message.get("content") or ""
+        if len(content) + len(addition) > self.batch_chars:
+            return False
+        if any(tail.get(key) != value for key, value in message.items() if key not in ("content", "seq")):
+            return False
+        # 生成新的字典，不修改调用方仍持有的消息；合并后的帧带最后一个片段的序号
+        merged = {**tail, "content": content + addition}
+        if "seq" in message:
+            merged["seq"] = message["seq"]
+        self._queue[-1] = merged
+        self.coalesced += 1
+        self._changed.notify_all()
+        return True
+
+    def _holding_batch(self) -> bool:
+        """队列中只有一个未满的流式片段时，发送任务在窗口内等待后续片段"""
+        if len(self._queue) != 1 or self.closed or self._draining or self.batch_ms <= 0:
+            return False
+        head = self._queue[0]
+        return head.get("type") in BATCHABLE_TYPES and len(head.get("content") or "") < self.batch_chars
+
+    def _put_mergeable(self, message: Dict[str, Any]):
+        for index in range(len(self._queue) - 1, -1, -1):
+            if self._queue[index].get("type") == message.get("type"):
+                self._queue[index] = message
+                self.merged += 1
+                return
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return
+        self._append(message)
+
+    def _drop_mergeable(self) -> bool:
+        for index, queued in enumerate(self._queue):
+            if queued.get("type") in MERGEABLE_TYPES:
+                del self._queue[index]
+                self.dropped += 1
+                return True
+        return False
+
+    def _append(self, message: Dict[str, Any]):
+        self._queue.append(message)
+        self._tail_since = time.monotonic()
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._changed.notify_all()
+
+    async def _run(self):
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._queue or self.closed)
+                if self.closed:
+                    return
+                if self._holding_batch():
+                    remaining = self._tail_since + self.batch_ms / 1000 - time.monotonic()
+                    if remaining > 0:
+                        try:
+                            await asyncio.wait_for(self._changed.wait_for(lambda: not self._holding_batch()), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                    if self.closed:
+                        return
+                message = self._queue.popleft()
+                self._sending = True
+                self._changed.notify_all()
+
+            started = time.perf_counter()
+            try:
+                payload = self.serializer.dumps(message)
+                if self.serializer.binary:
+                    await asyncio.wait_for(self.websocket.send_bytes(payload), self.send_timeout)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(payload), self.send_timeout)
+            except asyncio.TimeoutError:
+                await self.abort(f"发送超时（{self.send_timeout:g} 秒）", CLOSE_SLOW_CONSUMER)
+                return
+            except Exception as e:
+                await self.abort(f"发送失败: {e}", CLOSE_SEND_FAILED)
+                return
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            async with self._changed:
+                self._sending = False
+                self._changed.notify_all()
+            self.sent += 1
+            self.send_ms_total += elapsed_ms
+            self.max_send_ms = max(self.max_send_ms, elapsed_ms)
+
+    def _abort_nowait(self, reason: str, code: int):
+        """在持有条件锁时标记关闭，实际关闭连接交给后台任务"""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_reason = reason
+        self._changed.notify_all()
+        print(f"⚠️ 断开WebSocket连接: {reason}")
+        asyncio.create_task(self._close_socket(code))
+
+    async def abort(self, reason: str, code: int = CLOSE_SEND_FAILED):
+        """丢弃未发送的消息并关闭连接"""
+        async with self._changed:
+            self._abort_nowait(reason, code)
+
+    async def _close_socket(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), self.send_timeout)
+        except Exception:
+            pass
+
+    async def close(self, drain_timeout: float = 2.0):
+        """连接结束时调用：在限定时间内发送剩余消息，然后停止发送任务"""
+        if not self.closed and (self._queue or self._sending):
+            try:
+                async with self._changed:
+                    # 不再等待合并窗口，立即发出剩余消息
+                    self._draining = True
+                    self._changed.notify_all()
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: not (self._queue or self._sending) or self.closed), drain_timeout
+                    )
+            except asyncio.TimeoutError:
+                pass
+        async with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "capacity": self.max_size,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "merged": self.merged,
+            "coalesced": self.coalesced,
+            "batch_ms": self.batch_ms,
+            "batch_chars": self.batch_chars,
+            "dropped": self.dropped,
+            "backpressure_waits": self.backpressure_waits,
+            "avg_send_ms": round(self.send_ms_total / self.sent, 3) if self.sent else 0.0,
+            "max_send_ms": round(self.max_send_ms, 3),
+            "encoding": self.serializer.name,
+            "closed": self.closed,
+            "close_reason": self.close_reason
+        }
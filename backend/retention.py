@@ -0,0 +1,274 @@
+# retention.py
+"""
+聊天记录的保留策略与归档
+按会话最近活跃时间、会话数量和数据库总大小挑选过期会话，整段写入只追加的压缩归档文件后从数据库删除；
+删除产生的空闲页由后台按小批次增量回收，每批只短暂占用写连接，不阻塞正常写入
+"""
+
+import os
+import gzip
+import json
+import time
+import asyncio
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+
+from database import decode_cursor, encode_cursor
+from env import env_int, env_float
+
+
+def page_records(
+    records: List[Dict[str, Any]],
+    limit: int,
+    before: str = None,
+    after: str = None
+) -> Dict[str, Any]:
+    """在内存中按 (created_at, id) 游标分页，返回结构同 ChatDatabase.get_history_page"""
+    keyed = sorted(records, key=lambda r: (r["created_at"] or "", r["id"]))
+    if before:
+        before_key = tuple(decode_cursor(before))
+        keyed = [r for r in keyed if (r["created_at"] or "", r["id"]) < before_key]
+    if after:
+        after_key = tuple(decode_cursor(after))
+        keyed = [r for r in keyed if (r["created_at"] or "", r["id"]) > after_key]
+        page, has_more = keyed[:limit], len(keyed) > limit
+    else:
+        page, has_more = keyed[-limit:], len(keyed) > limit
+    return {
+        "records": page,
+        "before": encode_cursor(page[0]) if page else before,
+        "after": encode_cursor(page[-1]) if page else after,
+        "has_more": has_more
+    }
+
+
+class RetentionManager:
+    """定期归档过期会话并增量回收数据库空间"""
+
+    def __init__(
+        self,
+        db,
+        archive_dir: str = None,
+        max_age_days: float = None,
+        max_sessions: int = None,
+        max_db_mb: float = None,
+        min_idle_hours: float = None,
+        interval: float = None
+    ):
+        """
+        Args:
+            db: ChatDatabase 实例
+            archive_dir: 归档文件目录
+            max_age_days: 超过该天数未活跃的会话归档，0 表示不按时间归档
+            max_sessions: 只在数据库中保留最近活跃的这么多个会话，0 表示不限制
+            max_db_mb: 数据库已用空间上限（MB），超出时从最久未活跃的会话开始归档，0 表示不限制
+            min_idle_hours: 最近这段时间内活跃过的会话不归档
+            interval: 两次检查的间隔秒数
+        """
+        self.db = db
+        default_dir = Path(__file__).parent / "archive"
+        self.archive_dir = Path(archive_dir or os.getenv("CHAT_ARCHIVE_DIR", "") or default_dir)
+        if not self.archive_dir.is_absolute():
+            self.archive_dir = Path(__file__).parent / self.archive_dir
+        self.max_age_days = max_age_days if max_age_days is not None else env_float("RETENTION_MAX_AGE_DAYS", 0)
+        self.max_sessions = max_sessions if max_sessions is not None else env_int("RETENTION_MAX_SESSIONS", 0)
+        self.max_db_mb = max_db_mb if max_db_mb is not None else env_float("RETENTION_MAX_DB_MB", 0)
+        self.min_idle_hours = min_idle_hours if min_idle_hours is not None else env_float("RETENTION_MIN_IDLE_HOURS", 24)
+        self.interval = max(1.0, interval if interval is not None else env_float("RETENTION_INTERVAL", 3600))
+        # 增量回收：每批回收的页数与批次间隔
+        self.vacuum_pages = max(1, env_int("RETENTION_VACUUM_PAGES", 256))
+        self.vacuum_pause = max(0.0, env_float("RETENTION_VACUUM_PAUSE_MS", 20) / 1000)
+
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        # 归档文件只追加，同一时间只有一个写入者
+        self._file_lock = asyncio.Lock()
+
+        # 指标
+        self.runs = 0
+        self.sessions_archived = 0
+        self.records_archived = 0
+        self.archive_bytes = 0
+        self.pages_reclaimed = 0
+        self.failed = 0
+        self.last_run: Optional[str] = None
+        self.last_run_ms = 0.0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_days > 0 or self.max_sessions > 0 or self.max_db_mb > 0
+
+    def start(self):
+        """启动后台任务；未配置任何保留策略时只做增量回收"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"❌ 保留策略执行失败: {e}")
+
+    async def run_once(self) -> Dict[str, Any]:
+        """执行一次归档与空间回收，返回本次的归档会话数、记录数与回收页数"""
+        async with self._lock:
+            started = time.perf_counter()
+            sessions = records = 0
+            if self.enabled:
+                candidates = await self.db.get_expired_sessions(
+                    max_age_days=self.max_age_days,
+                    max_sessions=self.max_sessions,
+                    min_idle_hours=self.min_idle_hours,
+                    limit=1000
+                )
+                for session_id in candidates:
+                    archived = await self._archive_one(session_id)
+                    sessions += 1 if archived else 0
+                    records += archived
+                if self.max_db_mb > 0:
+                    s, r = await self._archive_for_size()
+                    sessions += s
+                    records += r
+            pages = await self.vacuum()
+
+            self.runs += 1
+            self.last_run = datetime.now().isoformat()
+            self.last_run_ms = (time.perf_counter() - started) * 1000
+            if sessions or pages:
+                print(f"🗄️ 保留策略: 归档 {sessions} 个会话 ({records} 条记录)，回收 {pages} 个空闲页")
+            return {"sessions": sessions, "records": records, "pages_reclaimed": pages}
+
+    async def _archive_for_size(self) -> Tuple[int, int]:
+        """已用空间超过上限时，从最久未活跃的会话开始归档"""
+        limit_bytes = self.max_db_mb * 1024 * 1024
+        sessions = records = 0
+        skipped = set()
+        while (await self.db.get_storage_info())["used_bytes"] > limit_bytes:
+            candidates = await self.db.get_oldest_sessions(min_idle_hours=self.min_idle_hours, limit=len(skipped) + 1)
+            candidates = [s for s in candidates if s not in skipped]
+            if not candidates:
+                print(f"⚠️ 数据库已用空间超过 {self.max_db_mb}MB，但没有可归档的会话")
+                break
+            archived = await self._archive_one(candidates[0])
+            if archived:
+                sessions += 1
+                records += archived
+            else:
+                # 归档失败的会话本轮不再重试
+                skipped.add(candidates[0])
+        return sessions, records
+
+    async def vacuum(self) -> int:
+        """分批回收空闲页，批次之间让出写连接"""
+        total = 0
+        while True:
+            reclaimed = await self.db.incremental_vacuum(self.vacuum_pages)
+            total += reclaimed
+            if reclaimed < self.vacuum_pages:
+                break
+            await asyncio.sleep(self.vacuum_pause)
+        self.pages_reclaimed += total
+        return total
+
+    async def _archive_one(self, session_id: str) -> int:
+        """归档单个会话，返回归档的记录数（失败时为 0）"""
+        try:
+            records = await self.db.export_session(session_id)
+            if not records:
+                return 0
+            max_record_id = max(r["id"] for r in records)
+            # 再次归档的会话：合并先前归档的记录，索引始终指向包含全部历史的最新成员
+            previous = await self.load_session(session_id)
+            if previous:
+                records = previous + records
+            entry = await self._append(session_id, records)
+            deleted = await self.db.archive_session(session_id, entry, max_record_id)
+            self.sessions_archived += 1
+            self.records_archived += deleted
+            return deleted
+        except Exception as e:
+            self.failed += 1
+            self.last_error = str(e)
+            print(f"❌ 归档会话 {session_id} 失败: {e}")
+            return 0
+
+    async def _append(self, session_id: str, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """将会话记录压缩为一个 gzip 成员追加到当月的归档文件，返回其位置"""
+        payload = json.dumps({
+            "session_id": session_id,
+            "archived_at": datetime.now().isoformat(),
+            "records": records
+        }, ensure_ascii=False, default=str).encode("utf-8")
+        data = gzip.compress(payload)
+        file_name = f"chat_archive_{datetime.now():%Y%m}.gz"
+
+        def write() -> int:
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.archive_dir / file_name, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            return offset
+
+        async with self._file_lock:
+            offset = await asyncio.to_thread(write)
+        self.archive_bytes += len(data)
+        return {
+            "archive_file": file_name,
+            "offset": offset,
+            "length": len(data),
+            "record_count": len(records),
+            "first_record": records[0].get("created_at"),
+            "last_record": records[-1].get("created_at")
+        }
+
+    async def load_session(self, session_id: str) -> List[Dict[str, Any]]:
+        """读取会话已归档的记录（按时间正序），没有归档时返回空列表"""
+        entry = await self.db.get_archive_entry(session_id)
+        if entry is None:
+            return []
+
+        def read() -> bytes:
+            with open(self.archive_dir / entry["archive_file"], "rb") as f:
+                f.seek(entry["offset"])
+                return f.read(entry["length"])
+
+        data = await asyncio.to_thread(read)
+        return json.loads(gzip.decompress(data))["records"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_age_days": self.max_age_days,
+            "max_sessions": self.max_sessions,
+            "max_db_mb": self.max_db_mb,
+            "min_idle_hours": self.min_idle_hours,
+            "interval": self.interval,
+            "archive_dir": str(self.archive_dir),
+            "runs": self.runs,
+            "sessions_archived": self.sessions_archived,
+            "records_archived": self.records_archived,
+            "archive_bytes": self.archive_bytes,
+            "pages_reclaimed": self.pages_reclaimed,
+            "failed": self.failed,
+            "last_run": self.last_run,
+            "last_run_ms": round(self.last_run_ms, 2),
+            "last_error": self.last_error
+        }
@@ -0,0 +1,104 @@
+# search_index.py
+"""
+聊天记录全文检索的文本处理
+SQLite FTS5 的 unicode61 分词器不会切分连续的中日韩文字，写入索引前在每个中日韩字符两侧补空格，
+使其按单字成词；查询时将关键词转换为相邻单字的短语查询
+索引不保存原文，摘要在检索时从结果页记录的原文中按关键词截取
+"""
+
+import re
+import html
+import hashlib
+from typing import Optional, Pattern
+
+_CJK = "⺀-鿿가-힯豈-﫿"
+_CJK_CHAR = re.compile(f"([{_CJK}])")
+# 非中日韩的词字符：英文等按整词匹配，需要词边界
+_WORD_CHAR = rf"[^\W{_CJK}]"
+
+# 摘要的长度（字符）
+SNIPPET_CHARS = 80
+
+
+def session_token(session_id: str) -> str:
+    """会话ID映射为单个检索词，用于在索引内按会话过滤"""
+    return "s" + hashlib.md5((session_id or "").encode("utf-8")).hexdigest()
+
+
+def index_text(text: Optional[str]) -> str:
+    """写入索引前的文本处理"""
+    if not text:
+        return ""
+    return _CJK_CHAR.sub(r" \1 ", text)
+
+
+def build_match_query(query: str, session_id: str = None) -> Optional[str]:
+    """将用户输入转换为 FTS5 MATCH 表达式：按空白拆分为多个关键词，每个关键词作为短语，全部命中才算匹配
+
+    Args:
+        query: 用户输入的关键词
+        session_id: 指定时只匹配该会话的记录
+    """
+    phrases = []
+    for term in query.split():
+        padded = " ".join(index_text(term).split())
+        # 只含标点的关键词分词后为空，跳过
+        if not re.search(r"\w", padded):
+            continue
+        phrases.append('"' + padded.replace('"', '""') + '"')
+    if not phrases:
+        return None
+    match = "{user_input ai_response tool_results} : (" + " AND ".join(phrases) + ")"
+    if session_id:
+        match = f'session_key : "{session_token(session_id)}" AND ' + match
+    return match
+
+
+def snippet_pattern(query: str) -> Optional[Pattern]:
+    """与 build_match_query 对应的正则，用于在原文中定位命中位置：
+    关键词按分词结果逐词匹配，词之间允许空白或标点（与索引的短语匹配一致），不区分大小写
+    """
+    alternatives = []
+    for term in query.split():
+        tokens = re.findall(r"\w+", index_text(term))
+        if not tokens:
+            continue
+        parts = []
+        for token in tokens:
+            if _CJK_CHAR.fullmatch(token):
+                parts.append(re.escape(token))
+            else:
+                parts.append(f"(?<!{_WORD_CHAR}){re.escape(token)}(?!{_WORD_CHAR})")
+        alternatives.append(r"\W*".join(parts))
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+def build_snippet(text: Optional[str], pattern: Optional[Pattern]) -> Optional[str]:
+    """截取第一个命中位置附近的原文，转义HTML并将命中部分标记为 <mark>；没有命中时返回 None"""
+    if not text or pattern is None:
+        return None
+    first = pattern.search(text)
+    if first is None:
+        return None
+    start = max(0, first.start() - SNIPPET_CHARS // 4)
+    end = min(len(text), max(start + SNIPPET_CHARS, first.end()))
+    window = text[start:end]
+    parts = []
+    position = 0
+    for match in pattern.finditer(window):
+        if not match.group():
+            continue
+        parts.append(html.escape(window[position:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        position = match.end()
+    parts.append(html.escape(window[position:]))
+    return ("…" if start else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+def leading_snippet(text: Optional[str]) -> str:
+    """原文开头的一段（未能定位命中位置时使用）"""
+    if not text:
+        return ""
+    return html.escape(text[:SNIPPET_CHARS]) + ("…" if len(text) > SNIPPET_CHARS else "")
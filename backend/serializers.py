@@ -0,0 +1,143 @@
+# serializers.py
+"""
+WebSocket 消息与 REST 响应的序列化
+默认使用 orjson 编解码 JSON（未安装时退回标准库 json）；客户端可通过 WebSocket 子协议协商 MessagePack 二进制编码
+"""
+
+import os
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from fastapi.responses import JSONResponse
+
+# orjson、msgpack 为可选依赖
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# WebSocket 子协议名
+SUBPROTOCOL_JSON = "json"
+SUBPROTOCOL_MSGPACK = "msgpack"
+
+
+class MessageDecodeError(ValueError):
+    """客户端消息无法解码"""
+
+
+def _json_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class JSONSerializer:
+    """标准库 json"""
+
+    name = "json"
+    binary = False
+
+    def dumps(self, obj: Any) -> str:
+        return _json_dumps(obj)
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        return _json_dumps(obj).encode("utf-8")
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        try:
+            return json.loads(data)
+        except (ValueError, TypeError) as e:
+            raise MessageDecodeError(str(e)) from e
+
+
+class ORJSONSerializer(JSONSerializer):
+    """orjson：输出与 json.dumps(ensure_ascii=False) 等价的紧凑 JSON；orjson 不支持的值（如超过64位的整数）退回标准库"""
+
+    name = "orjson"
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().dumps_bytes(obj)
+
+    def dumps(self, obj: Any) -> str:
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise MessageDecodeError(str(e)) from e
+
+
+class MsgpackSerializer:
+    """MessagePack：二进制帧，体积更小，客户端需通过子协议 msgpack 协商"""
+
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, default=str)
+
+    dumps_bytes = dumps
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise MessageDecodeError(str(e)) from e
+
+
+def _default_json() -> JSONSerializer:
+    name = os.getenv("JSON_SERIALIZER", "orjson").strip().lower() or "orjson"
+    if name == "orjson" and orjson is None:
+        print("⚠️ 未安装 orjson，JSON 序列化改用标准库 json")
+        name = "json"
+    if name not in ("orjson", "json"):
+        print(f"⚠️ 未知的 JSON 序列化方式 {name}，改用 {'orjson' if orjson else 'json'}")
+        name = "orjson" if orjson else "json"
+    return ORJSONSerializer() if name == "orjson" else JSONSerializer()
+
+
+# 全局使用的 JSON 序列化器（WebSocket 默认编码、REST 响应、NDJSON 流）
+json_serializer = _default_json()
+
+
+def available_subprotocols() -> List[str]:
+    """服务端支持的子协议"""
+    return [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON] if msgpack is not None else [SUBPROTOCOL_JSON]
+
+
+def negotiate(requested: Optional[List[str]]) -> Tuple[Any, Optional[str]]:
+    """按客户端请求的子协议顺序选择编码，返回 (序列化器, 接受的子协议)；未请求子协议时使用 JSON"""
+    for protocol in requested or []:
+        if protocol == SUBPROTOCOL_MSGPACK and msgpack is not None:
+            return MsgpackSerializer(), SUBPROTOCOL_MSGPACK
+        if protocol == SUBPROTOCOL_JSON:
+            return json_serializer, SUBPROTOCOL_JSON
+    return json_serializer, None
+
+
+def dumps_line(obj: Any) -> str:
+    """NDJSON 的一行"""
+    return json_serializer.dumps(obj) + "\n"
+
+
+class FastJSONResponse(JSONResponse):
+    """使用全局 JSON 序列化器（默认 orjson）渲染的响应"""
+
+    def render(self, content: Any) -> bytes:
+        return json_serializer.dumps_bytes(content)
+
+
+def serializer_info() -> Dict[str, Any]:
+    return {
+        "json": json_serializer.name,
+        "subprotocols": available_subprotocols()
+    }
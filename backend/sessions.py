@@ -0,0 +1,114 @@
+# sessions.py
+"""
+可恢复的聊天会话
+会话的事件带递增序号并保留在有界的重放缓冲中；连接断开后会话在一段时间内保持（进行中的对话继续执行），
+客户端带上 session_id、服务端签发的 resume_token 与最后收到的序号重连，即可收到断线期间的事件，无需重新加载完整历史
+会话ID会出现在分享链接中，不能单独作为恢复凭证
+"""
+
+import re
+import hmac
+import time
+import secrets
+import asyncio
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+from fastapi import WebSocket
+
+from tool_results import ToolResultStore
+from env import env_int, env_float
+
+# 会话被新的连接接替时关闭旧连接使用的关闭码（4000-4999 为应用自定义）
+CLOSE_SESSION_REPLACED = 4000
+
+# 客户端提供的会话ID格式（服务端分配的 uuid4），不符合时无需查找
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+# 连接断开后会话保留的秒数，0 表示立即结束（取消进行中的对话）
+RESUME_TTL = max(0.0, env_float("WS_RESUME_TTL", 300))
+
+
+def valid_session_id(session_id: Optional[str]) -> bool:
+    return bool(session_id) and SESSION_ID_PATTERN.match(session_id) is not None
+
+
+class ReplayBuffer:
+    """为会话事件分配序号，保留最近的若干条用于断线重放"""
+
+    def __init__(self, max_events: int = None):
+        """
+        Args:
+            max_events: 最多保留的事件数，超出后丢弃最早的
+        """
+        self.max_events = max(1, max_events if max_events is not None else env_int("WS_REPLAY_EVENTS", 2000))
+        self._events: deque = deque(maxlen=self.max_events)
+        self.last_seq = 0
+
+    def stamp(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """返回带 seq 的新消息并放入缓冲（不修改调用方的字典）"""
+        self.last_seq += 1
+        event = {**message, "seq": self.last_seq}
+        self._events.append(event)
+        return event
+
+    @property
+    def first_seq(self) -> int:
+        """缓冲中最早的序号，空缓冲时为下一个将分配的序号"""
+        return self._events[0]["seq"] if self._events else self.last_seq + 1
+
+    def since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """序号大于 seq 的事件；其中一部分已被丢弃（无法完整重放）时返回 None"""
+        if seq >= self.last_seq:
+            return []
+        if seq + 1 < self.first_seq:
+            return None
+        return [event for event in self._events if event["seq"] > seq]
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+
+class ChatSession:
+    """一个会话的运行状态：重放缓冲、暂存的完整工具结果、对话轮次，以及当前绑定的连接"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        # 恢复令牌：只通过 session_info 发给建立会话的连接，重连时必须出示
+        self.resume_token = secrets.token_urlsafe(32)
+        self.replay = ReplayBuffer()
+        self.tool_results = ToolResultStore()
+        self.turns = None  # TurnRunner，由 main.py 创建
+        self.websocket: Optional[WebSocket] = None
+        self.detached_at: Optional[float] = None
+        self.expiry: Optional[asyncio.Task] = None
+        self.resumed = 0
+
+    @property
+    def attached(self) -> bool:
+        return self.websocket is not None
+
+    def check_token(self, token: Optional[str]) -> bool:
+        """常数时间比较恢复令牌"""
+        return bool(token) and hmac.compare_digest(token.encode("utf-8"), self.resume_token.encode("utf-8"))
+
+    def attach(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.detached_at = None
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+
+    def detach(self):
+        self.websocket = None
+        self.detached_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "last_seq": self.replay.last_seq,
+            "replay_events": len(self.replay),
+            "attached": self.attached,
+            "detached_seconds": round(time.monotonic() - self.detached_at, 1) if self.detached_at else None,
+            "resumed": self.resumed
+        }
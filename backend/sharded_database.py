@@ -0,0 +1,310 @@
+# sharded_database.py
+"""
+按会话分片的聊天记录存储
+会话按 session_id 的 CRC32 分配到 N 个独立的 SQLite 文件，每个分片有自己的写连接，不同分片的会话可以并行写入；
+各分片的自增ID起点相差 2^40，记录ID全局唯一，按ID即可定位分片。统计、全文检索等跨会话查询并发访问全部分片后合并
+"""
+
+import os
+import json
+import zlib
+import asyncio
+from pathlib import Path
+from collections import defaultdict
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+
+from storage import ChatStorage, PartialWriteError, TOOLS_FULL
+from database import ChatDatabase
+from compression import merge_codec_stats
+from env import env_int
+
+# 每个分片的ID区间大小（2^40），分片 i 的记录ID从 i << SHARD_ID_BITS 开始
+SHARD_ID_BITS = 40
+# 分片目录中记录分片数的文件，分片数改变后会话会被路由到错误的分片，启动时校验
+MANIFEST_FILE = "shards.json"
+
+
+def shard_index(session_id: str, shard_count: int) -> int:
+    """会话所在的分片（与进程无关的稳定哈希）"""
+    return zlib.crc32((session_id or "").encode("utf-8")) % shard_count
+
+
+def shard_path(shard_dir: Path, index: int) -> Path:
+    return shard_dir / f"chat_history_{index}.db"
+
+
+class ShardedChatDatabase(ChatStorage):
+    """将会话分散到多个 ChatDatabase 的存储"""
+
+    def __init__(self, shard_count: int = None, shard_dir: str = None):
+        """
+        Args:
+            shard_count: 分片数
+            shard_dir: 分片文件所在目录，相对路径相对于 backend 目录
+        """
+        if shard_count is None:
+            shard_count = env_int("CHAT_DB_SHARDS", 4)
+        self.shard_count = max(1, shard_count)
+        self.shard_dir = Path(shard_dir or os.getenv("CHAT_DB_SHARD_DIR", "") or "shards")
+        if not self.shard_dir.is_absolute():
+            self.shard_dir = Path(__file__).parent / self.shard_dir
+        self.shards = [
+            ChatDatabase(str(shard_path(self.shard_dir, i)), id_base=i << SHARD_ID_BITS)
+            for i in range(self.shard_count)
+        ]
+        print(f"🧩 分片存储: {self.shard_count} 个分片, 目录 {self.shard_dir}")
+
+    def shard_for(self, session_id: str) -> ChatDatabase:
+        return self.shards[shard_index(session_id, self.shard_count)]
+
+    def _shard_for_id(self, record_id: int) -> Optional[ChatDatabase]:
+        index = record_id >> SHARD_ID_BITS
+        return self.shards[index] if 0 <= index < self.shard_count else None
+
+    async def _fan_out(self, method: str, *args, **kwargs) -> list:
+        """在全部分片上并发调用同名方法，按分片顺序返回结果"""
+        return await asyncio.gather(*(getattr(shard, method)(*args, **kwargs) for shard in self.shards))
+
+    @property
+    def search_enabled(self) -> bool:
+        return all(shard.search_enabled for shard in self.shards)
+
+    # ─────────── 生命周期 ───────────
+
+    async def initialize(self) -> bool:
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self.shard_dir / MANIFEST_FILE
+        if manifest.exists():
+            try:
+                expected = json.loads(manifest.read_text(encoding="utf-8"))["shards"]
+            except Exception as e:
+                print(f"❌ 读取分片清单失败: {e}")
+                return False
+            if expected != self.shard_count:
+                print(f"❌ 分片数不一致：目录中为 {expected} 个分片，配置为 {self.shard_count} 个")
+                return False
+        results = await self._fan_out("initialize")
+        if not all(results):
+            await self.close()
+            return False
+        if not manifest.exists():
+            manifest.write_text(json.dumps({"shards": self.shard_count}), encoding="utf-8")
+        return True
+
+    async def close(self):
+        await self._fan_out("close")
+
+    # ─────────── 写入 ───────────
+
+    async def start_conversation(self, session_id: str = "default") -> int:
+        return await self.shard_for(session_id).start_conversation(session_id)
+
+    async def save_conversation(
+        self,
+        user_input: str,
+        mcp_tools_called: List[Dict[str, Any]] = None,
+        mcp_results: List[Dict[str, Any]] = None,
+        ai_response: str = "",
+        session_id: str = "default",
+        conversation_id: int = None
+    ) -> bool:
+        return await self.shard_for(session_id).save_conversation(
+            user_input, mcp_tools_called, mcp_results, ai_response, session_id, conversation_id
+        )
+
+    async def save_conversations(self, records: List[Dict[str, Any]]) -> int:
+        """按分片分组后并发提交，每个分片一个事务"""
+        if not records:
+            return 0
+        groups: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        for record in records:
+            groups[shard_index(record.get("session_id", "default"), self.shard_count)].append(record)
+        indexes = list(groups)
+        results = await asyncio.gather(
+            *(self.shards[i].save_conversations(groups[i]) for i in indexes), return_exceptions=True
+        )
+        failed: List[Dict[str, Any]] = []
+        error = None
+        for i, result in zip(indexes, results):
+            if isinstance(result, BaseException):
+                failed.extend(groups[i])
+                error = error or result
+        if failed:
+            raise PartialWriteError(failed, error)
+        return len(records)
+
+    # ─────────── 读取 ───────────
+
+    async def get_chat_history(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        conversation_id: int = None,
+        tools: str = TOOLS_FULL
+    ) -> List[Dict[str, Any]]:
+        return await self.shard_for(session_id).get_chat_history(session_id, limit, conversation_id, tools)
+
+    async def get_history_page(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        tools: str = TOOLS_FULL
+    ) -> Dict[str, Any]:
+        return await self.shard_for(session_id).get_history_page(session_id, limit, before, after, tools)
+
+    async def iter_history(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        batch_size: int = 100,
+        tools: str = TOOLS_FULL
+    ) -> AsyncIterator[Dict[str, Any]]:
+        async for record in self.shard_for(session_id).iter_history(session_id, limit, before, after, batch_size, tools):
+            yield record
+
+    async def get_tool_calls(self, record_id: int) -> List[Dict[str, Any]]:
+        shard = self._shard_for_id(record_id)
+        return await shard.get_tool_calls(record_id) if shard else []
+
+    async def get_tool_usage(self, days: int = 7, tool_name: str = None) -> List[Dict[str, Any]]:
+        """合并各分片按 (日期, 工具) 的统计，平均结果大小按调用次数加权"""
+        merged: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for rows in await self._fan_out("get_tool_usage", days, tool_name):
+            for row in rows:
+                key = (row["day"], row["tool_name"])
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = dict(row)
+                    continue
+                sizes = [(r["avg_result_size"], r["calls"]) for r in (current, row) if r["avg_result_size"] is not None]
+                current["avg_result_size"] = (
+                    int(sum(size * calls for size, calls in sizes) / sum(calls for _, calls in sizes)) if sizes else None
+                )
+                for field in ("calls", "failures", "unfinished"):
+                    current[field] = (current[field] or 0) + (row[field] or 0)
+        usage = sorted(merged.values(), key=lambda r: r["calls"], reverse=True)
+        usage.sort(key=lambda r: r["day"], reverse=True)
+        return usage
+
+    async def search(self, query: str, session_id: str = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """指定会话时只查询所在分片；否则每个分片取前 offset+limit 条，按得分合并后分页
+
+        各分片的 bm25 得分基于各自的词频统计，合并后的排序与单库略有差异
+        """
+        if session_id:
+            return await self.shard_for(session_id).search(query, session_id, limit, offset)
+        offset = max(0, offset)
+        pages = await self._fan_out("search", query, None, offset + limit, 0)
+        results = sorted((r for page in pages for r in page["results"]), key=lambda r: r["score"], reverse=True)
+        return {
+            "results": results[offset:offset + limit],
+            "has_more": len(results) > offset + limit or any(page["has_more"] for page in pages)
+        }
+
+    async def get_session_counts(self, session_id: str) -> Dict[str, int]:
+        return await self.shard_for(session_id).get_session_counts(session_id)
+
+    async def get_stats(self, recount: bool = False) -> Dict[str, Any]:
+        stats = await self._fan_out("get_stats", recount)
+        latest = [s.get("latest_record") for s in stats if s.get("latest_record")]
+        return {
+            "total_records": sum(s.get("total_records", 0) for s in stats),
+            "total_sessions": sum(s.get("total_sessions", 0) for s in stats),
+            "total_conversations": sum(s.get("total_conversations", 0) for s in stats),
+            "latest_record": max(latest) if latest else None,
+            "database_path": str(self.shard_dir),
+            "shards": [
+                {"path": s.get("database_path"), "records": s.get("total_records", 0), "sessions": s.get("total_sessions", 0)}
+                for s in stats
+            ]
+        }
+
+    async def recount_stats(self) -> bool:
+        return all(await self._fan_out("recount_stats"))
+
+    # ─────────── 删除 ───────────
+
+    async def clear_history(self, session_id: str = "default") -> bool:
+        return await self.shard_for(session_id).clear_history(session_id)
+
+    async def clear_all_history(self) -> bool:
+        return all(await self._fan_out("clear_all_history"))
+
+    # ─────────── 保留策略与归档 ───────────
+
+    async def get_expired_sessions(
+        self,
+        max_age_days: float = 0,
+        max_sessions: int = 0,
+        min_idle_hours: float = 0,
+        limit: int = 50
+    ) -> List[str]:
+        """会话按哈希均匀分布，会话数上限平均分配给各分片"""
+        per_shard = -(-max_sessions // self.shard_count) if max_sessions > 0 else 0
+        expired = await self._fan_out("get_expired_sessions", max_age_days, per_shard, min_idle_hours, limit)
+        return [session_id for sessions in expired for session_id in sessions][:limit]
+
+    async def get_session_activity(self, min_idle_hours: float = 0, limit: int = 20) -> List[Tuple[str, str]]:
+        activity = await self._fan_out("get_session_activity", min_idle_hours, limit)
+        return sorted((item for items in activity for item in items), key=lambda item: item[1] or "")[:limit]
+
+    async def get_storage_info(self) -> Dict[str, int]:
+        infos = await self._fan_out("get_storage_info")
+        merged = {key: sum(info[key] for info in infos) for key in infos[0]}
+        merged["page_size"] = infos[0]["page_size"]
+        return merged
+
+    async def export_session(self, session_id: str) -> List[Dict[str, Any]]:
+        return await self.shard_for(session_id).export_session(session_id)
+
+    async def archive_session(self, session_id: str, entry: Dict[str, Any], max_record_id: int) -> int:
+        return await self.shard_for(session_id).archive_session(session_id, entry, max_record_id)
+
+    async def get_archive_entry(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.shard_for(session_id).get_archive_entry(session_id)
+
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        return sum(await self._fan_out("incremental_vacuum", pages))
+
+    # ─────────── 文本压缩 ───────────
+
+    @property
+    def compression_enabled(self) -> bool:
+        return self.shards[0].compression_enabled
+
+    async def ensure_compression_dictionary(self, sample_limit: int = 2000):
+        await self._fan_out("ensure_compression_dictionary", sample_limit)
+
+    async def compress_batch(self, table: str, last_id: int, batch_size: int = 200) -> Optional[Tuple[int, int, int, int]]:
+        """按ID区间依次处理各分片：last_id 所在的分片处理完后转到下一个分片"""
+        for index in range(max(0, last_id >> SHARD_ID_BITS), self.shard_count):
+            progress = await self.shards[index].compress_batch(table, max(last_id, index << SHARD_ID_BITS), batch_size)
+            if progress is not None:
+                return progress
+        return None
+
+    async def get_compression_stats(self, scan: bool = False) -> Dict[str, Any]:
+        items = await self._fan_out("get_compression_stats", scan)
+        stats: Dict[str, Any] = {"codec": merge_codec_stats([item["codec"] for item in items])}
+        if scan:
+            columns: Dict[str, Dict[str, int]] = {}
+            for item in items:
+                for name, summary in item["columns"].items():
+                    target = columns.setdefault(name, {key: 0 for key in summary})
+                    for key, value in summary.items():
+                        target[key] += value
+            stats["columns"] = columns
+            stats["saved_bytes"] = sum(item["saved_bytes"] for item in items)
+            table_bytes: Optional[Dict[str, int]] = {}
+            for item in items:
+                if item.get("table_bytes") is None:
+                    table_bytes = None
+                    break
+                for name, size in item["table_bytes"].items():
+                    table_bytes[name] = table_bytes.get(name, 0) + size
+            stats["table_bytes"] = table_bytes
+        return stats
@@ -0,0 +1,169 @@
+# split_database.py
+"""
+将单文件的 chat_history.db 拆分为按会话分片的存储（见 sharded_database.py）
+用法: python split_database.py --shards 4 [--source chat_history.db] [--target shards]
+源数据库以只读方式打开（不做迁移，表结构须为最新版本）；记录与工具调用的ID加上分片的ID起点，归档索引一并复制；全文索引不保存原文，无法复制，由分片首次启动时重建
+"""
+
+import asyncio
+import argparse
+import sqlite3
+from pathlib import Path
+
+from database import SCHEMA_VERSION
+from sharded_database import ShardedChatDatabase, SHARD_ID_BITS, shard_index, shard_path
+
+# 按表复制的语句，:base 为分片的ID起点，temp.split_sessions 为属于该分片的会话
+COPY_STATEMENTS = (
+    """
+    INSERT OR IGNORE INTO chat_compression_dicts (id, data, created_at)
+    SELECT id, data, created_at FROM src.chat_compression_dicts
+    """,
+    """
+    INSERT INTO chat_sessions (session_id, last_conversation_id, created_at, updated_at)
+    SELECT session_id, last_conversation_id, created_at, updated_at FROM src.chat_sessions
+    WHERE session_id IN (SELECT session_id FROM temp.split_sessions)
+    """,
+    """
+    INSERT INTO chat_records (
+        id, session_id, conversation_id, user_input, user_timestamp,
+        mcp_tools_called, mcp_results, ai_response, ai_timestamp, created_at
+    )
+    SELECT id + :base, session_id, conversation_id, user_input, user_timestamp,
+           mcp_tools_called, mcp_results, ai_response, ai_timestamp, created_at
+    FROM src.chat_records
+    WHERE session_id IN (SELECT session_id FROM temp.split_sessions)
+    ORDER BY id
+    """,
+    """
+    INSERT INTO chat_tool_calls (
+        id, record_id, session_id, position, tool_id, tool_name, tool_args,
+        progress, success, error, result_size, created_at
+    )
+    SELECT id + :base, record_id + :base, session_id, position, tool_id, tool_name, tool_args,
+           progress, success, error, result_size, created_at
+    FROM src.chat_tool_calls
+    WHERE session_id IN (SELECT session_id FROM temp.split_sessions)
+    ORDER BY id
+    """,
+    """
+    INSERT INTO chat_tool_results (call_id, result)
+    SELECT r.call_id + :base, r.result
+    FROM src.chat_tool_results r JOIN src.chat_tool_calls c ON c.id = r.call_id
+    WHERE c.session_id IN (SELECT session_id FROM temp.split_sessions)
+    """,
+    """
+    INSERT INTO chat_archive (
+        session_id, archive_file, offset, length, record_count, first_record, last_record, archived_at
+    )
+    SELECT session_id, archive_file, offset, length, record_count, first_record, last_record, archived_at
+    FROM src.chat_archive
+    WHERE session_id IN (SELECT session_id FROM temp.split_sessions)
+    """,
+)
+
+
+def _has_table(conn: sqlite3.Connection, schema: str, name: str) -> bool:
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def _source_uri(source: Path) -> str:
+    """源数据库的只读URI，拆分过程不会修改源库"""
+    return f"{source.resolve().as_uri()}?mode=ro"
+
+
+def _copy_shard(source: Path, target: Path, base: int, sessions: list) -> int:
+    """将属于一个分片的会话复制到分片文件，返回复制的记录数"""
+    conn = sqlite3.connect(str(target), isolation_level=None, uri=True)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (_source_uri(source),))
+        conn.execute("CREATE TEMP TABLE split_sessions (session_id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT INTO temp.split_sessions VALUES (?)", [(s,) for s in sessions])
+        conn.execute("BEGIN")
+        for statement in COPY_STATEMENTS:
+            conn.execute(statement, {"base": base})
+        if _has_table(conn, "main", "chat_search"):
+            # 删除分片中的空索引，重新打开时为复制的记录重建
+            conn.execute("DROP TABLE chat_search")
+        conn.execute("COMMIT")
+        return conn.execute("SELECT COUNT(*) FROM chat_records").fetchone()[0]
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+async def split(source: Path, target: Path, shard_count: int):
+    conn = sqlite3.connect(_source_uri(source), uri=True)
+    try:
+        # 不在此处迁移源库：旧版本的源库需先用当前版本启动一次服务完成升级
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise SystemExit(
+                f"源数据库表结构版本为 {version}，需要 {SCHEMA_VERSION}：请先用当前版本启动一次服务完成升级（建议先备份）"
+            )
+        sessions = [row[0] for row in conn.execute("""
+            SELECT session_id FROM chat_sessions
+            UNION SELECT session_id FROM chat_records
+            UNION SELECT session_id FROM chat_archive
+        """)]
+        source_records = conn.execute("SELECT COUNT(*) FROM chat_records").fetchone()[0]
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_tool_calls").fetchone()[0]
+        max_id = max(max_id, conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_records").fetchone()[0])
+    finally:
+        conn.close()
+    if max_id >= 1 << SHARD_ID_BITS:
+        raise SystemExit("源数据库的ID超出单个分片的ID区间，无法拆分")
+
+    storage = ShardedChatDatabase(shard_count, str(target))
+    if not await storage.initialize():
+        raise SystemExit("无法初始化分片存储（分片数与已有分片不一致？）")
+    existing = (await storage.get_stats()).get("total_records", 0)
+    await storage.close()
+    if existing:
+        raise SystemExit(f"目标目录 {target} 中已有 {existing} 条记录，请使用空目录")
+
+    groups = [[] for _ in range(shard_count)]
+    for session_id in sessions:
+        groups[shard_index(session_id, shard_count)].append(session_id)
+
+    copied = 0
+    for index, group in enumerate(groups):
+        count = await asyncio.to_thread(_copy_shard, source, shard_path(storage.shard_dir, index), index << SHARD_ID_BITS, group)
+        copied += count
+        print(f"📦 分片 {index}: {len(group)} 个会话, {count} 条记录")
+
+    # 重新打开以校验统计并重建缺失的全文索引
+    storage = ShardedChatDatabase(shard_count, str(target))
+    if not await storage.initialize():
+        raise SystemExit("拆分后的分片无法打开")
+    stats = await storage.get_stats(recount=True)
+    await storage.close()
+    if stats["total_records"] != source_records or copied != source_records:
+        raise SystemExit(f"❌ 记录数不一致：源库 {source_records} 条，分片共 {stats['total_records']} 条")
+    print(f"✅ 拆分完成: {source_records} 条记录, {len(sessions)} 个会话 → {shard_count} 个分片 ({storage.shard_dir})")
+    default_dir = Path(__file__).parent / "shards"
+    print(f"   启动前设置 CHAT_DB_SHARDS={shard_count}" + (f" CHAT_DB_SHARD_DIR={target}" if target != default_dir else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将 chat_history.db 按会话拆分为多个分片")
+    parser.add_argument("--shards", type=int, required=True, help="分片数（至少2）")
+    parser.add_argument("--source", default="chat_history.db", help="源数据库，相对路径相对于 backend 目录")
+    parser.add_argument("--target", default="shards", help="分片目录，相对路径相对于 backend 目录")
+    args = parser.parse_args()
+    if args.shards < 2:
+        parser.error("--shards 至少为 2")
+
+    backend_dir = Path(__file__).parent
+    source = Path(args.source) if Path(args.source).is_absolute() else backend_dir / args.source
+    if not source.exists():
+        parser.error(f"源数据库不存在: {source}")
+    target = Path(args.target) if Path(args.target).is_absolute() else backend_dir / args.target
+    asyncio.run(split(source, target, args.shards))
+
+
+if __name__ == "__main__":
+    main()
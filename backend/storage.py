@@ -0,0 +1,188 @@
+# storage.py
+"""
+聊天记录存储接口
+ChatDatabase（单个SQLite文件）与 ShardedChatDatabase（按会话分片到多个SQLite文件）实现同一组方法，
+main.py、写回队列、保留策略与后台压缩只依赖这里列出的方法
+"""
+
+from abc import ABC, abstractmethod
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+
+# 读取历史记录时工具数据的加载方式：full 调用与结果、calls 只加载调用（不含结果正文）、none 不加载
+TOOLS_FULL = "full"
+TOOLS_CALLS = "calls"
+TOOLS_NONE = "none"
+TOOL_LOAD_MODES = (TOOLS_FULL, TOOLS_CALLS, TOOLS_NONE)
+
+
+class PartialWriteError(Exception):
+    """批量写入只有部分记录提交成功（分片存储中部分分片失败）"""
+
+    def __init__(self, failed: List[Dict[str, Any]], error: Exception):
+        self.failed = failed
+        self.error = error
+        super().__init__(f"{len(failed)} 条记录写入失败: {error}")
+
+
+class ChatStorage(ABC):
+    """聊天记录存储"""
+
+    # ─────────── 生命周期 ───────────
+
+    @abstractmethod
+    async def initialize(self) -> bool:
+        """打开连接并初始化表结构，失败时返回 False"""
+
+    @abstractmethod
+    async def close(self):
+        """关闭全部连接"""
+
+    # ─────────── 写入 ───────────
+
+    @abstractmethod
+    async def start_conversation(self, session_id: str = "default") -> int:
+        """分配并返回会话的下一个 conversation_id"""
+
+    @abstractmethod
+    async def save_conversation(
+        self,
+        user_input: str,
+        mcp_tools_called: List[Dict[str, Any]] = None,
+        mcp_results: List[Dict[str, Any]] = None,
+        ai_response: str = "",
+        session_id: str = "default",
+        conversation_id: int = None
+    ) -> bool:
+        """保存一条对话记录"""
+
+    @abstractmethod
+    async def save_conversations(self, records: List[Dict[str, Any]]) -> int:
+        """批量保存对话记录；失败时抛出异常（部分成功时为 PartialWriteError）"""
+
+    # ─────────── 读取 ───────────
+
+    @abstractmethod
+    async def get_chat_history(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        conversation_id: int = None,
+        tools: str = TOOLS_FULL
+    ) -> List[Dict[str, Any]]:
+        """会话最近的记录（未指定 conversation_id 时最新的在前）"""
+
+    @abstractmethod
+    async def get_history_page(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        tools: str = TOOLS_FULL
+    ) -> Dict[str, Any]:
+        """按 (created_at, id) 游标分页读取会话记录"""
+
+    @abstractmethod
+    def iter_history(
+        self,
+        session_id: str = "default",
+        limit: int = 50,
+        before: str = None,
+        after: str = None,
+        batch_size: int = 100,
+        tools: str = TOOLS_FULL
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """与 get_history_page 相同的范围，按时间正序分批产出记录"""
+
+    @abstractmethod
+    async def get_tool_calls(self, record_id: int) -> List[Dict[str, Any]]:
+        """单条记录的工具调用及完整结果"""
+
+    @abstractmethod
+    async def get_tool_usage(self, days: int = 7, tool_name: str = None) -> List[Dict[str, Any]]:
+        """按天、按工具统计调用与失败次数"""
+
+    @abstractmethod
+    async def search(self, query: str, session_id: str = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """全文检索，按相关度排序"""
+
+    @abstractmethod
+    async def get_session_counts(self, session_id: str) -> Dict[str, int]:
+        """会话的记录数与对话数"""
+
+    @abstractmethod
+    async def get_stats(self, recount: bool = False) -> Dict[str, Any]:
+        """总记录数、会话数、对话数等统计"""
+
+    @abstractmethod
+    async def recount_stats(self) -> bool:
+        """全量重新统计"""
+
+    # ─────────── 删除 ───────────
+
+    @abstractmethod
+    async def clear_history(self, session_id: str = "default") -> bool:
+        """清空指定会话"""
+
+    @abstractmethod
+    async def clear_all_history(self) -> bool:
+        """清空所有会话"""
+
+    # ─────────── 保留策略与归档（retention.py） ───────────
+
+    @abstractmethod
+    async def get_expired_sessions(
+        self,
+        max_age_days: float = 0,
+        max_sessions: int = 0,
+        min_idle_hours: float = 0,
+        limit: int = 50
+    ) -> List[str]:
+        """按保留策略挑选需要归档的会话"""
+
+    @abstractmethod
+    async def get_session_activity(self, min_idle_hours: float = 0, limit: int = 20) -> List[Tuple[str, str]]:
+        """最久未活跃且仍有记录的会话 [(session_id, updated_at)]，最早的在前"""
+
+    async def get_oldest_sessions(self, min_idle_hours: float = 0, limit: int = 20) -> List[str]:
+        """最久未活跃的会话，用于按总大小归档"""
+        return [session_id for session_id, _ in await self.get_session_activity(min_idle_hours, limit)]
+
+    @abstractmethod
+    async def get_storage_info(self) -> Dict[str, int]:
+        """数据库页使用情况（字节）"""
+
+    @abstractmethod
+    async def export_session(self, session_id: str) -> List[Dict[str, Any]]:
+        """会话的全部记录（含工具调用与结果），按时间正序"""
+
+    @abstractmethod
+    async def archive_session(self, session_id: str, entry: Dict[str, Any], max_record_id: int) -> int:
+        """登记归档位置并删除已归档的记录，返回删除的记录数"""
+
+    @abstractmethod
+    async def get_archive_entry(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """会话的归档位置"""
+
+    @abstractmethod
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        """回收一批空闲页，返回回收的页数"""
+
+    # ─────────── 文本压缩（compression.py） ───────────
+
+    @property
+    @abstractmethod
+    def compression_enabled(self) -> bool:
+        """写入时是否压缩大文本"""
+
+    @abstractmethod
+    async def ensure_compression_dictionary(self, sample_limit: int = 2000):
+        """按需训练 zstd 字典"""
+
+    @abstractmethod
+    async def compress_batch(self, table: str, last_id: int, batch_size: int = 200) -> Optional[Tuple[int, int, int, int]]:
+        """压缩一批未压缩的旧数据，没有剩余数据时返回 None"""
+
+    @abstractmethod
+    async def get_compression_stats(self, scan: bool = False) -> Dict[str, Any]:
+        """压缩指标"""
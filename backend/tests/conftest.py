@@ -0,0 +1,7 @@
+# conftest.py
+"""测试从 backend 目录导入模块"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,99 @@
+# test_chat_stream.py
+"""最终回复按 ai_response_chunk 实时推送，不再整段重发"""
+
+import asyncio
+
+from langchain_core.messages import AIMessageChunk
+
+from mcp_agent import WebMCPAgent
+
+
+class _LLM:
+    """按预设的片段依次模拟每一轮流式输出"""
+
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+
+    async def astream(self, messages):
+        for chunk in self.rounds.pop(0):
+            yield chunk
+
+
+async def _events(agent, user_input="hi"):
+    return [event async for event in agent.chat_stream(user_input)]
+
+
+def _agent(rounds) -> WebMCPAgent:
+    agent = WebMCPAgent()
+    agent.llm = _LLM(rounds)
+
+    async def run_tool_calls(tool_calls, events):
+        await events.put(None)
+        return ["ok" for _ in tool_calls]
+
+    agent._run_tool_calls = run_tool_calls
+    return agent
+
+
+def test_final_round_streams_as_response_without_resend():
+    agent = _agent([[AIMessageChunk(content="Hello "), AIMessageChunk(content="world")]])
+    events = asyncio.run(_events(agent))
+    types = [event["type"] for event in events if event["type"] != "status"]
+    assert types == ["ai_response_start", "ai_response_chunk", "ai_response_chunk", "ai_response_end"]
+    assert "".join(e["content"] for e in events if e["type"] == "ai_response_chunk") == "Hello world"
+
+
+def test_tool_round_retracts_streamed_response():
+    tool_chunk = AIMessageChunk(content="", tool_call_chunks=[{"name": "t", "args": "{}", "id": "c1", "index": 0}])
+    agent = _agent([
+        [AIMessageChunk(content="Let me check. "), tool_chunk, AIMessageChunk(content="More")],
+        [AIMessageChunk(content="Done")]
+    ])
+    events = asyncio.run(_events(agent))
+    types = [event["type"] for event in events if event["type"] != "status"]
+    assert types == [
+        "ai_response_start", "ai_response_chunk", "ai_response_retract", "ai_thinking_chunk", "ai_thinking_end",
+        "tool_plan",
+        "ai_response_start", "ai_response_chunk", "ai_response_end"
+    ]
+    assert events[-2]["content"] == "Done"
+
+
+def test_fallback_tool_call_ids_unique_across_turns():
+    def tool_round():
+        return [AIMessageChunk(content="", tool_call_chunks=[{"name": "t", "args": "{}", "id": None, "index": 0}])]
+
+    # 两轮对话，每轮对话各有一次工具调用：轮次编号相同，ID也不能重复
+    agent = _agent([tool_round(), [AIMessageChunk(content="Done")], tool_round(), [AIMessageChunk(content="Done")]])
+    seen = []
+
+    async def run_tool_calls(tool_calls, events):
+        seen.extend(tool_call["id"] for tool_call in tool_calls)
+        await events.put(None)
+        return ["ok" for _ in tool_calls]
+
+    agent._run_tool_calls = run_tool_calls
+    asyncio.run(_events(agent))
+    asyncio.run(_events(agent))
+    assert len(seen) == 2 and len(set(seen)) == 2
+    assert all(tool_id.startswith("call_") for tool_id in seen)
+
+
+def test_cached_tool_calls_get_fresh_ids(monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_TTL", "60")
+    tool_round = [AIMessageChunk(content="", tool_call_chunks=[{"name": "t", "args": "{}", "id": "provider_1", "index": 0}])]
+    # 第二轮对话的首轮推理命中缓存，只有最终回复需要实际请求
+    agent = _agent([tool_round, [AIMessageChunk(content="Done")], [AIMessageChunk(content="Again")]])
+    assert agent.llm_cache.enabled
+    seen = []
+
+    async def run_tool_calls(tool_calls, events):
+        seen.extend(tool_call["id"] for tool_call in tool_calls)
+        await events.put(None)
+        return ["ok" for _ in tool_calls]
+
+    agent._run_tool_calls = run_tool_calls
+    asyncio.run(_events(agent))
+    asyncio.run(_events(agent))
+    assert seen[0] == "provider_1"
+    assert len(seen) == 2 and seen[1] != "provider_1"
@@ -0,0 +1,42 @@
+# test_search.py
+"""无原文全文索引：摘要从原文生成，删除记录时同步移除索引"""
+
+import asyncio
+import sqlite3
+
+from database import ChatDatabase
+
+
+def test_search_snippet_and_unindex(tmp_path):
+    path = str(tmp_path / "chat.db")
+
+    async def scenario():
+        db = ChatDatabase(path)
+        assert await db.initialize()
+        await db.save_conversation(
+            "帮我查询苹果公司的股票",
+            [{"tool_id": "c1", "tool_name": "stock", "tool_args": {}}],
+            [{"tool_id": "c1", "tool_name": "stock", "result": {"quote": "AAPL 收盘价 190.5"}, "success": True}],
+            "苹果公司今天股价上涨" * 100,
+            session_id="a"
+        )
+        await db.save_conversation("今天天气怎么样", ai_response="北京晴天", session_id="b")
+
+        page = await db.search("收盘价")
+        assert [r["matched_in"] for r in page["results"]] == ["tool_results"]
+        assert "<mark>收盘价</mark>" in page["results"][0]["snippet"]
+        page = await db.search("晴天")
+        assert page["results"][0]["snippet"] == "北京<mark>晴天</mark>"
+
+        await db.clear_history("a")
+        await db.close()
+
+    asyncio.run(scenario())
+    conn = sqlite3.connect(path)
+    try:
+        # 删除的记录不再留在索引中，其余记录不受影响
+        assert conn.execute("SELECT COUNT(*) FROM chat_search WHERE chat_search MATCH '\"收 盘 价\"'").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM chat_search WHERE chat_search MATCH '晴'").fetchone()[0] == 1
+        conn.execute("INSERT INTO chat_search (chat_search, rank) VALUES ('integrity-check', 0)")
+    finally:
+        conn.close()
@@ -0,0 +1,58 @@
+# test_tool_cache.py
+"""ToolResultCache 合并调用的取消语义"""
+
+import asyncio
+
+from tool_cache import ToolResultCache
+
+POLICY = {"ttl": 60, "max_entries": 16, "dedicated": False}
+
+
+def test_leader_cancel_does_not_cancel_waiter():
+    async def scenario():
+        cache = ToolResultCache()
+        calls = []
+
+        async def invoke():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return f"result-{len(calls)}"
+
+        leader = asyncio.create_task(cache.call("srv", "get_quote", {"symbol": "A"}, POLICY, invoke))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.call("srv", "get_quote", {"symbol": "A"}, POLICY, invoke))
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        value, source = await waiter
+
+        assert leader.cancelled()
+        assert not waiter.cancelled()
+        # 等待方重新进入后自行执行了调用
+        assert value == "result-2"
+        assert source == "miss"
+        assert len(calls) == 2
+        assert cache.stats()["inflight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiters_share_leader_result():
+    async def scenario():
+        cache = ToolResultCache()
+        calls = []
+
+        async def invoke():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        results = await asyncio.gather(*(
+            cache.call("srv", "get_quote", {"symbol": "A"}, POLICY, invoke) for _ in range(3)
+        ))
+
+        assert [value for value, _ in results] == ["ok", "ok", "ok"]
+        assert sorted(source for _, source in results) == ["coalesced", "coalesced", "miss"]
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
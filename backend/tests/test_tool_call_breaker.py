@@ -0,0 +1,64 @@
+# test_tool_call_breaker.py
+"""工具调用被取消时熔断器试探名额的释放"""
+
+import asyncio
+
+from mcp_agent import WebMCPAgent
+from tool_cache import ToolResultCache
+
+
+class _Tool:
+    async def ainvoke(self, args):
+        await asyncio.sleep(0.01)
+        return "ok"
+
+
+class _Registry:
+    def get(self, name):
+        return _Tool()
+
+    def server_of(self, name):
+        return "srv"
+
+
+def _agent() -> WebMCPAgent:
+    agent = WebMCPAgent.__new__(WebMCPAgent)
+    agent.registry = _Registry()
+    agent.server_options = {"srv": {"max_concurrency": 1}}
+    agent.tool_cache = ToolResultCache()
+    agent._breakers = {}
+    agent._server_semaphores = {}
+    agent.tool_concurrency = 1
+    agent.tool_timeout = 5
+    agent.breaker_threshold = 1
+    agent.breaker_recovery = 0.01
+    return agent
+
+
+def test_probe_released_when_cancelled_waiting_for_semaphore():
+    async def scenario():
+        agent = _agent()
+        breaker = agent._get_breaker("srv")
+        breaker.record_failure("boom")
+        await asyncio.sleep(0.02)
+
+        # 并发名额被占满，试探调用停在等待信号量处时被取消
+        semaphore = agent._get_server_semaphore("srv")
+        await semaphore.acquire()
+        events = asyncio.Queue()
+        probe = asyncio.create_task(agent._run_tool_call(1, 1, {"name": "t", "id": "c1"}, events))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        try:
+            await probe
+        except asyncio.CancelledError:
+            pass
+        semaphore.release()
+
+        # 试探名额已释放，下一次调用可以作为试探执行并关闭熔断
+        result = await agent._run_tool_call(1, 1, {"name": "t", "id": "c2"}, events)
+        assert result == "ok"
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
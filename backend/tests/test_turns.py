@@ -0,0 +1,35 @@
+# test_turns.py
+"""对话轮次的取消与排队"""
+
+import asyncio
+
+from turns import TurnRunner, TURN_STARTED, TURN_QUEUED
+
+
+def test_cancel_then_run_queued_turn():
+    async def scenario():
+        started = []
+        finished = []
+
+        async def process(user_input):
+            started.append(user_input)
+            await asyncio.sleep(0.05)
+            finished.append(user_input)
+
+        runner = TurnRunner(process, policy="queue", max_pending=3)
+        assert runner.submit("a")[0] == TURN_STARTED
+        await asyncio.sleep(0.01)
+        runner.cancel(drop_pending=False)
+        assert runner.submit("b")[0] == TURN_QUEUED
+        while runner.busy:
+            await asyncio.sleep(0.01)
+        assert started == ["a", "b"] and finished == ["b"]
+        assert runner.stats()["cancelled"] == 1 and runner.stats()["completed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancel_without_uncancel(monkeypatch):
+    """Python 3.11 之前的 Task 没有 uncancel()"""
+    monkeypatch.setattr(asyncio, "current_task", lambda loop=None: object())
+    test_cancel_then_run_queued_turn()
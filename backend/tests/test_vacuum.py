@@ -0,0 +1,50 @@
+# test_vacuum.py
+"""旧数据库默认不在启动时执行完整 VACUUM，需显式开启转换"""
+
+import asyncio
+import sqlite3
+
+from database import ChatDatabase
+
+
+def _auto_vacuum(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _open(path):
+    async def scenario():
+        db = ChatDatabase(path)
+        assert await db.initialize()
+        enabled = db.incremental_vacuum_enabled
+        reclaimed = await db.incremental_vacuum(16)
+        await db.close()
+        return enabled, reclaimed
+
+    return asyncio.run(scenario())
+
+
+def test_new_database_is_incremental(tmp_path, monkeypatch):
+    monkeypatch.delenv("CHAT_DB_VACUUM_CONVERT", raising=False)
+    path = str(tmp_path / "new.db")
+    assert _open(path) == (True, 0)
+    assert _auto_vacuum(path) == 2
+
+
+def test_existing_database_converts_only_when_requested(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE legacy (value TEXT)")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.delenv("CHAT_DB_VACUUM_CONVERT", raising=False)
+    assert _open(path) == (False, 0)
+    assert _auto_vacuum(path) == 0
+
+    monkeypatch.setenv("CHAT_DB_VACUUM_CONVERT", "1")
+    assert _open(path)[0] is True
+    assert _auto_vacuum(path) == 2
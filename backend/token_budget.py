@@ -0,0 +1,171 @@
+# token_budget.py
+"""
+对话历史的Token预算
+按记录统计Token数（带缓存），在提示词预算内保留最近的对话，更早的对话压缩为简短摘要
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+# tiktoken 为可选依赖，未安装或编码文件不可用时使用估算
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+def _load_encoding():
+    """加载 cl100k_base 编码；首次使用时 tiktoken 会下载编码文件，离线时可能长时间阻塞或失败"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"⚠️ tiktoken 编码加载失败，使用估算Token数: {e}")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算Token数：中日韩字符约1个Token，其余字符约4个字符1个Token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if 0x2E80 <= ord(ch) <= 0x9FFF or 0xAC00 <= ord(ch) <= 0xD7AF or 0xF900 <= ord(ch) <= 0xFAFF)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class HistoryBudget:
+    """在Token预算内组装对话历史"""
+
+    # 每条消息的格式开销（role等）
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, prompt_budget: int = 8000, summary_budget: int = 500, cache_size: int = 4096):
+        """
+        Args:
+            prompt_budget: 整个提示词（系统提示 + 历史 + 当前输入）的Token预算
+            summary_budget: 被省略的早期对话摘要最多占用的Token数
+            cache_size: 按记录缓存Token数的最大条数
+        """
+        self.prompt_budget = prompt_budget
+        self.summary_budget = summary_budget
+        self.cache_size = cache_size
+        # 编码由 load_encoding() 在后台线程加载，加载完成前（或失败时）使用估算
+        self._encoding = None
+        self._loading: Optional[asyncio.Task] = None
+        self._record_tokens: "OrderedDict[Any, Tuple[int, int]]" = OrderedDict()
+
+    def load_encoding(self) -> Optional[asyncio.Task]:
+        """开始在后台线程加载 tiktoken 编码（只加载一次），返回加载任务；未安装 tiktoken 时返回 None"""
+        if tiktoken is None:
+            return None
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load())
+        return self._loading
+
+    async def _load(self):
+        encoding = await asyncio.to_thread(_load_encoding)
+        if encoding is not None:
+            self._encoding = encoding
+            # 已缓存的是估算值，换用精确计数
+            self._record_tokens.clear()
+            print("✅ tiktoken 编码已加载，按实际Token数裁剪历史")
+
+    def count(self, text: str) -> int:
+        """统计文本Token数"""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def record_tokens(self, record: Dict[str, Any]) -> Tuple[int, int]:
+        """返回记录的 (用户输入Token数, AI回复Token数)，有 id 的记录会被缓存"""
+        record_id = record.get('id')
+        if record_id is not None and record_id in self._record_tokens:
+            self._record_tokens.move_to_end(record_id)
+            return self._record_tokens[record_id]
+
+        counts = (
+            self.count(record.get('user_input') or "") + self.MESSAGE_OVERHEAD,
+            self.count(record.get('ai_response') or "") + self.MESSAGE_OVERHEAD if record.get('ai_response') else 0
+        )
+        if record_id is not None:
+            self._record_tokens[record_id] = counts
+            while len(self._record_tokens) > self.cache_size:
+                self._record_tokens.popitem(last=False)
+        return counts
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """按Token数截断文本，保留开头部分"""
+        if max_tokens <= 0:
+            return ""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            return self._encoding.decode(tokens[:max_tokens]) + "…（已截断）"
+        total = estimate_tokens(text)
+        if total <= max_tokens:
+            return text
+        return text[:max(1, len(text) * max_tokens // total)] + "…（已截断）"
+
+    def _summarize(self, dropped: List[Dict[str, Any]], budget: int) -> Optional[str]:
+        """将被省略的早期对话压缩为用户问题列表"""
+        if not dropped or budget <= 0:
+            return None
+        header = f"（为控制上下文长度，已省略更早的 {len(dropped)} 轮对话，以下为其中用户问题的摘要）"
+        lines = []
+        used = self.count(header)
+        # 优先保留离当前最近的问题
+        for record in reversed(dropped):
+            question = " ".join((record.get('user_input') or "").split())
+            line = f"- {self._truncate(question, 60)}"
+            cost = self.count(line)
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+        return "\n".join([header] + lines[::-1])
+
+    def fit(self, history: List[Dict[str, Any]], reserved_tokens: int = 0) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """在预算内选取历史记录
+
+        Args:
+            history: 历史记录（任意顺序，按时间排序后处理）
+            reserved_tokens: 系统提示与当前输入已占用的Token数
+
+        Returns:
+            (按时间正序保留的记录, 早期对话摘要或None)
+        """
+        records = sorted(history, key=lambda r: (r.get('created_at') or "", r.get('id') or 0))
+        budget = self.prompt_budget - reserved_tokens
+        if budget <= 0:
+            return [], None
+
+        selected: List[Dict[str, Any]] = []
+        used = 0
+        # 从最新的对话开始往前保留
+        index = len(records)
+        while index > 0:
+            record = records[index - 1]
+            user_tokens, ai_tokens = self.record_tokens(record)
+            if used + user_tokens + ai_tokens > budget:
+                if not selected and used + user_tokens < budget:
+                    # 最近一轮单独超出预算时截断其回复而不是整轮丢弃
+                    trimmed = dict(record)
+                    trimmed['ai_response'] = self._truncate(record.get('ai_response') or "", budget - user_tokens - self.MESSAGE_OVERHEAD)
+                    selected.append(trimmed)
+                    used = budget
+                    index -= 1
+                break
+            selected.append(record)
+            used += user_tokens + ai_tokens
+            index -= 1
+
+        selected.reverse()
+        dropped = records[:index]
+        summary = self._summarize(dropped, min(self.summary_budget, max(0, budget - used)))
+        if dropped:
+            print(f"✂️ 历史记录超出Token预算，保留最近 {len(selected)} 轮，省略 {len(dropped)} 轮")
+        return selected, summary
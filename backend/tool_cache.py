@@ -0,0 +1,198 @@
+# tool_cache.py
+"""
+MCP工具结果缓存
+面向只读/幂等工具：LRU + TTL 有界缓存，相同请求并发时合并为一次实际调用
+"""
+
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Callable, Awaitable
+
+# 默认缓存参数（可在 mcp.json 中按服务器/工具覆盖）
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_ENTRIES = 256
+
+
+class LeaderCancelled(Exception):
+    """合并调用中实际执行的一方被取消（如其用户停止了对话），等待方应重新发起调用"""
+
+
+class TTLCache:
+    """带过期时间的LRU缓存"""
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES, ttl: float = DEFAULT_CACHE_TTL):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """返回 (是否命中, 值)，过期条目会被删除"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def make_cache_key(server_name: str, tool_name: str, tool_args: Any) -> str:
+    """由服务器名、工具名和规范化后的参数生成缓存键"""
+    try:
+        args = json.dumps(tool_args, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    except Exception:
+        args = repr(tool_args)
+    return f"{server_name}\x00{tool_name}\x00{args}"
+
+
+class ToolResultCache:
+    """按服务器/工具配置的工具结果缓存
+
+    mcp.json 中服务器的 cache 配置示例::
+
+        "cache": {
+            "enabled": true,          # 未在 tools 中列出的工具是否缓存，默认true
+            "ttl": 300,               # 秒
+            "max_entries": 256,
+            "tools": {
+                "get_quote": {"ttl": 30},
+                "place_order": {"enabled": false}
+            }
+        }
+
+    未配置 cache 的服务器不缓存；tools 中列出的工具默认可缓存，
+    单个工具配置 max_entries 时使用独立的缓存空间。
+    """
+
+    def __init__(self):
+        self._stores: Dict[str, TTLCache] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def resolve_policy(cache_config: Optional[Dict[str, Any]], tool_name: str) -> Optional[Dict[str, Any]]:
+        """合并服务器级与工具级配置，不可缓存时返回None"""
+        if not isinstance(cache_config, dict):
+            return None
+        tools_config = cache_config.get("tools") or {}
+        if tool_name in tools_config:
+            # 单独列出的工具默认可缓存
+            tool_config = tools_config[tool_name] or {}
+            enabled = tool_config.get("enabled", True)
+        else:
+            tool_config = {}
+            enabled = cache_config.get("enabled", True)
+        if not enabled:
+            return None
+        try:
+            ttl = float(tool_config.get("ttl", cache_config.get("ttl", DEFAULT_CACHE_TTL)))
+        except Exception:
+            ttl = DEFAULT_CACHE_TTL
+        if ttl <= 0:
+            return None
+        return {
+            "ttl": ttl,
+            "max_entries": tool_config.get("max_entries", cache_config.get("max_entries", DEFAULT_CACHE_MAX_ENTRIES)),
+            # 工具单独限定容量时使用独立缓存空间
+            "dedicated": "max_entries" in tool_config,
+        }
+
+    def _get_store(self, server_name: str, tool_name: str, policy: Dict[str, Any]) -> TTLCache:
+        store_key = f"{server_name}\x00{tool_name}" if policy["dedicated"] else server_name
+        store = self._stores.get(store_key)
+        if store is None:
+            try:
+                store = TTLCache(max_entries=int(policy["max_entries"]), ttl=policy["ttl"])
+            except Exception:
+                store = TTLCache(ttl=policy["ttl"])
+            self._stores[store_key] = store
+        return store
+
+    async def call(
+        self,
+        server_name: str,
+        tool_name: str,
+        tool_args: Any,
+        policy: Dict[str, Any],
+        invoke: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, str]:
+        """带缓存地执行工具调用
+
+        Returns:
+            (结果, 来源)，来源为 "hit" / "coalesced" / "miss"
+        """
+        key = make_cache_key(server_name, tool_name, tool_args)
+        store = self._get_store(server_name, tool_name, policy)
+
+        while True:
+            hit, value = store.get(key)
+            if hit:
+                self.hits += 1
+                return value, "hit"
+
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            # 相同请求正在执行，等待其结果；执行方被取消时重新进入，由某个等待方自行执行
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future), "coalesced"
+            except LeaderCancelled:
+                self.coalesced -= 1
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await invoke()
+        except BaseException as e:
+            # 执行方被取消不代表等待方也要取消：以 LeaderCancelled 通知它们重试
+            future.set_exception(LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            # 标记异常已被读取，避免无人等待时的告警
+            future.exception()
+            raise
+        else:
+            store.set(key, value, ttl=policy["ttl"])
+            future.set_result(value)
+            return value, "miss"
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self, server_name: Optional[str] = None):
+        """清空缓存；指定服务器时只清空该服务器相关的缓存空间"""
+        if server_name is None:
+            self._stores.clear()
+            return
+        for store_key in list(self._stores):
+            if store_key == server_name or store_key.startswith(f"{server_name}\x00"):
+                del self._stores[store_key]
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "entries": sum(len(store) for store in self._stores.values()),
+            "inflight": len(self._inflight)
+        }
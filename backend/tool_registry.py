@@ -0,0 +1,87 @@
+# tool_registry.py
+"""
+MCP工具注册表
+按服务器分组保存工具，并维护 工具名 -> (服务器, 工具) 索引，支持按服务器增量更新
+"""
+
+from typing import Dict, List, Any, Optional, Tuple, Iterable
+
+
+class ToolRegistry:
+    """MCP工具注册表
+
+    每次变更都会整体构建新的分组与索引后再替换引用（写时复制），
+    正在进行中的对话持有的旧列表不会被修改，读取方无需加锁。
+    """
+
+    def __init__(self):
+        self._tools_by_server: Dict[str, List[Any]] = {}
+        self._index: Dict[str, Tuple[str, Any]] = {}
+        self._tools: List[Any] = []
+        self.version = 0
+
+    @property
+    def tools(self) -> List[Any]:
+        """全部工具的扁平列表"""
+        return self._tools
+
+    @property
+    def tools_by_server(self) -> Dict[str, List[Any]]:
+        """按服务器分组的工具（只读，请勿直接修改）"""
+        return self._tools_by_server
+
+    @property
+    def server_names(self) -> List[str]:
+        return list(self._tools_by_server.keys())
+
+    def get(self, tool_name: str) -> Optional[Any]:
+        """按名称查找工具，未找到返回None"""
+        entry = self._index.get(tool_name)
+        return entry[1] if entry else None
+
+    def server_of(self, tool_name: str) -> Optional[str]:
+        """查找工具所属的服务器"""
+        entry = self._index.get(tool_name)
+        return entry[0] if entry else None
+
+    def update(self, set_servers: Dict[str, List[Any]] = None, remove_servers: Iterable[str] = ()) -> int:
+        """批量更新服务器工具，返回新的版本号
+
+        Args:
+            set_servers: 服务器名 -> 该服务器的完整工具列表（新增或替换）
+            remove_servers: 需要移除的服务器名
+        """
+        tools_by_server = dict(self._tools_by_server)
+        for server_name in remove_servers:
+            tools_by_server.pop(server_name, None)
+        for server_name, server_tools in (set_servers or {}).items():
+            tools_by_server[server_name] = list(server_tools)
+
+        index: Dict[str, Tuple[str, Any]] = {}
+        for server_name, server_tools in tools_by_server.items():
+            for tool in server_tools:
+                owner = index.get(tool.name)
+                if owner and owner[0] != server_name:
+                    print(f"⚠️ 工具名 '{tool.name}' 同时存在于 {owner[0]} 和 {server_name}，使用后者")
+                index[tool.name] = (server_name, tool)
+
+        # 单次同步替换，事件循环内不会观察到中间状态
+        self._tools_by_server = tools_by_server
+        self._index = index
+        self._tools = [tool for server_tools in tools_by_server.values() for tool in server_tools]
+        self.version += 1
+        return self.version
+
+    def set_server_tools(self, server_name: str, server_tools: List[Any]) -> int:
+        """新增或替换单个服务器的工具"""
+        return self.update(set_servers={server_name: server_tools})
+
+    def remove_server(self, server_name: str) -> int:
+        """移除单个服务器及其工具"""
+        return self.update(remove_servers=[server_name])
+
+    def __len__(self) -> int:
+        return len(self._tools)
+
+    def __contains__(self, tool_name: str) -> bool:
+        return tool_name in self._index
@@ -0,0 +1,103 @@
+# tool_results.py
+"""
+大体积工具结果的处理
+分别限制：前端预览、写入提示词、写入数据库的长度；完整结果暂存在内存中，按需分块推送给前端
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Iterator, Tuple
+
+from env import env_int
+
+# 各用途的长度上限（字符数），0 表示不限制
+PREVIEW_LIMIT = env_int("TOOL_RESULT_PREVIEW_CHARS", 4000)
+PROMPT_LIMIT = env_int("TOOL_RESULT_PROMPT_CHARS", 20000)
+STORE_LIMIT = env_int("TOOL_RESULT_STORE_CHARS", 100000)
+# 写入提示词时的截断策略：head_tail 保留首尾，head 只保留开头
+PROMPT_STRATEGY = os.getenv("TOOL_RESULT_PROMPT_STRATEGY", "head_tail").strip() or "head_tail"
+# 按需推送完整结果时每帧的字符数
+CHUNK_SIZE = max(1024, env_int("TOOL_RESULT_CHUNK_CHARS", 64000))
+
+
+def truncate_text(text: str, limit: int, strategy: str = "head") -> Tuple[str, bool]:
+    """按字符数截断文本，返回 (截断后的文本, 是否发生截断)
+
+    Args:
+        text: 原始文本
+        limit: 最大字符数，0 或负数表示不限制
+        strategy: head 保留开头；head_tail 保留开头与结尾各一部分
+    """
+    if limit <= 0 or len(text) <= limit:
+        return text, False
+    omitted = len(text) - limit
+    if strategy == "head_tail":
+        head = limit * 2 // 3
+        tail = limit - head
+        return (
+            f"{text[:head]}\n\n…[结果过长，已省略中间 {omitted} 个字符，共 {len(text)} 个字符]…\n\n{text[-tail:]}",
+            True
+        )
+    return f"{text[:limit]}\n\n…[结果过长，已截断 {omitted} 个字符，共 {len(text)} 个字符]", True
+
+
+def preview_result(text: str) -> Tuple[str, bool]:
+    """前端预览用的结果"""
+    return truncate_text(text, PREVIEW_LIMIT)
+
+
+def prompt_result(text: str) -> str:
+    """写入提示词的结果"""
+    return truncate_text(text, PROMPT_LIMIT, PROMPT_STRATEGY)[0]
+
+
+def stored_result(text: str) -> str:
+    """写入数据库的结果"""
+    return truncate_text(text, STORE_LIMIT)[0]
+
+
+class ToolResultStore:
+    """按总字符数限制的完整工具结果暂存（LRU）"""
+
+    def __init__(self, max_chars: int = None):
+        self.max_chars = max_chars if max_chars is not None else env_int("TOOL_RESULT_MEMORY_CHARS", 8_000_000)
+        self._results: "OrderedDict[str, str]" = OrderedDict()
+        self._total_chars = 0
+
+    def put(self, tool_id: str, result: str):
+        if not tool_id or len(result) > self.max_chars:
+            return
+        old = self._results.pop(tool_id, None)
+        if old is not None:
+            self._total_chars -= len(old)
+        self._results[tool_id] = result
+        self._total_chars += len(result)
+        while self._total_chars > self.max_chars:
+            _, evicted = self._results.popitem(last=False)
+            self._total_chars -= len(evicted)
+
+    def get(self, tool_id: str) -> Optional[str]:
+        result = self._results.get(tool_id)
+        if result is not None:
+            self._results.move_to_end(tool_id)
+        return result
+
+    def iter_chunks(self, tool_id: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+        """将完整结果拆分为 tool_result_chunk 事件"""
+        result = self.get(tool_id)
+        if result is None:
+            return
+        total = max(1, (len(result) + chunk_size - 1) // chunk_size)
+        for index in range(total):
+            yield {
+                "type": "tool_result_chunk",
+                "tool_id": tool_id,
+                "index": index,
+                "total": total,
+                "content": result[index * chunk_size:(index + 1) * chunk_size],
+                "done": index == total - 1
+            }
+
+    def clear(self):
+        self._results.clear()
+        self._total_chars = 0
@@ -0,0 +1,94 @@
+# tool_schema_cache.py
+"""
+MCP工具定义的本地缓存
+将各服务器 get_tools 得到的工具定义持久化到磁盘，按服务器配置的哈希区分，
+重启时可直接用缓存绑定工具，再在后台向服务器重新校验
+"""
+
+import os
+import json
+import hashlib
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Iterable
+
+CACHE_FORMAT_VERSION = 1
+
+
+def config_hash(server_config: Dict[str, Any]) -> str:
+    """服务器连接配置的稳定哈希，配置变化后旧缓存自动失效"""
+    payload = json.dumps(server_config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def serialize_tool(tool: Any) -> Dict[str, Any]:
+    """将 LangChain 工具还原为 MCP 工具定义（name / description / inputSchema / annotations）"""
+    schema = tool.args_schema
+    if not isinstance(schema, dict):
+        schema = schema.model_json_schema() if hasattr(schema, 'model_json_schema') else {}
+    definition = {
+        "name": tool.name,
+        "description": tool.description or "",
+        "inputSchema": schema,
+    }
+    annotations = {k: v for k, v in (getattr(tool, 'metadata', None) or {}).items() if k != "_meta"}
+    if annotations:
+        definition["annotations"] = annotations
+    return definition
+
+
+class ToolSchemaCache:
+    """基于单个JSON文件的工具定义缓存"""
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self._data = self._read()
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_FORMAT_VERSION and isinstance(data.get("servers"), dict):
+                return data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ 工具定义缓存读取失败，将重新获取: {e}")
+        return {"version": CACHE_FORMAT_VERSION, "servers": {}}
+
+    def _write(self):
+        # 先写临时文件再替换，避免进程中断留下损坏的缓存
+        tmp_file = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            print(f"⚠️ 工具定义缓存写入失败: {e}")
+
+    def load(self, server_name: str, server_hash: str) -> Optional[List[Dict[str, Any]]]:
+        """读取服务器的缓存工具定义，配置哈希不一致时返回None"""
+        entry = self._data["servers"].get(server_name)
+        if not entry or entry.get("config_hash") != server_hash:
+            return None
+        return entry.get("tools")
+
+    def save(self, server_name: str, server_hash: str, definitions: List[Dict[str, Any]]):
+        """保存服务器的工具定义，内容未变化时不写盘"""
+        entry = self._data["servers"].get(server_name)
+        if entry and entry.get("config_hash") == server_hash and entry.get("tools") == definitions:
+            return
+        self._data["servers"][server_name] = {
+            "config_hash": server_hash,
+            "saved_at": datetime.now().isoformat(),
+            "tools": definitions
+        }
+        self._write()
+
+    def prune(self, server_names: Iterable[str]):
+        """删除已不在配置中的服务器缓存"""
+        keep = set(server_names)
+        stale = [name for name in self._data["servers"] if name not in keep]
+        if stale:
+            for name in stale:
+                del self._data["servers"][name]
+            self._write()
@@ -0,0 +1,122 @@
+# turns.py
+"""
+WebSocket 连接的对话轮次调度
+每轮对话在独立任务中执行，接收循环保持可读：进行中可响应心跳、处理 cancel；
+对话进行中收到的新消息按策略排队（queue）或拒绝（reject）
+"""
+
+import os
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Any, Optional, Tuple
+
+from env import env_int
+
+TURN_POLICY_QUEUE = "queue"
+TURN_POLICY_REJECT = "reject"
+
+# submit() 的结果
+TURN_STARTED = "started"
+TURN_QUEUED = "queued"
+TURN_REJECTED = "rejected"
+
+
+class TurnRunner:
+    """单个连接的对话轮次：同一时间只执行一轮，其余按策略排队或拒绝"""
+
+    def __init__(self, process: Callable[[str], Awaitable[None]], policy: str = None, max_pending: int = None):
+        """
+        Args:
+            process: 执行一轮对话的协程函数；被取消时应自行保存已生成的部分并正常返回
+            policy: queue 排队 / reject 拒绝进行中收到的新消息
+            max_pending: queue 策略下最多排队的消息数，超出后拒绝
+        """
+        policy = (policy or os.getenv("WS_TURN_POLICY", TURN_POLICY_QUEUE)).strip().lower()
+        if policy not in (TURN_POLICY_QUEUE, TURN_POLICY_REJECT):
+            print(f"⚠️ 未知的对话排队策略 {policy}，改用 queue")
+            policy = TURN_POLICY_QUEUE
+        self.policy = policy
+        self.max_pending = max(0, max_pending if max_pending is not None else env_int("WS_MAX_PENDING_TURNS", 3))
+        self._process = process
+        self._pending: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._cancelling = False
+
+        # 指标
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    @property
+    def busy(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, user_input: str) -> Tuple[str, int]:
+        """提交一条用户消息，返回 (started / queued / rejected, 排队位置)"""
+        if not self.busy:
+            self._task = asyncio.create_task(self._run(user_input))
+            return TURN_STARTED, 0
+        if self.policy == TURN_POLICY_REJECT or len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            return TURN_REJECTED, 0
+        self._pending.append(user_input)
+        return TURN_QUEUED, len(self._pending)
+
+    def cancel(self, drop_pending: bool = True) -> Tuple[bool, int]:
+        """取消进行中的一轮，默认同时丢弃排队的消息；返回 (是否有进行中的轮次, 丢弃的排队数)"""
+        dropped = 0
+        if drop_pending:
+            dropped = len(self._pending)
+            self._pending.clear()
+        if not self.busy:
+            return False, dropped
+        # 同一轮只取消一次，避免打断被取消后保存部分结果的过程
+        if not self._cancelling:
+            self._cancelling = True
+            self._task.cancel()
+        return True, dropped
+
+    async def _run(self, user_input: str):
+        while user_input is not None:
+            self._cancelling = False
+            try:
+                await self._process(user_input)
+            except asyncio.CancelledError:
+                # process 未自行处理取消时（如取消发生在开始之前），本轮视为已取消
+                pass
+            except Exception as e:
+                print(f"❌ 对话轮次执行异常: {e}")
+            if self._cancelling:
+                self.cancelled += 1
+                # 取消已处理完毕，清除任务的取消计数，后续轮次中的超时判断不受影响
+                # （取消计数是 Python 3.11 引入的，更早的版本没有计数，无需清除）
+                task = asyncio.current_task()
+                if hasattr(task, "uncancel"):
+                    task.uncancel()
+            else:
+                self.completed += 1
+            user_input = self._pending.popleft() if self._pending else None
+
+    async def close(self):
+        """连接断开时调用：丢弃排队的消息，取消进行中的一轮并等待其保存完成"""
+        self.cancel()
+        if self._task is not None:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "busy": self.busy,
+            "pending": len(self._pending),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected
+        }
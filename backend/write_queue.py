@@ -0,0 +1,190 @@
+# write_queue.py
+"""
+对话记录的异步写回队列
+WebSocket 每轮结束时只把记录放入有界队列，后台任务按刷新间隔或批大小将多条记录合并为一个事务提交
+"""
+
+import time
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from storage import PartialWriteError
+from env import env_int, env_float
+
+
+class ConversationWriteQueue:
+    """批量提交 save_conversation 的写回队列"""
+
+    def __init__(self, db, max_size: int = None, batch_size: int = None, flush_interval: float = None):
+        """
+        Args:
+            db: ChatStorage 实例（需提供 save_conversations）
+            max_size: 队列最多缓存的记录数，满时 submit 等待（背压）
+            batch_size: 单个事务最多写入的记录数
+            flush_interval: 收到第一条记录后最多等待多少秒再提交
+        """
+        self.db = db
+        self.max_size = max(1, max_size if max_size is not None else env_int("CHAT_DB_WRITE_QUEUE_SIZE", 1000))
+        self.batch_size = max(1, batch_size if batch_size is not None else env_int("CHAT_DB_WRITE_BATCH", 100))
+        interval = flush_interval if flush_interval is not None else env_float("CHAT_DB_FLUSH_INTERVAL_MS", 50) / 1000
+        self.flush_interval = max(0.0, interval)
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_size)
+        self._worker: Optional[asyncio.Task] = None
+        self._closed = False
+        self._warned_full = False
+        # 各会话尚未提交的记录数，用于保证同一会话的"先写后读"
+        self._pending: Dict[str, int] = defaultdict(int)
+        self._committed = asyncio.Condition()
+
+        # 指标
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.backpressure_waits = 0
+        self.max_depth = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._closed = False
+            self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, **record) -> bool:
+        """放入一条对话记录（参数同 save_conversation），队列已关闭时直接同步写入"""
+        record.setdefault("session_id", "default")
+        now = datetime.now().isoformat()
+        record.setdefault("user_timestamp", now)
+        record.setdefault("ai_timestamp", now)
+
+        if self._closed or self._worker is None:
+            return await self._write_one(record)
+
+        if self._queue.full():
+            self.backpressure_waits += 1
+            if not self._warned_full:
+                self._warned_full = True
+                print(f"⏳ 对话写入队列已满 ({self.max_size})，等待后台提交")
+        self._pending[record["session_id"]] += 1
+        try:
+            await self._queue.put(record)
+        except BaseException:
+            self._release(record["session_id"])
+            raise
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def wait_session(self, session_id: str):
+        """等待该会话已提交到队列的记录全部落库"""
+        if not self._pending.get(session_id):
+            return
+        async with self._committed:
+            await self._committed.wait_for(lambda: not self._pending.get(session_id))
+
+    async def flush(self):
+        """等待队列中的全部记录落库"""
+        if self._worker is not None and not self._worker.done():
+            await self._queue.join()
+
+    async def close(self):
+        """停止接收新记录，提交剩余记录后结束后台任务"""
+        self._closed = True
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        print(f"💾 对话写入队列已清空 (共写入 {self.written} 条, {self.batches} 个批次)")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush_batch(batch)
+
+    async def _flush_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            await self.db.save_conversations(batch)
+            self.written += len(batch)
+        except PartialWriteError as e:
+            # 分片存储中其他分片已提交，只重试失败的记录
+            self.written += len(batch) - len(e.failed)
+            print(f"⚠️ 批量保存时 {len(e.failed)} 条对话记录失败，改为逐条写入: {e.error}")
+            for record in e.failed:
+                await self._write_one(record)
+        except Exception as e:
+            # 整批失败时逐条重试，避免一条坏记录拖累同批的其他记录
+            print(f"⚠️ 批量保存 {len(batch)} 条对话记录失败，改为逐条写入: {e}")
+            for record in batch:
+                await self._write_one(record)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+            self._warned_full = False
+            for record in batch:
+                self._release(record["session_id"])
+                self._queue.task_done()
+            async with self._committed:
+                self._committed.notify_all()
+
+    async def _write_one(self, record: Dict[str, Any]) -> bool:
+        try:
+            await self.db.save_conversations([record])
+            self.written += 1
+            return True
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ 保存对话记录失败 (session={record.get('session_id')}): {e}")
+            return False
+
+    def _release(self, session_id: str):
+        self._pending[session_id] -= 1
+        if self._pending[session_id] <= 0:
+            del self._pending[session_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "capacity": self.max_size,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": round(self.flush_interval * 1000, 1),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "backpressure_waits": self.backpressure_waits,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.batches, 2) if self.batches else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2)
+        }
@@ -6,6 +6,7 @@ class ChatApp {
         this.currentAIContent = ''; // 当前AI消息的累积内容
         this.thinkingFlow = new ThinkingFlow(this); // 思维流管理器
         this.sessionId = null; // 当前会话ID，由后端分配
+        this.pendingToolResults = {}; // 正在分块接收的完整工具结果
         
         // DOM 元素
         this.chatMessages = document.getElementById('chatMessages');
@@ -54,6 +55,11 @@ class ChatApp {
         });
         
         this.messageInput.addEventListener('keydown', (e) => {
+            if (e.key === 'Escape') {
+                // Esc 停止当前回复
+                this.cancelTurn();
+                return;
+            }
             if (e.key === 'Enter') {
                 if (e.shiftKey) {
                     // Shift + Enter 换行
@@ -119,7 +125,13 @@ class ChatApp {
             case 'session_info':
                 // 接收会话ID
                 this.sessionId = data.session_id;
-                console.log('🆔 收到会话ID:', this.sessionId);
+                console.log('🆔 收到会话ID:', this.sessionId, '片段合并窗口:', data.batch);
+                if (data.resumed) {
+                    console.log(`🔁 会话已恢复，补发 ${data.replayed} 条事件`);
+                }
+                if (data.replay_gap) {
+                    this.showError('连接中断期间的部分回复未能恢复');
+                }
                 break;
                 
             case 'user_msg_received':
@@ -189,11 +201,51 @@ class ChatApp {
                 this.appendAIResponse(data.content);
                 break;
                 
+            case 'ai_response_retract':
+                // 本轮出现了工具调用，已显示的回复改为该轮的思考内容
+                this.retractAIResponse(data.iteration);
+                break;
+                
             case 'ai_response_end':
                 this.endAIResponse();
                 this.thinkingFlow.completeThinkingFlow('success');
                 break;
                 
+            case 'tool_result_chunk':
+                // 按需加载的完整工具结果分块
+                this.pendingToolResults[data.tool_id] = (this.pendingToolResults[data.tool_id] || '') + data.content;
+                if (data.done) {
+                    this.thinkingFlow.showFullToolResult(data.tool_id, this.pendingToolResults[data.tool_id]);
+                    delete this.pendingToolResults[data.tool_id];
+                }
+                break;
+                
+            case 'tool_result_unavailable':
+                delete this.pendingToolResults[data.tool_id];
+                this.showError(data.content);
+                break;
+                
+            case 'user_msg_queued':
+                // 上一轮尚未结束，消息已排队
+                console.log(`⏳ 消息已排队，位置: ${data.position}`);
+                break;
+                
+            case 'user_msg_rejected':
+                this.showError(`消息未发送：${data.reason}`);
+                this.thinkingFlow.completeThinkingFlow('error');
+                break;
+                
+            case 'turn_cancelled':
+                // 已停止，已生成的部分由服务端保存
+                if (this.currentAIMessage) {
+                    this.endAIResponse();
+                }
+                this.thinkingFlow.completeThinkingFlow('cancelled');
+                break;
+                
+            case 'cancel_ignored':
+                break;
+                
             case 'error':
                 this.showError(data.content);
                 this.thinkingFlow.completeThinkingFlow('error');
@@ -237,6 +289,27 @@ class ChatApp {
         }
     }
     
+    // 停止进行中的回复（同时丢弃排队中的消息）
+    cancelTurn() {
+        if (!this.wsManager.isConnected()) {
+            return;
+        }
+        this.wsManager.send({ type: 'cancel' });
+    }
+    
+    // 请求被截断的工具完整结果，服务端分块推送
+    requestFullToolResult(toolId) {
+        this.pendingToolResults[toolId] = '';
+        const success = this.wsManager.send({
+            type: 'tool_result_request',
+            tool_id: toolId
+        });
+        if (!success) {
+            delete this.pendingToolResults[toolId];
+            this.showError('请求完整结果失败，请检查网络连接');
+        }
+    }
+    
     addUserMessage(content) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'message user';
@@ -324,6 +397,19 @@ class ChatApp {
         }
     }
     
+    retractAIResponse(iteration) {
+        const content = this.currentAIContent;
+        if (this.currentAIMessage) {
+            this.currentAIMessage.closest('.message').remove();
+            this.currentAIMessage = null;
+            this.currentAIContent = '';
+        }
+        this.thinkingFlow.startThinkingContent(iteration);
+        if (content) {
+            this.thinkingFlow.appendThinkingContent(content, iteration);
+        }
+    }
+    
     // 实时markdown渲染方法
     renderMarkdownContent(isFinal = false) {
         if (!this.currentAIMessage || typeof marked === 'undefined') {
@@ -459,14 +545,14 @@ class ChatApp {
                 return;
             }
             
-            // 构建API URL，如果有会话ID则传递
-            let apiUrl = window.configManager.getFullApiUrl('/api/history');
-            if (this.sessionId) {
-                apiUrl += `?session_id=${encodeURIComponent(this.sessionId)}`;
-                console.log('🗑️ 清空当前会话历史:', this.sessionId);
-            } else {
-                console.log('🗑️ 清空所有历史（无会话ID）');
+            // 只清空当前会话；没有会话ID时不请求后端，避免误清空其他会话
+            if (!this.sessionId) {
+                console.warn('⚠️ 无会话ID，跳过清空服务器历史');
+                return;
             }
+            const apiUrl = window.configManager.getFullApiUrl('/api/history') +
+                `?session_id=${encodeURIComponent(this.sessionId)}`;
+            console.log('🗑️ 清空当前会话历史:', this.sessionId);
             
             fetch(apiUrl, {
                 method: 'DELETE'
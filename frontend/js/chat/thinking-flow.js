@@ -208,6 +208,9 @@ class ThinkingFlow {
         if (status === 'success') {
             thinkingText.textContent = '思考完成';
             flowHeader.classList.add('completed');
+        } else if (status === 'cancelled') {
+            thinkingText.textContent = '已停止';
+            flowHeader.classList.add('completed');
         } else {
             thinkingText.textContent = '处理出错';
             flowHeader.classList.add('error');
@@ -261,15 +264,21 @@ class ThinkingFlow {
             statusIcon = '<span class="tool-check">✓</span>';
             statusText = '执行完成';
             
-            // 添加结果显示
+            // 添加结果显示（超长结果只显示预览，可按需加载完整内容）
             const resultContent = this.formatToolResult(data.result);
-            const resultLength = data.result.length;
+            const resultLength = data.result_size || data.result.length;
             const resultSizeText = this.formatDataSize(resultLength);
             const isLongContent = resultLength > 200;
+            const canLoadFull = data.truncated && typeof this.appInstance.requestFullToolResult === 'function';
 
             resultSection = `
                 <div class="tool-result-header">
-                    <span class="tool-result-size">${resultSizeText}</span>
+                    <span class="tool-result-size">${resultSizeText}${data.truncated ? '（预览）' : ''}</span>
+                    ${canLoadFull ? `
+                        <button class="tool-result-load" onclick="${this.appName}.requestFullToolResult('${data.tool_id}')">
+                            <span>加载完整结果</span>
+                        </button>
+                    ` : ''}
                     ${isLongContent ? `
                         <button class="tool-result-toggle" onclick="${this.appName}.thinkingFlow.toggleToolResult('${data.tool_id}')">
                             <span class="toggle-icon">▶</span>
@@ -341,6 +350,25 @@ class ThinkingFlow {
         }
     }
 
+    // 用完整结果替换工具的预览内容
+    showFullToolResult(toolId, result) {
+        const toolDiv = document.getElementById(`thinking-tool-${toolId}`);
+        if (!toolDiv) return;
+
+        const resultContent = toolDiv.querySelector('.tool-result-content');
+        if (resultContent) {
+            resultContent.innerHTML = this.formatToolResult(result);
+        }
+        const sizeText = toolDiv.querySelector('.tool-result-size');
+        if (sizeText) {
+            sizeText.textContent = this.formatDataSize(result.length);
+        }
+        const loadBtn = toolDiv.querySelector('.tool-result-load');
+        if (loadBtn) {
+            loadBtn.remove();
+        }
+    }
+
     // 切换工具结果显示状态
     toggleToolResult(toolId) {
         const toolDiv = document.getElementById(`thinking-tool-${toolId}`);
@@ -43,7 +43,8 @@ class ShareApp {
         try {
             this.showLoading('正在加载对话记录...');
             
-            const apiUrl = window.configManager.getFullApiUrl(`/api/share/${encodeURIComponent(this.sessionId)}`);
+            // 以NDJSON流式获取，边接收边渲染
+            const apiUrl = window.configManager.getFullApiUrl(`/api/share/${encodeURIComponent(this.sessionId)}?stream=true`);
             
             const response = await fetch(apiUrl);
             
@@ -56,18 +57,15 @@ class ShareApp {
                 return;
             }
             
-            const result = await response.json();
+            const total = await this.renderStream(response);
             
-            if (!result.success || !result.data || result.data.length === 0) {
+            if (total === 0) {
                 this.showEmptyState();
                 return;
             }
             
-            // 显示聊天记录
-            this.displayChatHistory(result.data);
-            
             // 更新页面标题
-            document.title = `分享的对话 (${result.total_records}条消息) - MCP Web 智能助手`;
+            document.title = `分享的对话 (${total}条消息) - MCP Web 智能助手`;
             
             this.hideLoading();
             
@@ -77,6 +75,80 @@ class ShareApp {
         }
     }
     
+    async renderStream(response) {
+        // 逐行解析NDJSON：meta → record... → end；同一对话的记录收齐后整组渲染
+        let group = [];
+        let groupNumber = 0;
+        let showSeparators = false;
+        let total = 0;
+        
+        const flushGroup = () => {
+            if (group.length === 0) return;
+            groupNumber++;
+            if (showSeparators) {
+                this.addConversationSeparator(groupNumber, group.length);
+            }
+            group.forEach(record => this.renderRecord(record));
+            group = [];
+        };
+        
+        const handleLine = (line) => {
+            if (!line.trim()) return;
+            const event = JSON.parse(line);
+            if (event.type === 'meta') {
+                this.chatMessages.innerHTML = '';
+                this.addShareHeader(event.session_records);
+                showSeparators = event.session_conversations > 1;
+                this.hideLoading();
+            } else if (event.type === 'record') {
+                const record = event.data;
+                if (group.length > 0 && group[0].conversation_id !== record.conversation_id) {
+                    flushGroup();
+                }
+                group.push(record);
+                total++;
+            } else if (event.type === 'error') {
+                console.warn('⚠️ 分享记录流中断:', event.content);
+            }
+        };
+        
+        if (!response.body || !response.body.getReader) {
+            (await response.text()).split('\n').forEach(handleLine);
+            flushGroup();
+            return total;
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.forEach(handleLine);
+        }
+        handleLine(buffer + decoder.decode());
+        flushGroup();
+        return total;
+    }
+    
+    renderRecord(record) {
+        // 添加用户消息
+        this.addUserMessage(record.user_input, record.created_at);
+        
+        // 重现思维链
+        if (record.mcp_tools_called && record.mcp_tools_called.length > 0) {
+            this.reproduceThinkingFlow(record);
+        }
+        
+        // 添加AI回复
+        if (record.ai_response) {
+            this.addAIMessage(record.ai_response, record.ai_timestamp || record.created_at);
+        }
+    }
+    
     displayChatHistory(records) {
         this.chatMessages.innerHTML = '';
         
@@ -92,20 +164,7 @@ class ShareApp {
                 this.addConversationSeparator(index + 1, conversation.length);
             }
             
-            conversation.forEach(record => {
-                // 添加用户消息
-                this.addUserMessage(record.user_input, record.created_at);
-                
-                // 重现思维链
-                if (record.mcp_tools_called && record.mcp_tools_called.length > 0) {
-                    this.reproduceThinkingFlow(record);
-                }
-                
-                // 添加AI回复
-                if (record.ai_response) {
-                    this.addAIMessage(record.ai_response, record.ai_timestamp || record.created_at);
-                }
-            });
+            conversation.forEach(record => this.renderRecord(record));
         });
         
         // 滚动到顶部
@@ -12,6 +12,11 @@ class WebSocketManager {
         this.isManualClose = false;
         this.isInitialized = false;
         
+        // 会话恢复：重连时带上会话ID与最后收到的事件序号，服务端补发断线期间的事件
+        this.sessionId = null;
+        this.resumeToken = null;
+        this.lastSeq = 0;
+        
         // 事件回调
         this.onOpen = null;
         this.onMessage = null;
@@ -32,6 +37,12 @@ class WebSocketManager {
             
             // 获取WebSocket URL
             this.url = window.configManager.getSmartWebSocketUrl('/ws/chat');
+            
+            // 协商流式片段的合并窗口（毫秒），未配置时使用服务端默认值
+            const wsConfig = window.configManager.config.websocket || {};
+            if (wsConfig.batchMs !== undefined) {
+                this.url += `${this.url.includes('?') ? '&' : '?'}batch_ms=${encodeURIComponent(wsConfig.batchMs)}`;
+            }
             this.isInitialized = true;
             
             console.log('🔧 WebSocket 初始化完成, URL:', this.url);
@@ -77,7 +88,7 @@ class WebSocketManager {
         console.log('🔗 正在连接 WebSocket...', this.url);
         
         try {
-            this.ws = new WebSocket(this.url);
+            this.ws = new WebSocket(this.getConnectUrl());
             this.setupEventListeners();
         } catch (error) {
             console.error('❌ WebSocket 连接错误:', error);
@@ -85,6 +96,15 @@ class WebSocketManager {
         }
     }
     
+    getConnectUrl() {
+        if (!this.sessionId || !this.resumeToken) {
+            return this.url;
+        }
+        const separator = this.url.includes('?') ? '&' : '?';
+        return `${this.url}${separator}session_id=${encodeURIComponent(this.sessionId)}` +
+            `&resume_token=${encodeURIComponent(this.resumeToken)}&last_seq=${this.lastSeq}`;
+    }
+    
     setupEventListeners() {
         this.ws.onopen = (event) => {
             console.log('✅ WebSocket 连接成功');
@@ -101,6 +121,25 @@ class WebSocketManager {
             try {
                 const data = JSON.parse(event.data);
                 
+                if (data.type === 'session_info') {
+                    this.sessionId = data.session_id;
+                    // 恢复令牌只用于重连，不随消息转发
+                    this.resumeToken = data.resume_token || null;
+                    delete data.resume_token;
+                    // 新会话或无法完整补发时，从服务端当前的序号继续
+                    if (!data.resumed || data.replay_gap) {
+                        this.lastSeq = data.last_seq || 0;
+                    }
+                }
+                
+                // 带序号的会话事件：跳过重连补发时重复收到的部分
+                if (data.seq !== undefined) {
+                    if (data.seq <= this.lastSeq) {
+                        return;
+                    }
+                    this.lastSeq = data.seq;
+                }
+                
                 // 处理心跳响应
                 if (data.type === 'pong') {
                     console.log('💓 收到心跳响应');
@@ -124,6 +163,11 @@ class WebSocketManager {
                 this.onClose(event);
             }
             
+            // 会话已在其他连接中恢复（4000）时不再重连
+            if (event.code === 4000) {
+                return;
+            }
+            
             // 如果不是手动关闭，尝试重连
             if (!this.isManualClose && this.reconnectAttempts < this.maxReconnectAttempts) {
                 this.attemptReconnect();